@@ -1,32 +1,171 @@
 from django.contrib import admin
-from .models import Owner, DriverLicense, Vehicle, Plate, Insurer, InsurancePolicy, Accident, CarPart
+from django.core.paginator import Paginator
+from django.db import connections, models
+from django.utils.functional import cached_property
+
+from .models import (
+    Owner, DriverLicense, Vehicle, Plate, Insurer, InsurancePolicy, Accident, CarPart, PlateLookupStat, LookupAuditEvent,
+    PlateArchive, AccidentArchive, VehicleRiskSummary, VehicleFacetCount,
+)
+
+
+def estimated_rows(queryset):
+    """
+    Row count of the queryset's table without scanning it, or None.
+
+    PostgreSQL: the planner's estimate from the last ANALYZE. SQLite: the
+    largest integer primary key, an upper bound that only overshoots by
+    the deleted rows.
+    """
+    connection = connections[queryset.db]
+    if connection.vendor == 'postgresql':
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass',
+                           [queryset.model._meta.db_table])
+            row = cursor.fetchone()
+        # -1: never analyzed
+        return row[0] if row and row[0] >= 0 else None
+    pk = queryset.model._meta.pk
+    if connection.vendor == 'sqlite' and isinstance(pk.target_field if pk.is_relation else pk, models.IntegerField):
+        return queryset.model._default_manager.using(queryset.db).aggregate(rows=models.Max('pk'))['rows'] or 0
+    return None
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Changelist paginator that never runs an exact ``COUNT(*)`` over a big table.
+
+    Unfiltered lists of big tables use ``estimated_rows``; everything else
+    counts at most ``COUNT_LIMIT`` matching rows, so the page links stop
+    there and narrowing the filter reaches the rest. Small estimates are
+    not trusted: a changelist that fits on one page is fetched without
+    LIMIT, which must never happen because of stale statistics.
+    """
+    COUNT_LIMIT = 10000
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        if not queryset.query.has_filters():
+            estimate = estimated_rows(queryset)
+            if estimate is not None and estimate >= self.COUNT_LIMIT:
+                return estimate
+        return queryset.order_by().values('pk')[:self.COUNT_LIMIT].count()
+
+
+class RegistryAdmin(admin.ModelAdmin):
+    """
+    Defaults for registry tables that grow to millions of rows: estimated
+    counts, no second count for "N total", and search by exact values of
+    unique or indexed columns only (``search_fields`` use ``__exact``).
+    """
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    list_per_page = 50
+    search_help_text = 'Точное совпадение'
+    # Plate numbers, VINs and document numbers are stored in upper case
+    search_uppercase = True
+
+    def get_search_results(self, request, queryset, search_term):
+        search_term = search_term.strip()
+        if self.search_uppercase:
+            search_term = search_term.upper()
+        return super().get_search_results(request, queryset, search_term)
+
+
+class VehicleFacetFilter(admin.SimpleListFilter):
+    """Most common values from ``vehicle_facet_counts`` instead of ``SELECT DISTINCT`` over ``vehicles``."""
+    facet = None
+    limit = 50
+
+    def lookups(self, request, model_admin):
+        rows = (
+            VehicleFacetCount.objects.filter(facet=self.facet, vehicles__gt=0).exclude(value='')
+            .order_by('-vehicles', 'value')[:self.limit]
+        )
+        return [(row.value, f'{row.value} ({row.vehicles})') for row in rows]
+
+    def queryset(self, request, queryset):
+        if self.value() is None:
+            return queryset
+        return queryset.filter(**{self.facet: self.value()})
+
+
+class FixedValuesFilter(admin.SimpleListFilter):
+    """Filter over a known set of values, without ``SELECT DISTINCT`` over the table."""
+    values = ()
+
+    def lookups(self, request, model_admin):
+        return [(str(value), str(value)) for value in self.values]
+
+    def queryset(self, request, queryset):
+        if self.value() is None:
+            return queryset
+        return queryset.filter(**{self.parameter_name: self.value()})
+
+
+class EndpointFilter(FixedValuesFilter):
+    title = 'endpoint'
+    parameter_name = 'endpoint'
+    values = ('check_plate', 'check_batch', 'check_vin')
+
+
+class StatusCodeFilter(FixedValuesFilter):
+    title = 'status code'
+    parameter_name = 'status_code'
+    values = (200, 404)
+
+
+class MakeFilter(VehicleFacetFilter):
+    title = 'make'
+    parameter_name = facet = 'make'
+
+
+class YearFilter(VehicleFacetFilter):
+    title = 'year'
+    parameter_name = facet = 'year'
+
+
+class ColorFilter(VehicleFacetFilter):
+    title = 'color'
+    parameter_name = facet = 'color'
 
 
 @admin.register(Owner)
-class OwnerAdmin(admin.ModelAdmin):
+class OwnerAdmin(RegistryAdmin):
     list_display = ['owner_id', 'full_name', 'iin', 'dob', 'phone']
-    search_fields = ['full_name', 'iin', 'phone']
+    search_fields = ['iin__exact']
+    search_help_text = 'ИИН, точное совпадение'
 
 
 @admin.register(DriverLicense)
-class DriverLicenseAdmin(admin.ModelAdmin):
+class DriverLicenseAdmin(RegistryAdmin):
     list_display = ['license_id', 'number', 'owner', 'categories', 'issued_at', 'expires_at', 'status']
-    list_filter = ['status', 'categories']
-    search_fields = ['number', 'owner__full_name']
+    list_select_related = ['owner']
+    list_filter = ['status']
+    search_fields = ['number__exact', 'owner__iin__exact']
+    search_help_text = 'Номер удостоверения или ИИН владельца, точное совпадение'
+    autocomplete_fields = ['owner']
 
 
 @admin.register(Vehicle)
-class VehicleAdmin(admin.ModelAdmin):
+class VehicleAdmin(RegistryAdmin):
     list_display = ['vehicle_id', 'vin', 'make', 'model', 'year', 'color', 'owner']
-    search_fields = ['vin', 'make', 'model', 'owner__full_name']
-    list_filter = ['make', 'year', 'color']
+    list_select_related = ['owner']
+    search_fields = ['vin__exact']
+    search_help_text = 'VIN, точное совпадение'
+    list_filter = [MakeFilter, YearFilter, ColorFilter]
+    autocomplete_fields = ['owner']
 
 
 @admin.register(Plate)
-class PlateAdmin(admin.ModelAdmin):
+class PlateAdmin(RegistryAdmin):
     list_display = ['plate_id', 'plate_number', 'vehicle', 'region', 'assigned_at', 'released_at']
-    search_fields = ['plate_number', 'vehicle__vin']
-    list_filter = ['region', 'assigned_at']
+    list_select_related = ['vehicle']
+    search_fields = ['plate_number__exact', 'vehicle__vin__exact']
+    search_help_text = 'Номер или VIN, точное совпадение'
+    list_filter = ['assigned_at']
+    raw_id_fields = ['vehicle']
 
 
 @admin.register(Insurer)
@@ -36,22 +175,72 @@ class InsurerAdmin(admin.ModelAdmin):
 
 
 @admin.register(InsurancePolicy)
-class InsurancePolicyAdmin(admin.ModelAdmin):
+class InsurancePolicyAdmin(RegistryAdmin):
     list_display = ['policy_id', 'policy_number', 'type', 'vehicle', 'insurer', 'valid_from', 'valid_to', 'status']
+    list_select_related = ['vehicle', 'insurer']
     list_filter = ['type', 'status', 'insurer']
-    search_fields = ['policy_number', 'vehicle__vin']
+    search_fields = ['policy_number__exact', 'vehicle__vin__exact']
+    search_help_text = 'Номер полиса или VIN, точное совпадение'
+    raw_id_fields = ['vehicle']
+    autocomplete_fields = ['insurer']
 
 
 @admin.register(CarPart)
 class CarPartAdmin(admin.ModelAdmin):
-    list_display = ['part_id', 'name', 'category', 'description']
+    list_display = ['part_id', 'name', 'category', 'bit', 'description']
     list_filter = ['category']
     search_fields = ['name', 'category', 'description']
 
 
 @admin.register(Accident)
-class AccidentAdmin(admin.ModelAdmin):
+class AccidentAdmin(RegistryAdmin):
     list_display = ['accident_id', 'vehicle', 'date', 'severity', 'location', 'fault_party']
+    list_select_related = ['vehicle']
     list_filter = ['severity', 'fault_party', 'date']
-    search_fields = ['vehicle__vin', 'location', 'description']
+    search_fields = ['vehicle__vin__exact']
+    search_help_text = 'VIN, точное совпадение'
+    raw_id_fields = ['vehicle']
     filter_horizontal = ['damaged_parts']
+
+
+@admin.register(PlateLookupStat)
+class PlateLookupStatAdmin(RegistryAdmin):
+    list_display = ['plate_number', 'lookups', 'last_lookup_at']
+    search_fields = ['plate_number__exact']
+    search_help_text = 'Номер, точное совпадение'
+    ordering = ['-lookups']
+
+
+@admin.register(LookupAuditEvent)
+class LookupAuditEventAdmin(RegistryAdmin):
+    list_display = ['event_id', 'occurred_at', 'client', 'plate_number', 'endpoint', 'status_code', 'remote_addr']
+    list_filter = [EndpointFilter, StatusCodeFilter, 'occurred_at']
+    search_fields = ['plate_number__exact', 'client__exact']
+    search_help_text = 'Номер или клиент, точное совпадение'
+    search_uppercase = False
+
+
+@admin.register(PlateArchive)
+class PlateArchiveAdmin(RegistryAdmin):
+    list_display = ['plate_id', 'plate_number', 'region', 'vehicle', 'assigned_at', 'released_at', 'archived_at']
+    list_select_related = ['vehicle']
+    search_fields = ['plate_number__exact', 'vehicle__vin__exact']
+    search_help_text = 'Номер или VIN, точное совпадение'
+    raw_id_fields = ['vehicle']
+
+
+@admin.register(AccidentArchive)
+class AccidentArchiveAdmin(RegistryAdmin):
+    list_display = ['accident_id', 'vehicle', 'date', 'severity', 'location', 'fault_party', 'archived_at']
+    list_select_related = ['vehicle']
+    list_filter = ['severity', 'fault_party']
+    search_fields = ['vehicle__vin__exact']
+    search_help_text = 'VIN, точное совпадение'
+    raw_id_fields = ['vehicle']
+
+
+@admin.register(VehicleRiskSummary)
+class VehicleRiskSummaryAdmin(RegistryAdmin):
+    list_display = ['vehicle', 'accidents', 'at_fault_accidents', 'last_accident_at', 'osago_valid_to', 'kasko_valid_to', 'updated_at']
+    list_select_related = ['vehicle']
+    raw_id_fields = ['vehicle']
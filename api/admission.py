@@ -0,0 +1,290 @@
+"""
+Admission control and load shedding for API views.
+
+Each configured view gets a concurrency limit and a bounded wait queue.
+Requests that would wait longer than the view's latency budget (or the
+client's own deadline) are rejected immediately with 503 + Retry-After
+instead of queueing behind slow database work. Optional per-client token
+buckets live in a memory-mapped file so every worker on the host shares
+the same limits.
+"""
+import math
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+import zlib
+from collections import Counter
+
+from django.conf import settings
+from django.http import JsonResponse
+
+try:
+    import fcntl
+except ImportError:  # Windows: buckets fall back to a per-process lock
+    fcntl = None
+
+
+DEFAULTS = {
+    'ENABLED': True,
+    'MAX_CONCURRENCY': 16,
+    'MAX_QUEUE': 64,
+    'LATENCY_BUDGET': 0.5,
+    'VIEWS': {},
+    'RATE_LIMIT': None,
+}
+
+DEADLINE_HEADER = 'HTTP_X_REQUEST_TIMEOUT'
+CLIENT_HEADER = 'HTTP_X_CLIENT_ID'
+
+
+def get_config():
+    config = dict(DEFAULTS)
+    config.update(getattr(settings, 'API_ADMISSION', {}))
+    return config
+
+
+class ViewLimiter:
+    """Concurrency limit with a bounded, deadline-aware wait queue."""
+
+    def __init__(self, name, max_concurrency, max_queue, latency_budget):
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.latency_budget = latency_budget
+        self.active = 0
+        self.waiting = 0
+        # EWMA of time spent inside the view, used to estimate queue wait
+        self.service_time = 0.05
+        self._cond = threading.Condition()
+
+    def estimated_wait(self, position):
+        return position / self.max_concurrency * self.service_time
+
+    def acquire(self, timeout):
+        """Return (admitted, reason, retry_after)."""
+        budget = self.latency_budget if timeout is None else min(timeout, self.latency_budget)
+        with self._cond:
+            if self.active < self.max_concurrency and not self.waiting:
+                self.active += 1
+                return True, None, 0
+            if self.waiting >= self.max_queue:
+                return False, 'queue_full', self.estimated_wait(self.waiting + 1)
+            expected = self.estimated_wait(self.waiting + 1)
+            if expected > budget:
+                return False, 'latency_budget', expected
+
+            self.waiting += 1
+            deadline = time.monotonic() + budget
+            try:
+                while self.active >= self.max_concurrency:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return False, 'timeout', self.estimated_wait(self.waiting)
+                    self._cond.wait(remaining)
+                self.active += 1
+                return True, None, 0
+            finally:
+                self.waiting -= 1
+
+    def release(self, elapsed):
+        with self._cond:
+            self.active -= 1
+            self.service_time = 0.8 * self.service_time + 0.2 * elapsed
+            self._cond.notify()
+
+
+class SharedTokenBuckets:
+    """
+    Fixed-size table of token buckets in a memory-mapped file.
+
+    Clients are hashed into slots, so two clients may share a bucket when
+    the table is small; the table size should comfortably exceed the number
+    of active clients. Each slot is locked with a byte-range lock, which
+    makes the buckets safe to share between forked workers.
+    """
+
+    SLOT = struct.Struct('dd')  # tokens, last refill (wall clock)
+
+    def __init__(self, rate, burst, slots=4096, path=None):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.slots = slots
+        self._local_lock = threading.Lock()
+        size = self.SLOT.size * slots
+        if path is None:
+            path = os.path.join(tempfile.gettempdir(), 'car_registry_ratelimit.bin')
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        if os.fstat(self._fd).st_size < size:
+            os.ftruncate(self._fd, size)
+        self._map = mmap.mmap(self._fd, size)
+
+    def _lock(self, offset):
+        if fcntl is not None:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, self.SLOT.size, offset)
+
+    def _unlock(self, offset):
+        if fcntl is not None:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN, self.SLOT.size, offset)
+
+    def consume(self, client_id):
+        """Take one token; return 0 if allowed, else seconds until the next token."""
+        offset = (zlib.crc32(client_id.encode()) % self.slots) * self.SLOT.size
+        now = time.time()
+        with self._local_lock:
+            self._lock(offset)
+            try:
+                tokens, updated = self.SLOT.unpack_from(self._map, offset)
+                if updated == 0:
+                    tokens = self.burst
+                else:
+                    tokens = min(self.burst, tokens + (now - updated) * self.rate)
+                if tokens >= 1:
+                    self.SLOT.pack_into(self._map, offset, tokens - 1, now)
+                    return 0
+                self.SLOT.pack_into(self._map, offset, tokens, now)
+                return (1 - tokens) / self.rate
+            finally:
+                self._unlock(offset)
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+_buckets = None
+_counters = Counter()
+_counters_lock = threading.Lock()
+
+
+def get_limiter(name, config):
+    limiter = _limiters.get(name)
+    if limiter is None:
+        with _limiters_lock:
+            limiter = _limiters.get(name)
+            if limiter is None:
+                options = config['VIEWS'].get(name) or {}
+                limiter = _limiters[name] = ViewLimiter(
+                    name,
+                    options.get('MAX_CONCURRENCY', config['MAX_CONCURRENCY']),
+                    options.get('MAX_QUEUE', config['MAX_QUEUE']),
+                    options.get('LATENCY_BUDGET', config['LATENCY_BUDGET']),
+                )
+    return limiter
+
+
+def get_buckets(config):
+    global _buckets
+    options = config['RATE_LIMIT']
+    if not options or not options.get('RATE'):
+        return None
+    if _buckets is None:
+        with _limiters_lock:
+            if _buckets is None:
+                _buckets = SharedTokenBuckets(
+                    options['RATE'],
+                    options.get('BURST', options['RATE']),
+                    options.get('SLOTS', 4096),
+                    options.get('PATH'),
+                )
+    return _buckets
+
+
+def count(view_name, reason):
+    with _counters_lock:
+        _counters[(view_name, reason)] += 1
+
+
+def snapshot():
+    """Shed/admitted counters and current queue state for this process."""
+    with _counters_lock:
+        counters = dict(_counters)
+    views = {}
+    for (view_name, reason), value in counters.items():
+        views.setdefault(view_name, {})[reason] = value
+    for name, limiter in list(_limiters.items()):
+        views.setdefault(name, {}).update({
+            'active': limiter.active,
+            'waiting': limiter.waiting,
+            'service_time': round(limiter.service_time, 4),
+        })
+    return views
+
+
+def client_id(request):
+    return request.META.get(CLIENT_HEADER) or request.META.get('REMOTE_ADDR') or 'anonymous'
+
+
+def request_timeout(request):
+    value = request.META.get(DEADLINE_HEADER)
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        return None
+
+
+def rejected(status_code, detail, retry_after):
+    response = JsonResponse({'detail': detail}, status=status_code)
+    response['Retry-After'] = str(max(1, math.ceil(retry_after)))
+    return response
+
+
+class AdmissionControlMiddleware:
+    """
+    Sheds load for the views listed in ``API_ADMISSION['VIEWS']``.
+
+    The slot is taken in ``process_view`` (once the view is resolved) and
+    given back when the response comes out of the middleware chain, or, for
+    a streaming response, when the server closes it: the body is produced
+    after this middleware has returned.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        try:
+            response = self.get_response(request)
+        except BaseException:
+            self.release(request)
+            raise
+        if response.streaming and getattr(request, '_admission', None) is not None:
+            response._resource_closers.append(lambda: self.release(request))
+        else:
+            self.release(request)
+        return response
+
+    @staticmethod
+    def release(request):
+        admission = getattr(request, '_admission', None)
+        if admission is not None:
+            # close() may run more than once
+            request._admission = None
+            limiter, started = admission
+            limiter.release(time.monotonic() - started)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        config = get_config()
+        match = request.resolver_match
+        name = match.url_name if match else None
+        if not config['ENABLED'] or name not in config['VIEWS']:
+            return None
+
+        buckets = get_buckets(config)
+        if buckets is not None:
+            wait = buckets.consume(client_id(request))
+            if wait:
+                count(name, 'rate_limited')
+                return rejected(429, 'rate limit exceeded', wait)
+
+        limiter = get_limiter(name, config)
+        admitted, reason, retry_after = limiter.acquire(request_timeout(request))
+        if not admitted:
+            count(name, reason)
+            return rejected(503, f'overloaded: {reason}', retry_after)
+
+        count(name, 'admitted')
+        request._admission = (limiter, time.monotonic())
+        return None
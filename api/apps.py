@@ -1,6 +1,73 @@
 from django.apps import AppConfig
+from django.db.backends.signals import connection_created
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete, pre_save
+
+
+def configure_sqlite(sender, connection, **kwargs):
+    """
+    Use WAL journaling on SQLite so background batch writers (audit log,
+    lookup counters) never block concurrent readers.
+    """
+    if connection.vendor == 'sqlite':
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA journal_mode=WAL')
+            cursor.execute('PRAGMA synchronous=NORMAL')
 
 
 class ApiConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'api'
+
+    def ready(self):
+        from . import dbguard, fragments, health, materialized, parts, risk, search
+        from .models import Accident, CarPart, DriverLicense, Insurer, InsurancePolicy, Owner, Plate, Vehicle
+
+        connection_created.connect(configure_sqlite, dispatch_uid='api.configure_sqlite')
+        connection_created.connect(dbguard.install, dispatch_uid='api.dbguard.install')
+        connection_created.connect(health.track_connection, dispatch_uid='api.health.track_connection')
+        m2m_changed.connect(parts.sync_mask, sender=Accident.damaged_parts.through, dispatch_uid='api.parts.sync_mask')
+        pre_delete.connect(parts.drop_part_bit, sender=CarPart, dispatch_uid='api.parts.drop_part_bit')
+        post_save.connect(parts.catalog_changed, sender=CarPart, dispatch_uid='api.parts.catalog_saved')
+        post_delete.connect(parts.catalog_changed, sender=CarPart, dispatch_uid='api.parts.catalog_deleted')
+        pre_save.connect(search.remember_facets, sender=Vehicle, dispatch_uid='api.search.remember_facets')
+        post_save.connect(search.count_saved, sender=Vehicle, dispatch_uid='api.search.count_saved')
+        post_delete.connect(search.count_deleted, sender=Vehicle, dispatch_uid='api.search.count_deleted')
+        post_save.connect(risk.vehicle_created, sender=Vehicle, dispatch_uid='api.risk.vehicle_created')
+        pre_save.connect(risk.remember_accident, sender=Accident, dispatch_uid='api.risk.remember_accident')
+        post_save.connect(risk.accident_saved, sender=Accident, dispatch_uid='api.risk.accident_saved')
+        post_delete.connect(risk.accident_deleted, sender=Accident, dispatch_uid='api.risk.accident_deleted')
+        pre_save.connect(risk.remember_policy, sender=InsurancePolicy, dispatch_uid='api.risk.remember_policy')
+        post_save.connect(risk.policy_saved, sender=InsurancePolicy, dispatch_uid='api.risk.policy_saved')
+        post_delete.connect(risk.policy_deleted, sender=InsurancePolicy, dispatch_uid='api.risk.policy_deleted')
+        post_save.connect(fragments.owner_changed, sender=Owner, dispatch_uid='api.fragments.owner_saved')
+        post_delete.connect(fragments.owner_changed, sender=Owner, dispatch_uid='api.fragments.owner_deleted')
+        pre_save.connect(fragments.remember_license_owner, sender=DriverLicense,
+                         dispatch_uid='api.fragments.remember_license_owner')
+        post_save.connect(fragments.license_changed, sender=DriverLicense, dispatch_uid='api.fragments.license_saved')
+        post_delete.connect(fragments.license_changed, sender=DriverLicense, dispatch_uid='api.fragments.license_deleted')
+        post_save.connect(fragments.insurer_changed, sender=Insurer, dispatch_uid='api.fragments.insurer_saved')
+        post_delete.connect(fragments.insurer_changed, sender=Insurer, dispatch_uid='api.fragments.insurer_deleted')
+        for model in (Plate, InsurancePolicy, Accident):
+            name = model._meta.model_name
+            pre_save.connect(materialized.remember_vehicle, sender=model,
+                             dispatch_uid=f'api.materialized.remember_vehicle.{name}')
+            post_save.connect(materialized.vehicle_row_changed, sender=model,
+                              dispatch_uid=f'api.materialized.{name}_saved')
+            post_delete.connect(materialized.vehicle_row_changed, sender=model,
+                                dispatch_uid=f'api.materialized.{name}_deleted')
+        post_save.connect(materialized.vehicle_changed, sender=Vehicle, dispatch_uid='api.materialized.vehicle_saved')
+        post_delete.connect(materialized.vehicle_changed, sender=Vehicle, dispatch_uid='api.materialized.vehicle_deleted')
+        post_save.connect(materialized.owner_changed, sender=Owner, dispatch_uid='api.materialized.owner_saved')
+        pre_delete.connect(materialized.owner_changed, sender=Owner, dispatch_uid='api.materialized.owner_deleted')
+        pre_save.connect(materialized.remember_license_owner, sender=DriverLicense,
+                         dispatch_uid='api.materialized.remember_license_owner')
+        post_save.connect(materialized.license_changed, sender=DriverLicense,
+                          dispatch_uid='api.materialized.license_saved')
+        post_delete.connect(materialized.license_changed, sender=DriverLicense,
+                            dispatch_uid='api.materialized.license_deleted')
+        post_save.connect(materialized.insurer_changed, sender=Insurer, dispatch_uid='api.materialized.insurer_saved')
+        pre_delete.connect(materialized.insurer_changed, sender=Insurer, dispatch_uid='api.materialized.insurer_deleted')
+        post_save.connect(materialized.part_changed, sender=CarPart, dispatch_uid='api.materialized.part_saved')
+        pre_delete.connect(materialized.part_changed, sender=CarPart, dispatch_uid='api.materialized.part_deleted')
+        m2m_changed.connect(materialized.damaged_parts_changed, sender=Accident.damaged_parts.through,
+                            dispatch_uid='api.materialized.damaged_parts_changed')
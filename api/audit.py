@@ -0,0 +1,187 @@
+"""
+Asynchronous, batched audit log of personal-data lookups.
+
+Requests only put a tuple on a bounded in-process queue. A background
+writer wakes every ``FLUSH_INTERVAL`` seconds, or as soon as
+``BATCH_SIZE`` events are waiting, and inserts them in batches of at most
+``BATCH_SIZE`` rows. When the queue is full the
+request either waits briefly and then writes its own event synchronously
+(``ON_FULL = 'block'``; if that insert fails the event is logged and
+counted as dropped) or the event is counted and dropped (``'drop'``).
+Pending events are flushed at interpreter exit.
+"""
+import atexit
+import logging
+import os
+import queue
+import threading
+import time
+from collections import Counter
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    'ENABLED': True,
+    'QUEUE_SIZE': 10000,
+    'BATCH_SIZE': 500,
+    'FLUSH_INTERVAL': 1.0,
+    'ON_FULL': 'block',
+    'BLOCK_TIMEOUT': 0.05,
+}
+
+INSERT_SQL = (
+    "INSERT INTO lookup_audit_events "
+    "(occurred_at, plate_number, client, remote_addr, endpoint, sections, status_code) "
+    "VALUES (%s, %s, %s, %s, %s, %s, %s)"
+)
+
+
+def get_config():
+    config = dict(DEFAULTS)
+    config.update(getattr(settings, 'LOOKUP_AUDIT', {}))
+    return config
+
+
+class AuditWriter:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pid = None
+        self._thread = None
+        self.configure()
+
+    def configure(self):
+        """(Re)read settings, flushing and stopping a running writer first."""
+        self.shutdown()
+        self.config = get_config()
+        self.queue = queue.Queue(self.config['QUEUE_SIZE'])
+        self.counters = Counter()
+
+    def _ensure_started(self):
+        # Threads do not survive fork(): each worker starts its own writer
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self.queue = queue.Queue(self.config['QUEUE_SIZE'])
+            self._wake = threading.Event()
+            self._stopping = threading.Event()
+            self._thread = threading.Thread(target=self._run, name='audit-writer', daemon=True)
+            self._thread.start()
+            self._pid = os.getpid()
+
+    def record(self, plate_number, client, remote_addr, endpoint, sections, status_code):
+        if not self.config['ENABLED']:
+            return
+        self._ensure_started()
+        event = (timezone.now(), plate_number, client, remote_addr, endpoint, sections, status_code)
+        try:
+            self.queue.put_nowait(event)
+            if self.queue.qsize() >= self.config['BATCH_SIZE']:
+                self._wake.set()
+            return
+        except queue.Full:
+            self._wake.set()
+
+        if self.config['ON_FULL'] == 'drop':
+            self.counters['dropped'] += 1
+            return
+        try:
+            self.queue.put(event, timeout=self.config['BLOCK_TIMEOUT'])
+            self.counters['blocked'] += 1
+            return
+        except queue.Full:
+            pass
+        # The writer cannot keep up: pay for this one insert on the request
+        # thread rather than lose a compliance record. Its failure must not
+        # fail the lookup itself
+        try:
+            self._write([event])
+        except Exception:
+            self.counters['dropped'] += 1
+            self.counters['write_errors'] += 1
+            logger.exception('Failed to write an audit event inline, dropped')
+        else:
+            self.counters['written_inline'] += 1
+
+    def _write(self, events):
+        # Plain executemany: building model instances for bulk_create would
+        # hold the GIL several times longer while request threads wait
+        adapt = connection.ops.adapt_datetimefield_value
+        rows = [(adapt(event[0]),) + event[1:] for event in events]
+        with transaction.atomic():
+            with connection.cursor() as cursor:
+                cursor.executemany(INSERT_SQL, rows)
+        self.counters['written'] += len(events)
+        self.counters['batches'] += 1
+
+    def _flush(self, batch):
+        if not batch:
+            return
+        try:
+            self._write(batch)
+        except Exception:
+            self.counters['write_errors'] += 1
+            logger.exception('Failed to write %d audit events', len(batch))
+
+    def _drain(self):
+        batch = []
+        while len(batch) < self.config['BATCH_SIZE']:
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        # Sleep until the interval elapses or record() signals a full batch;
+        # waking per event would make every request hand over the GIL
+        while not self._stopping.is_set():
+            self._wake.wait(self.config['FLUSH_INTERVAL'])
+            self._wake.clear()
+            while True:
+                batch = self._drain()
+                self._flush(batch)
+                if len(batch) < self.config['BATCH_SIZE']:
+                    break
+        while True:
+            batch = self._drain()
+            if not batch:
+                break
+            self._flush(batch)
+        connection.close()
+
+    def shutdown(self, timeout=10):
+        """Flush everything queued so far and stop the writer."""
+        if self._pid != os.getpid() or self._thread is None:
+            return
+        self._stopping.set()
+        self._wake.set()
+        self._thread.join(timeout)
+        self._pid = None
+
+    def snapshot(self):
+        return dict(self.counters, queued=self.queue.qsize(), lag=self.lag())
+
+    def lag(self):
+        """Age in seconds of the oldest event still waiting to be written."""
+        try:
+            oldest = self.queue.queue[0][0]
+        except IndexError:
+            return 0.0
+        return round(max(0.0, time.time() - oldest.timestamp()), 3)
+
+
+writer = AuditWriter()
+atexit.register(writer.shutdown)
+
+
+def client_label(request):
+    user = getattr(request, 'user', None)
+    if user is not None and user.is_authenticated:
+        return f'user:{user.get_username()}'
+    return request.META.get('HTTP_X_CLIENT_ID') or 'anonymous'
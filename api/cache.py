@@ -0,0 +1,301 @@
+"""
+Dossier cache with request coalescing and stale-while-revalidate.
+
+Entries are stored as ``(fresh_until, dossier)`` and kept in the cache for
+``TTL + STALE_TTL`` seconds. A fresh entry is served as is; an expired one
+is still served while a single background refresh rebuilds it; a miss is
+computed once per key no matter how many requests are waiting for it.
+With ``CROSS_PROCESS_LOCK`` a cache-level lock extends that guarantee to
+all workers sharing the cache backend.
+
+Keys carry ``SCHEMA_VERSION`` and a generation number stored in the cache
+itself, so a shared backend (file, /dev/shm, memcached, redis; see
+``SHARED_CACHE_BACKEND`` in settings) never serves entries written by a
+deploy with a different dossier shape, and ``invalidate()`` drops every
+dossier by bumping one counter. Old entries simply expire.
+"""
+import logging
+import os
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connections
+from rest_framework.renderers import JSONRenderer
+
+from . import dossier, sqljson
+from .singleflight import SingleFlight, AsyncSingleFlight
+from .stats import hottest_plates
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    'ALIAS': 'dossiers',
+    'TTL': 30,
+    'STALE_TTL': 300,
+    'CROSS_PROCESS_LOCK': False,
+    'LOCK_TIMEOUT': 5.0,
+    'PREWARM_TOP_K': 0,
+    'GENERATION_CHECK': 1.0,
+}
+
+# Bump when the dossier layout changes
+SCHEMA_VERSION = 1
+GENERATION_KEY = f'dossier:v{SCHEMA_VERSION}:generation'
+
+flights = SingleFlight()
+async_flights = AsyncSingleFlight()
+_refresher = ThreadPoolExecutor(max_workers=2, thread_name_prefix='dossier-refresh')
+_refreshing = set()
+_refreshing_lock = threading.Lock()
+_stats = Counter()
+_generation = (None, 0.0)
+
+
+def get_config():
+    config = dict(DEFAULTS)
+    config.update(getattr(settings, 'DOSSIER_CACHE', {}))
+    return config
+
+
+def generation(config=None):
+    """
+    Current key generation, shared by all workers through the cache.
+
+    Re-read at most every ``GENERATION_CHECK`` seconds per process. A
+    missing counter (first start, eviction) gets a time-based value, so it
+    never comes back as a generation that was already used.
+    """
+    global _generation
+    value, checked_at = _generation
+    if value is not None and time.monotonic() - checked_at < (config or get_config())['GENERATION_CHECK']:
+        return value
+    cache = caches[(config or get_config())['ALIAS']]
+    value = cache.get(GENERATION_KEY)
+    if value is None:
+        cache.add(GENERATION_KEY, time.time_ns(), None)
+        value = cache.get(GENERATION_KEY)
+    _generation = (value, time.monotonic())
+    return value
+
+
+def invalidate():
+    """Drop every cached dossier in all workers: O(1), whatever the cache size."""
+    cache = caches[get_config()['ALIAS']]
+    try:
+        cache.incr(GENERATION_KEY)
+    except ValueError:
+        cache.set(GENERATION_KEY, time.time_ns(), None)
+    global _generation
+    _generation = (None, 0.0)
+    _stats['invalidations'] += 1
+
+
+def make_key(plate_norm, sections, accidents_limit, variant=None, config=None):
+    key = (f"dossier:v{SCHEMA_VERSION}:{generation(config)}:"
+           f"{plate_norm}:{','.join(sorted(sections))}:{accidents_limit}")
+    return f"{key}:{variant}" if variant else key
+
+
+def _store(cache, key, value, config):
+    if value is None:
+        cache.delete(key)
+    else:
+        cache.set(key, (time.time() + config['TTL'], value), config['TTL'] + config['STALE_TTL'])
+
+
+def _load(cache, key, loader, config):
+    if not config['CROSS_PROCESS_LOCK']:
+        value = loader()
+        _store(cache, key, value, config)
+        return value
+
+    lock_key = f'{key}:lock'
+    if cache.add(lock_key, 1, config['LOCK_TIMEOUT']):
+        try:
+            value = loader()
+            _store(cache, key, value, config)
+            return value
+        finally:
+            cache.delete(lock_key)
+
+    # Another worker holds the lock: wait for its result instead of
+    # repeating the queries, but never longer than the lock itself lives
+    _stats['lock_waits'] += 1
+    deadline = time.monotonic() + config['LOCK_TIMEOUT']
+    while time.monotonic() < deadline:
+        time.sleep(0.02)
+        entry = cache.get(key)
+        if entry is not None:
+            return entry[1]
+        if cache.get(lock_key) is None:
+            break
+    value = loader()
+    _store(cache, key, value, config)
+    return value
+
+
+def _refresh(cache, key, loader, config):
+    lock_key = f'{key}:lock'
+    try:
+        if config['CROSS_PROCESS_LOCK'] and not cache.add(lock_key, 1, config['LOCK_TIMEOUT']):
+            return
+        try:
+            _store(cache, key, loader(), config)
+            _stats['refreshes'] += 1
+        finally:
+            if config['CROSS_PROCESS_LOCK']:
+                cache.delete(lock_key)
+    except Exception:
+        logger.exception('Background refresh of %s failed', key)
+    finally:
+        with _refreshing_lock:
+            _refreshing.discard(key)
+        connections.close_all()
+
+
+def _revalidate(cache, key, loader, config):
+    with _refreshing_lock:
+        if key in _refreshing:
+            return
+        _refreshing.add(key)
+    _refresher.submit(_refresh, cache, key, loader, config)
+
+
+def get_dossier(plate_norm, sections, accidents_limit, loader, variant=None):
+    """
+    Return the cached dossier, or ``loader()``'s result (None = not found).
+
+    ``loader`` runs at most once per key at a time in this process.
+    ``variant`` keeps other representations of the same dossier (e.g. the
+    SQL-built JSON text) under their own keys.
+    """
+    config = get_config()
+    if not config['TTL']:
+        return loader()
+
+    cache = caches[config['ALIAS']]
+    key = make_key(plate_norm, sections, accidents_limit, variant, config)
+    entry = cache.get(key)
+    if entry is not None:
+        fresh_until, value = entry
+        if time.time() < fresh_until:
+            _stats['hits'] += 1
+        else:
+            _stats['stale'] += 1
+            _revalidate(cache, key, loader, config)
+        return value
+
+    _stats['misses'] += 1
+    if flights.in_flight(key):
+        _stats['coalesced'] += 1
+    return flights.do(key, lambda: _load(cache, key, loader, config))
+
+
+def peek(plate_norm, sections, accidents_limit, variant=None):
+    """Cached dossier however stale, without touching the database; None if absent."""
+    config = get_config()
+    if not config['TTL']:
+        return None
+    entry = caches[config['ALIAS']].get(make_key(plate_norm, sections, accidents_limit, variant, config))
+    if entry is None:
+        return None
+    _stats['served_on_db_failure'] += 1
+    return entry[1]
+
+
+async def aget_dossier(plate_norm, sections, accidents_limit, loader, variant=None):
+    """``get_dossier`` for asyncio callers; concurrent tasks share one lookup."""
+    # Coalescing key only, the generation is resolved inside get_dossier
+    key = f"{plate_norm}:{','.join(sorted(sections))}:{accidents_limit}:{variant}"
+    return await async_flights.do(
+        key, sync_to_async(lambda: get_dossier(plate_norm, sections, accidents_limit, loader, variant))
+    )
+
+
+def stats():
+    return dict(_stats, **flights.stats())
+
+
+def _warm_marker(config):
+    return f'dossier:v{SCHEMA_VERSION}:{generation(config)}:warmed'
+
+
+def is_warm():
+    """Whether the current key generation has been pre-warmed (by a worker or ``warm_dossier_cache``)."""
+    config = get_config()
+    return bool(config['TTL']) and caches[config['ALIAS']].get(_warm_marker(config)) is not None
+
+
+def warm(plate_numbers, batch_size=500):
+    """
+    Preload full dossiers for ``plate_numbers``; returns how many were cached.
+
+    JSON clients on the SQL JSON path read their own key variant; it is
+    filled with the same dossier rendered once here.
+    """
+    config = get_config()
+    cache = caches[config['ALIAS']]
+    sections = frozenset(dossier.SECTIONS)
+    plate_numbers = list(plate_numbers)
+    warmed = 0
+    for start in range(0, len(plate_numbers), batch_size):
+        plates = list(dossier.find_active_plates(plate_numbers[start:start + batch_size], sections).values())
+        entries = {}
+        for plate, value in zip(plates, dossier.build_dossiers(plates, sections)):
+            entries[make_key(plate.plate_number, sections, dossier.DEFAULT_ACCIDENTS, config=config)] = value
+            if sqljson.supported(plate.plate_number):
+                key = make_key(plate.plate_number, sections, dossier.DEFAULT_ACCIDENTS, 'sql-json', config)
+                entries[key] = JSONRenderer().render(value).decode()
+        cache.set_many(
+            {key: (time.time() + config['TTL'], value) for key, value in entries.items()},
+            config['TTL'] + config['STALE_TTL'],
+        )
+        warmed += len(plates)
+    cache.set(_warm_marker(config), os.getpid(), config['TTL'] + config['STALE_TTL'])
+    return warmed
+
+
+def prewarm_on_startup():
+    """
+    Startup hook for the WSGI/ASGI entry points: warm the cache with the
+    ``PREWARM_TOP_K`` most looked-up plates before serving traffic.
+
+    With a shared backend only the first worker to start does the work;
+    the others (and restarts within the entries' lifetime) find the
+    marker left by it or by ``manage.py warm_dossier_cache``. If the warm
+    fails the marker is removed, so the next worker to start tries again.
+    """
+    config = get_config()
+    limit = config['PREWARM_TOP_K']
+    if not limit or not config['TTL']:
+        return 0
+    cache = caches[config['ALIAS']]
+    claimed = None
+    try:
+        # The marker doubles as a claim so workers starting together do not
+        # all warm; a failed warm gives it back for the next worker to retry
+        marker = _warm_marker(config)
+        if not cache.add(marker, os.getpid(), config['TTL'] + config['STALE_TTL']):
+            logger.info('Dossier cache already warm, skipping pre-warm')
+            return 0
+        claimed = marker
+        warmed = warm(hottest_plates(limit))
+        logger.info('Pre-warmed %d dossiers', warmed)
+        return warmed
+    except Exception:
+        logger.exception('Dossier cache pre-warm failed')
+        if claimed is not None:
+            try:
+                cache.delete(claimed)
+            except Exception:
+                logger.exception('Could not release the pre-warm marker')
+        return 0
+    finally:
+        # The app may be preloaded before workers fork; never hand them
+        # an inherited connection
+        connections.close_all()
@@ -0,0 +1,319 @@
+"""
+Statement deadlines and circuit breakers for database access.
+
+Views listed in ``DB_GUARD['VIEWS']`` run with a deadline (the view's
+budget, or the client's ``X-Request-Timeout`` if shorter). Every statement
+they issue is cut off when the deadline passes: SQLite through a progress
+handler that interrupts the running statement, PostgreSQL through
+``statement_timeout`` set on the connection. The progress handler does not
+run while SQLite waits for a lock, so that wait is bounded by
+``busy_timeout``, lowered to the time left for the duration of the
+statement. A cut-off statement raises ``StatementTimeout``.
+
+The same execute wrapper feeds a circuit breaker per database alias with
+the outcome and latency of each guarded statement. Only operational and
+connection errors count as failures; a statement cut off by its own
+deadline is a ``deadline_hit`` (still slow if it ran ``SLOW_CALL`` or
+longer), so clients with short timeouts cannot open the breaker for
+everyone. When the error rate or the share of slow statements over the
+last ``WINDOW`` seconds crosses its threshold the breaker opens, and guarded statements on that alias fail at
+once with ``CircuitOpen`` instead of queueing behind a struggling
+database. After ``OPEN_FOR`` seconds a few trial statements are let
+through; if they succeed the breaker closes again.
+
+Management commands, the admin and background writers are not guarded.
+"""
+import contextvars
+import math
+import threading
+import time
+from collections import Counter, deque
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db.utils import InterfaceError, OperationalError
+
+from .admission import request_timeout
+
+DEFAULTS = {
+    'ENABLED': True,
+    'VIEWS': {},
+    'SQLITE_PROGRESS_OPS': 1000,
+    'BREAKER': {
+        'WINDOW': 10.0,
+        'MIN_CALLS': 20,
+        'ERROR_RATE': 0.5,
+        'SLOW_CALL': 0.25,
+        'SLOW_RATE': 0.8,
+        'OPEN_FOR': 5.0,
+        'HALF_OPEN_CALLS': 3,
+    },
+}
+
+# Python's sqlite3 default for the ``timeout`` connection option (seconds)
+SQLITE_TIMEOUT = 5.0
+
+_deadline = contextvars.ContextVar('statement_deadline', default=None)
+
+
+class DatabaseUnavailable(OperationalError):
+    retry_after = 1.0
+
+
+class StatementTimeout(DatabaseUnavailable):
+    pass
+
+
+class CircuitOpen(DatabaseUnavailable):
+    def __init__(self, alias, retry_after):
+        super().__init__(f'circuit breaker for {alias!r} is open')
+        self.retry_after = retry_after
+
+
+def get_config():
+    config = dict(DEFAULTS)
+    config.update(getattr(settings, 'DB_GUARD', {}))
+    config['BREAKER'] = dict(DEFAULTS['BREAKER'], **config['BREAKER'])
+    return config
+
+
+class CircuitBreaker:
+    """Closed -> open -> half-open state machine over a sliding window of per-second buckets."""
+
+    def __init__(self, alias, window, min_calls, error_rate, slow_call, slow_rate, open_for, half_open_calls):
+        self.alias = alias
+        self.window = window
+        self.min_calls = min_calls
+        self.error_rate = error_rate
+        self.slow_call = slow_call
+        self.slow_rate = slow_rate
+        self.open_for = open_for
+        self.half_open_calls = half_open_calls
+        self.state = 'closed'
+        self.opened_at = 0.0
+        self.trials = 0
+        self.successes = 0
+        self.buckets = deque()  # [second, calls, failures, slow]
+        self.counters = Counter()
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """Return 0 if a statement may run, else seconds until the next trial."""
+        with self._lock:
+            now = time.monotonic()
+            if self.state == 'open':
+                remaining = self.opened_at + self.open_for - now
+                if remaining > 0:
+                    self.counters['rejected'] += 1
+                    return remaining
+                self.state = 'half_open'
+                self.trials = self.successes = 0
+            if self.state == 'half_open':
+                if self.trials >= self.half_open_calls:
+                    self.counters['rejected'] += 1
+                    return self.open_for
+                self.trials += 1
+            return 0
+
+    def record(self, elapsed, failed, timed_out=False):
+        with self._lock:
+            now = time.monotonic()
+            if failed:
+                self.counters['failures'] += 1
+            if timed_out:
+                self.counters['deadline_hits'] += 1
+            if self.state == 'half_open':
+                if timed_out:
+                    self.trials -= 1  # says nothing either way: let another trial run
+                elif failed:
+                    self._open(now)
+                else:
+                    self.successes += 1
+                    if self.successes >= self.half_open_calls:
+                        self.state = 'closed'
+                        self.buckets.clear()
+                        self.counters['closed'] += 1
+                return
+            if self.state == 'open':
+                return  # a statement that started before the breaker opened
+
+            second = int(now)
+            if not self.buckets or self.buckets[-1][0] != second:
+                self.buckets.append([second, 0, 0, 0])
+            bucket = self.buckets[-1]
+            bucket[1] += 1
+            bucket[2] += failed
+            bucket[3] += elapsed >= self.slow_call
+            while self.buckets and self.buckets[0][0] <= now - self.window:
+                self.buckets.popleft()
+
+            calls = sum(b[1] for b in self.buckets)
+            if calls < self.min_calls:
+                return
+            if (sum(b[2] for b in self.buckets) >= self.error_rate * calls
+                    or sum(b[3] for b in self.buckets) >= self.slow_rate * calls):
+                self._open(now)
+
+    def _open(self, now):
+        self.state = 'open'
+        self.opened_at = now
+        self.buckets.clear()
+        self.counters['opened'] += 1
+
+    def snapshot(self):
+        with self._lock:
+            result = {'state': self.state, **self.counters}
+            if self.state == 'open':
+                result['retry_after'] = round(max(0.0, self.opened_at + self.open_for - time.monotonic()), 3)
+            return result
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+_counters = Counter()
+
+
+def get_breaker(alias, config=None):
+    breaker = _breakers.get(alias)
+    if breaker is None:
+        with _breakers_lock:
+            breaker = _breakers.get(alias)
+            if breaker is None:
+                options = (config or get_config())['BREAKER']
+                breaker = _breakers[alias] = CircuitBreaker(
+                    alias,
+                    options['WINDOW'],
+                    options['MIN_CALLS'],
+                    options['ERROR_RATE'],
+                    options['SLOW_CALL'],
+                    options['SLOW_RATE'],
+                    options['OPEN_FOR'],
+                    options['HALF_OPEN_CALLS'],
+                )
+    return breaker
+
+
+def snapshot():
+    """Breaker state per alias plus timeout counters, for this process."""
+    return {
+        'breakers': {alias: breaker.snapshot() for alias, breaker in list(_breakers.items())},
+        **_counters,
+    }
+
+
+def open_breakers():
+    return [alias for alias, breaker in list(_breakers.items()) if breaker.state == 'open']
+
+
+@contextmanager
+def deadline(seconds):
+    """Guard the statements issued inside the block, as in a listed view."""
+    token = _deadline.set(time.monotonic() + seconds)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def _set_postgresql_timeout(connection, deadline, remaining):
+    # One SET per connection and request; later statements in the same
+    # request are bounded by the first one's remaining time
+    if getattr(connection, '_guard_deadline', None) == deadline:
+        return
+    with connection.connection.cursor() as cursor:
+        cursor.execute('SET statement_timeout = %s', [0 if deadline is None else max(1, int(remaining * 1000))])
+    connection._guard_deadline = deadline
+
+
+def _set_sqlite_busy_timeout(connection, deadline, remaining):
+    # A PRAGMA that touches no page: cheap enough to run per statement, so
+    # every one gets exactly the time left
+    configured = math.ceil(connection.settings_dict['OPTIONS'].get('timeout', SQLITE_TIMEOUT) * 1000)
+    milliseconds = configured if deadline is None else min(configured, max(1, math.ceil(remaining * 1000)))
+    connection.connection.execute(f'PRAGMA busy_timeout = {milliseconds}')
+    connection._guard_deadline = deadline
+
+
+def guard_statement(execute, sql, params, many, context):
+    """Execute wrapper installed on every connection (see ``ApiConfig.ready``)."""
+    deadline = _deadline.get()
+    connection = context['connection']
+    if deadline is None:
+        if getattr(connection, '_guard_deadline', None) is not None:
+            if connection.vendor == 'sqlite':
+                _set_sqlite_busy_timeout(connection, None, 0)
+            else:
+                _set_postgresql_timeout(connection, None, 0)
+        return execute(sql, params, many, context)
+
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        _counters['timeouts'] += 1
+        raise StatementTimeout('request deadline exceeded')
+    config = get_config()
+    breaker = get_breaker(connection.alias, config)
+    retry_after = breaker.allow()
+    if retry_after:
+        raise CircuitOpen(connection.alias, retry_after)
+
+    if connection.vendor == 'sqlite':
+        _set_sqlite_busy_timeout(connection, deadline, remaining)
+        connection.connection.set_progress_handler(lambda: time.monotonic() > deadline, config['SQLITE_PROGRESS_OPS'])
+    elif connection.vendor == 'postgresql':
+        _set_postgresql_timeout(connection, deadline, remaining)
+    started = time.monotonic()
+    try:
+        result = execute(sql, params, many, context)
+    except (OperationalError, InterfaceError) as e:
+        # Our own cut-off surfaces as an OperationalError too ("interrupted",
+        # "canceling statement due to statement timeout"): not a failure
+        timed_out = isinstance(e, OperationalError) and time.monotonic() >= deadline
+        breaker.record(time.monotonic() - started, not timed_out, timed_out)
+        if timed_out:
+            _counters['timeouts'] += 1
+            raise StatementTimeout(f'statement exceeded the request deadline: {e}') from e
+        raise
+    except Exception:
+        # Integrity and programming errors say nothing about database health
+        breaker.record(time.monotonic() - started, False)
+        raise
+    finally:
+        if connection.vendor == 'sqlite':
+            connection.connection.set_progress_handler(None, 0)
+    breaker.record(time.monotonic() - started, False)
+    return result
+
+
+def install(sender, connection, **kwargs):
+    """``connection_created`` handler: guard every statement on the connection."""
+    connection._guard_deadline = None
+    if guard_statement not in connection.execute_wrappers:
+        connection.execute_wrappers.append(guard_statement)
+
+
+class StatementDeadlineMiddleware:
+    """Runs the views listed in ``DB_GUARD['VIEWS']`` under a statement deadline."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        try:
+            return self.get_response(request)
+        finally:
+            token = getattr(request, '_statement_deadline', None)
+            if token is not None:
+                _deadline.reset(token)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        config = get_config()
+        match = request.resolver_match
+        name = match.url_name if match else None
+        if not config['ENABLED'] or not config['VIEWS'].get(name):
+            return None
+        timeout = config['VIEWS'][name]
+        client_timeout = request_timeout(request)
+        if client_timeout is not None:
+            timeout = min(timeout, client_timeout)
+        request._statement_deadline = _deadline.set(time.monotonic() + timeout)
+        return None
@@ -0,0 +1,269 @@
+"""
+Dossier assembly for ``check_plate``.
+
+A dossier is split into sections; only the requested sections are fetched,
+so a caller asking for ``vehicle,insurance`` never pays for the owner,
+license or accident queries. Every fetcher works on a batch of plates and
+issues one query per section (per shard) regardless of batch size.
+Owners with their latest license and insurer names come from the
+fragment cache (``api.fragments``), so only vehicle-specific rows are
+queried on a warm cache.
+"""
+from django.db.models import F, Window
+from django.db.models.functions import RowNumber
+
+from . import fragments, parts, risk, shards
+from .models import Plate, Owner, DriverLicense, Insurer, InsurancePolicy, Accident, CarPart
+
+SECTIONS = ('vehicle', 'owner', 'driver_license', 'insurance', 'accidents', 'risk')
+DEFAULT_ACCIDENTS = 10
+MAX_ACCIDENTS = 100
+
+
+def _split(value):
+    if isinstance(value, (list, tuple)):
+        return [str(item).strip() for item in value if str(item).strip()]
+    return [item.strip() for item in value.split(',') if item.strip()]
+
+
+def parse_params(params):
+    """
+    Read ``fields``, ``exclude`` and ``accidents`` from query params.
+
+    Returns ``(sections, accidents_limit)``; raises ValueError with a
+    client-facing message on bad input.
+    """
+    sections = set(SECTIONS)
+    if params.get('fields'):
+        sections = set(_split(params['fields']))
+    excluded = set(_split(params.get('exclude', '')))
+    unknown = (sections | excluded) - set(SECTIONS)
+    if unknown:
+        raise ValueError(f"unknown fields: {', '.join(sorted(unknown))}")
+    sections -= excluded
+
+    limit = params.get('accidents', DEFAULT_ACCIDENTS)
+    try:
+        limit = int(limit)
+    except (TypeError, ValueError):
+        raise ValueError("accidents must be an integer")
+    if not 0 <= limit <= MAX_ACCIDENTS:
+        raise ValueError(f"accidents must be between 0 and {MAX_ACCIDENTS}")
+    if limit == 0:
+        sections.discard('accidents')
+    return frozenset(sections), limit
+
+
+def active_plates(sections, using=None):
+    """Queryset of active plates joined with only what ``sections`` need."""
+    queryset = Plate.objects.using(using or shards.default_shard()).filter(released_at__isnull=True)
+    if sections & {'vehicle', 'owner', 'driver_license'}:
+        return queryset.select_related('vehicle')
+    return queryset
+
+
+def find_active_plate(plate_norm, sections):
+    using = shards.alias_for_plate(plate_norm)
+    return active_plates(sections, using).filter(plate_number=plate_norm).first()
+
+
+def find_active_plates(plate_norms, sections):
+    """Active plates for a batch of normalized numbers, as {plate_number: plate}."""
+    groups = shards.group_by_alias(plate_norms)
+    found = shards.fan_out(
+        lambda alias: list(active_plates(sections, alias).filter(plate_number__in=groups[alias])),
+        groups,
+    )
+    return {plate.plate_number: plate for plates in found.values() for plate in plates}
+
+
+def owner_data(owner):
+    if owner is None:
+        return None
+    return {
+        'owner_id': owner.owner_id,
+        'full_name': owner.full_name,
+        'iin': owner.iin,
+        'dob': owner.dob,
+        'phone': owner.phone
+    }
+
+
+def vehicle_data(vehicle):
+    return {
+        'vehicle_id': vehicle.vehicle_id,
+        'vin': vehicle.vin,
+        'make': vehicle.make,
+        'model': vehicle.model,
+        'year': vehicle.year,
+        'color': vehicle.color
+    }
+
+
+def license_data(license):
+    return {
+        'license_id': license.license_id,
+        'number': license.number,
+        'categories': license.categories,
+        'issued_at': license.issued_at,
+        'expires_at': license.expires_at,
+        'status': license.status
+    }
+
+
+def policy_data(policy, insurers):
+    return {
+        'policy_number': policy.policy_number,
+        'type': policy.type,
+        'insurer': insurers.get(policy.insurer_id),
+        'valid_from': policy.valid_from,
+        'valid_to': policy.valid_to,
+        'status': policy.status
+    }
+
+
+def part_data(part):
+    return {
+        'part_id': part.part_id,
+        'name': part.name,
+        'category': part.category,
+        'description': part.description
+    }
+
+
+def accident_data(accident, catalog):
+    return {
+        'accident_id': accident.accident_id,
+        'date': accident.date,
+        'severity': accident.severity,
+        'location': accident.location,
+        'description': accident.description,
+        'fault_party': accident.fault_party,
+        'damaged_parts': [part_data(part) for part in catalog.decode(accident.damaged_parts_mask)]
+    }
+
+
+def latest_licenses(owner_ids, using):
+    """Latest (by ``expires_at``) license per owner, as {owner_id: data}."""
+    result = {}
+    if not owner_ids:
+        return result
+    licenses = DriverLicense.objects.using(using).filter(owner_id__in=owner_ids).order_by('owner_id', '-expires_at', '-license_id')
+    for license in licenses:
+        result.setdefault(license.owner_id, license_data(license))
+    return result
+
+
+def owner_fragments(owner_ids, using, cached=True):
+    """Owner and latest license per owner, as {owner_id: {'owner': ..., 'driver_license': ...}}."""
+    def fetch(missing):
+        licenses = latest_licenses(missing, using)
+        return {
+            owner_id: {'owner': owner_data(owner), 'driver_license': licenses.get(owner_id)}
+            for owner_id, owner in Owner.objects.using(using).in_bulk(missing).items()
+        }
+    if not cached:
+        return fetch(set(owner_ids))
+    return fragments.read_through('owner', owner_ids, using, fetch)
+
+
+def insurer_names(insurer_ids, using, cached=True):
+    def fetch(missing):
+        return dict(Insurer.objects.using(using).filter(pk__in=missing).values_list('pk', 'name'))
+    if not cached:
+        return fetch(set(insurer_ids)) if insurer_ids else {}
+    return fragments.read_through('insurer', insurer_ids, using, fetch)
+
+
+def policies_by_vehicle(vehicle_ids, using, cached=True):
+    result = {vehicle_id: [] for vehicle_id in vehicle_ids}
+    policies = list(
+        InsurancePolicy.objects.using(using).filter(vehicle_id__in=vehicle_ids)
+        .order_by('vehicle_id', 'policy_id')
+    )
+    insurers = insurer_names({policy.insurer_id for policy in policies if policy.insurer_id}, using, cached)
+    for policy in policies:
+        result[policy.vehicle_id].append(policy_data(policy, insurers))
+    return result
+
+
+def accidents_by_vehicle(vehicle_ids, limit, using, cached=True):
+    """Last ``limit`` accidents per vehicle, damaged parts decoded from the mask."""
+    result = {vehicle_id: [] for vehicle_id in vehicle_ids}
+    if not vehicle_ids or not limit:
+        return result
+    queryset = Accident.objects.using(using).filter(vehicle_id__in=vehicle_ids)
+    if len(vehicle_ids) == 1:
+        accidents = queryset.order_by('-date', '-accident_id')[:limit]
+    else:
+        accidents = queryset.annotate(
+            row=Window(
+                RowNumber(),
+                partition_by=[F('vehicle_id')],
+                order_by=[F('date').desc(), F('accident_id').desc()],
+            )
+        ).filter(row__lte=limit).order_by('vehicle_id', '-date', '-accident_id')
+    catalog = parts.catalog(using) if cached else parts.Catalog(CarPart.objects.using(using).all())
+    for accident in accidents:
+        result[accident.vehicle_id].append(accident_data(accident, catalog))
+    return result
+
+
+def _fetch_sections(plates, sections, accidents_limit, using, cached=True):
+    vehicle_ids = [plate.vehicle_id for plate in plates]
+    owners = policies = accidents = summaries = {}
+    if sections & {'owner', 'driver_license'}:
+        owners = owner_fragments({plate.vehicle.owner_id for plate in plates if plate.vehicle.owner_id}, using, cached)
+    if 'insurance' in sections:
+        policies = policies_by_vehicle(vehicle_ids, using, cached)
+    if 'accidents' in sections:
+        accidents = accidents_by_vehicle(vehicle_ids, accidents_limit, using, cached)
+    if 'risk' in sections:
+        summaries = risk.summaries_by_vehicle(vehicle_ids, using)
+    return owners, policies, accidents, summaries
+
+
+def build_dossiers(plates, sections, accidents_limit=DEFAULT_ACCIDENTS, cached=True):
+    """
+    Assemble dossiers for ``plates`` (from ``active_plates(sections)``).
+
+    Returns dossiers in the same order as ``plates``. ``cached=False``
+    reads owners, insurers and the part catalog from the database instead
+    of the process and fragment caches.
+    """
+    plates = list(plates)
+    by_alias = {}
+    for plate in plates:
+        by_alias.setdefault(plate._state.db, []).append(plate)
+    fetched = {
+        alias: _fetch_sections(group, sections, accidents_limit, alias, cached)
+        for alias, group in by_alias.items()
+    }
+
+    dossiers = []
+    for plate in plates:
+        owners, policies, accidents, summaries = fetched[plate._state.db]
+        owner = owners.get(plate.vehicle.owner_id) if owners else None
+        dossier = {'plate': plate.plate_number}
+        if 'vehicle' in sections:
+            dossier['vehicle'] = vehicle_data(plate.vehicle)
+        if 'owner' in sections:
+            dossier['owner'] = owner and owner['owner']
+        if 'driver_license' in sections:
+            dossier['driver_license'] = owner and owner['driver_license']
+        if 'insurance' in sections:
+            dossier['insurance'] = policies[plate.vehicle_id]
+        if 'accidents' in sections:
+            dossier['accidents'] = accidents[plate.vehicle_id]
+        if 'risk' in sections:
+            dossier['risk'] = summaries[plate.vehicle_id]
+        dossiers.append(dossier)
+    return dossiers
+
+
+def load_dossier(plate_norm, sections, accidents_limit=DEFAULT_ACCIDENTS):
+    """Dossier for an active plate, or None if the plate is not registered."""
+    plate = find_active_plate(plate_norm, sections)
+    if plate is None:
+        return None
+    return build_dossiers([plate], sections, accidents_limit)[0]
@@ -0,0 +1,174 @@
+"""
+Full-dossier export for partners (``/api/export/dossiers/``, ``manage.py export_dossiers``).
+
+Active plates are read in keyset chunks (``plate_id > last seen``, per
+shard) and each chunk is assembled with ``dossier.build_dossiers``, so a
+chunk costs one query per section however large the registry is. Output
+is NDJSON, one dossier per line, compressed on the fly with gzip or zstd
+(``zstandard`` package) and flushed after every chunk; memory stays flat
+and an interrupted download decodes up to its last complete chunk.
+
+After each chunk comes a checkpoint line ``{"cursor": "..."}``; passing
+that cursor back resumes after the chunk. The last line also carries
+``"complete": true``. Cursors are ``{alias: last plate_id}``, encoded as in
+search.
+
+``since`` limits the export to plates issued at or after it, or whose
+vehicle's risk summary (accidents, policies; see ``api.risk``) changed
+since then. Edits to vehicle, owner or license rows carry no timestamp
+and are not picked up.
+"""
+import datetime
+import zlib
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+
+from . import dossier, kzplates, shards
+from .renderers import NDJSONRenderer
+from .search import decode_cursor, encode_cursor
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+DEFAULTS = {
+    'CHUNK_SIZE': 1000,
+    'GZIP_LEVEL': 6,
+    'ZSTD_LEVEL': 3,
+}
+
+_ndjson = NDJSONRenderer()
+
+
+def get_config():
+    config = dict(DEFAULTS)
+    config.update(getattr(settings, 'DOSSIER_EXPORT', {}))
+    return config
+
+
+class Gzip:
+    media_type = 'application/gzip'
+    suffix = '.gz'
+
+    def __init__(self, config):
+        self._compressor = zlib.compressobj(config['GZIP_LEVEL'], zlib.DEFLATED, 31)
+
+    def compress(self, data):
+        return self._compressor.compress(data) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self, data):
+        return self._compressor.compress(data) + self._compressor.flush()
+
+
+class Zstd:
+    media_type = 'application/zstd'
+    suffix = '.zst'
+
+    def __init__(self, config):
+        self._compressor = zstandard.ZstdCompressor(level=config['ZSTD_LEVEL']).compressobj()
+
+    def compress(self, data):
+        return self._compressor.compress(data) + self._compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+
+    def finish(self, data):
+        return self._compressor.compress(data) + self._compressor.flush()
+
+
+class Identity:
+    media_type = NDJSONRenderer.media_type
+    suffix = ''
+
+    def __init__(self, config):
+        pass
+
+    def compress(self, data):
+        return data
+
+    finish = compress
+
+
+COMPRESSORS = {'gzip': Gzip, 'zstd': Zstd, 'none': Identity}
+
+
+def available_compressions():
+    return [name for name in COMPRESSORS if name != 'zstd' or zstandard is not None]
+
+
+def parse_since(value):
+    """Aware datetime from an ISO date or datetime; raises ValueError."""
+    value = value.strip()
+    parsed = parse_datetime(value)
+    if parsed is None:
+        day = parse_date(value)
+        if day is None:
+            raise ValueError('since must be an ISO date or datetime')
+        parsed = datetime.datetime.combine(day, datetime.time())
+    if timezone.is_naive(parsed):
+        parsed = timezone.make_aware(parsed)
+    return parsed
+
+
+def parse_params(params):
+    """
+    Read export query params; returns a dict of ``stream`` keyword arguments.
+
+    Raises ValueError with a client-facing message on bad input.
+    """
+    sections, accidents_limit = dossier.parse_params(params)
+    compression = params.get('compression') or 'gzip'
+    if compression not in available_compressions():
+        raise ValueError(f"compression must be one of: {', '.join(available_compressions())}")
+    region = (params.get('region') or '').strip() or None
+    if region is not None and region not in kzplates.REGIONS:
+        raise ValueError('region must be a region code from 01 to 20')
+    return {
+        'sections': sections,
+        'accidents_limit': accidents_limit,
+        'region': region,
+        'since': parse_since(params['since']) if params.get('since') else None,
+        'cursor': decode_cursor(params.get('cursor')),
+        'compression': compression,
+    }
+
+
+def plate_chunks(sections, region=None, since=None, cursor=None, chunk_size=None):
+    """``(alias, plates)`` chunks of active plates, shard by shard in ``plate_id`` order."""
+    chunk_size = chunk_size or get_config()['CHUNK_SIZE']
+    cursor = cursor or {}
+    for alias in [shards.alias_for_region(region)] if region else shards.aliases():
+        queryset = dossier.active_plates(sections, alias).order_by('plate_id')
+        if region:
+            queryset = queryset.filter(region=region)
+        if since is not None:
+            queryset = queryset.filter(Q(assigned_at__gte=since) | Q(vehicle__risk__updated_at__gte=since))
+        last = cursor.get(alias, 0)
+        while True:
+            plates = list(queryset.filter(plate_id__gt=last)[:chunk_size])
+            if not plates:
+                break
+            yield alias, plates
+            last = plates[-1].plate_id
+
+
+def stream(sections, accidents_limit=dossier.DEFAULT_ACCIDENTS, region=None, since=None, cursor=None,
+           compression='gzip', chunk_size=None, progress=None):
+    """
+    Compressed NDJSON export, as an iterator of byte strings.
+
+    ``progress(count, cursor)`` is called after each chunk.
+    """
+    compressor = COMPRESSORS[compression](get_config())
+    cursor = dict(cursor or {})
+    count = 0
+    for alias, plates in plate_chunks(sections, region, since, cursor, chunk_size):
+        cursor[alias] = plates[-1].plate_id
+        count += len(plates)
+        dossiers = dossier.build_dossiers(plates, sections, accidents_limit)
+        yield compressor.compress(_ndjson.render(dossiers + [{'cursor': encode_cursor(cursor)}]))
+        if progress is not None:
+            progress(count, cursor)
+    yield compressor.finish(_ndjson.render([{'cursor': encode_cursor(cursor), 'complete': True}]))
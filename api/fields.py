@@ -0,0 +1,29 @@
+from django.db import models
+
+
+class PartMaskField(models.BigIntegerField):
+    """
+    Set of car parts packed into one integer: bit ``CarPart.bit`` is set when
+    that part is in the set. Supports ``__has_any`` / ``__has_all`` lookups
+    taking a mask (see ``api.parts.mask_of``).
+    """
+
+
+@PartMaskField.register_lookup
+class HasAny(models.Lookup):
+    lookup_name = 'has_any'
+
+    def as_sql(self, compiler, connection):
+        lhs, lhs_params = self.process_lhs(compiler, connection)
+        rhs, rhs_params = self.process_rhs(compiler, connection)
+        return f'({lhs} & {rhs}) != 0', lhs_params + rhs_params
+
+
+@PartMaskField.register_lookup
+class HasAll(models.Lookup):
+    lookup_name = 'has_all'
+
+    def as_sql(self, compiler, connection):
+        lhs, lhs_params = self.process_lhs(compiler, connection)
+        rhs, rhs_params = self.process_rhs(compiler, connection)
+        return f'({lhs} & {rhs}) = {rhs}', lhs_params + rhs_params + rhs_params
@@ -0,0 +1,116 @@
+"""
+Entity-level read-through cache for dossier fragments.
+
+Many plates share the same owner (fleets) and every policy points at one
+of a handful of insurers, so those pieces are cached per entity rather
+than per plate: an owner with its latest driver license under
+``owner:v1:<alias>:<owner_id>`` and an insurer's name under
+``insurer:v1:<alias>:<insurer_id>``. A dossier then only queries what is
+specific to the vehicle; the hit ratio depends on the number of distinct
+owners, not plates. The ``CarPart`` catalog is kept in process memory by
+``api.parts``, which only stores its generation counter here.
+
+Writes through the ORM drop the affected key (signal handlers below);
+bulk updates bypass them and are covered by ``TTL``.
+"""
+from collections import Counter
+
+from django.conf import settings
+from django.core.cache import caches
+
+from .models import DriverLicense
+
+DEFAULTS = {
+    'ALIAS': 'fragments',
+    'TTL': 3600,
+    'CATALOG_CHECK': 1.0,
+}
+
+KINDS = ('owner', 'insurer')
+
+# Bump when a fragment's layout changes (the cache may outlive a deploy)
+SCHEMA_VERSION = 1
+
+_stats = Counter()
+
+
+def get_config():
+    config = dict(DEFAULTS)
+    config.update(getattr(settings, 'FRAGMENT_CACHE', {}))
+    return config
+
+
+def make_key(kind, using, pk):
+    return f'{kind}:v{SCHEMA_VERSION}:{using}:{pk}'
+
+
+def read_through(kind, ids, using, fetch):
+    """
+    ``{id: fragment}`` for ``ids`` on shard ``using``.
+
+    Misses are loaded with a single ``fetch(missing_ids)`` call, which
+    returns ``{id: fragment}`` for the ids it found, and cached.
+    """
+    ids = set(ids)
+    if not ids:
+        return {}
+    config = get_config()
+    if not config['TTL']:
+        return fetch(ids)
+
+    cache = caches[config['ALIAS']]
+    keys = {make_key(kind, using, pk): pk for pk in ids}
+    found = {keys[key]: value for key, value in cache.get_many(keys).items()}
+    _stats[f'{kind}_hits'] += len(found)
+    missing = ids - found.keys()
+    if missing:
+        _stats[f'{kind}_misses'] += len(missing)
+        loaded = fetch(missing)
+        cache.set_many({make_key(kind, using, pk): value for pk, value in loaded.items()}, config['TTL'])
+        found.update(loaded)
+    return found
+
+
+def invalidate(kind, using, *ids):
+    ids = [pk for pk in ids if pk is not None]
+    if ids:
+        caches[get_config()['ALIAS']].delete_many([make_key(kind, using, pk) for pk in ids])
+        _stats[f'{kind}_invalidations'] += len(ids)
+
+
+def stats():
+    result = {}
+    for kind in KINDS:
+        hits, misses = _stats[f'{kind}_hits'], _stats[f'{kind}_misses']
+        result[kind] = {
+            'hits': hits,
+            'misses': misses,
+            'invalidations': _stats[f'{kind}_invalidations'],
+            'hit_ratio': round(hits / (hits + misses), 4) if hits + misses else None,
+        }
+    return result
+
+
+def owner_changed(sender, instance, using, **kwargs):
+    """``post_save``/``post_delete`` handler for ``Owner``."""
+    invalidate('owner', using, instance.pk)
+
+
+def remember_license_owner(sender, instance, raw, using, **kwargs):
+    """``pre_save`` handler for ``DriverLicense``: an edit may move it to another owner."""
+    instance._fragment_owner_before = None
+    if not raw and not instance._state.adding:
+        instance._fragment_owner_before = (
+            DriverLicense.objects.using(using).filter(pk=instance.pk).values_list('owner_id', flat=True).first()
+        )
+
+
+def license_changed(sender, instance, using, **kwargs):
+    """``post_save``/``post_delete`` handler for ``DriverLicense``."""
+    before = instance.__dict__.pop('_fragment_owner_before', None)
+    invalidate('owner', using, *{instance.owner_id, before})
+
+
+def insurer_changed(sender, instance, using, **kwargs):
+    """``post_save``/``post_delete`` handler for ``Insurer``."""
+    invalidate('insurer', using, instance.pk)
@@ -0,0 +1,130 @@
+"""
+Liveness and readiness probes.
+
+Liveness is answered from memory: the process is up and serving requests.
+Readiness checks that every database alias answers ``SELECT 1`` within
+``DB_TIMEOUT`` seconds and has no unapplied migrations. The result is
+cached for ``CHECK_INTERVAL`` seconds per process and computed by one
+request at a time, so probes every second from every node cost one
+trivial statement per alias and interval. Nothing here reads the
+registry tables.
+
+Next to the verdict the report carries what an operator looks at when it
+is negative: connection age and ``CONN_MAX_AGE`` per alias, whether the
+dossier cache is warm, and how far behind the background lookup-counter
+and audit writers are. Those are informational and never fail the probe.
+"""
+import os
+import time
+
+from django.conf import settings
+from django.db import connections
+from django.db.migrations.executor import MigrationExecutor
+
+from . import audit, cache, dbguard, shards, stats
+from .singleflight import SingleFlight
+
+DEFAULTS = {
+    'CHECK_INTERVAL': 5.0,
+    'DB_TIMEOUT': 1.0,
+    'MIGRATIONS_INTERVAL': 60.0,
+    'STALE_AFTER': 60.0,
+}
+
+STARTED_AT = time.time()
+
+flights = SingleFlight()
+_report = (None, 0.0)
+_migrations = {}  # alias -> (pending, checked_at)
+
+
+def get_config():
+    config = dict(DEFAULTS)
+    config.update(getattr(settings, 'HEALTH_CHECKS', {}))
+    return config
+
+
+def track_connection(sender, connection, **kwargs):
+    """``connection_created`` handler: remember when the connection was opened."""
+    connection._opened_at = time.monotonic()
+
+
+def liveness():
+    return {'alive': True, 'pid': os.getpid(), 'uptime': round(time.time() - STARTED_AT, 3)}
+
+
+def _pending_migrations(connection, config):
+    pending, checked_at = _migrations.get(connection.alias, (None, 0.0))
+    # Loading the migration graph is the expensive part; a pending result
+    # is re-checked every probe so the node turns ready right after migrate
+    if pending or pending is None or time.monotonic() - checked_at >= config['MIGRATIONS_INTERVAL']:
+        executor = MigrationExecutor(connection)
+        pending = len(executor.migration_plan(executor.loader.graph.leaf_nodes()))
+        _migrations[connection.alias] = (pending, time.monotonic())
+    return pending
+
+
+def _check_database(alias, config):
+    connection = connections[alias]
+    result = {
+        'status': 'ok',
+        'vendor': connection.vendor,
+        'conn_max_age': connection.settings_dict['CONN_MAX_AGE'],
+        'pending_migrations': None,
+    }
+    started = time.monotonic()
+    try:
+        with dbguard.deadline(config['DB_TIMEOUT']):
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT 1')
+                cursor.fetchone()
+            result['latency'] = round(time.monotonic() - started, 4)
+            result['pending_migrations'] = _pending_migrations(connection, config)
+    except dbguard.CircuitOpen:
+        result['status'] = 'circuit_open'
+    except dbguard.StatementTimeout:
+        result['status'] = 'timeout'
+    except Exception as e:
+        result.update(status='error', error=str(e))
+    opened_at = getattr(connection, '_opened_at', None)
+    if connection.connection is not None and opened_at is not None:
+        result['connection_age'] = round(time.monotonic() - opened_at, 3)
+    return result
+
+
+def _cache_warm():
+    try:
+        return cache.is_warm()
+    except Exception:
+        # The shared cache being down does not make the node unready
+        return None
+
+
+def _refresh(config):
+    global _report
+    databases = {alias: _check_database(alias, config) for alias in shards.aliases()}
+    report = {
+        'ready': all(db['status'] == 'ok' and db['pending_migrations'] == 0 for db in databases.values()),
+        'databases': databases,
+        'dossier_cache': {'warm': _cache_warm()},
+    }
+    _report = (report, time.monotonic())
+    return _report
+
+
+def readiness():
+    """
+    Cached readiness report; ``age`` is how old the database check is.
+
+    Writer lag is read live: it is process memory, not a query.
+    """
+    config = get_config()
+    report, checked_at = _report
+    if report is None or time.monotonic() - checked_at >= config['CHECK_INTERVAL']:
+        report, checked_at = flights.do('readiness', lambda: _refresh(config))
+    writers = {'lookup_stats': stats.lookups.lag(), 'audit': audit.writer.lag()}
+    return dict(
+        report,
+        age=round(time.monotonic() - checked_at, 3),
+        writers={name: {'lag': lag, 'stale': lag > config['STALE_AFTER']} for name, lag in writers.items()},
+    )
@@ -0,0 +1,143 @@
+"""
+Plate and accident history.
+
+``archive_*`` move cold rows (released plates, old accidents) from the hot
+tables into ``plates_archive`` / ``accidents_archive`` in chunked
+transactions, so the indexes and pages ``check_plate`` touches only cover
+active plates and recent accidents. The readers below union the live
+tables with their archives, so history endpoints see one timeline.
+"""
+from django.db import transaction
+from django.db.models import BooleanField, F, Value, Window
+from django.db.models.functions import RowNumber
+
+from . import parts
+from .dossier import part_data
+from .models import Plate, PlateArchive, Accident, AccidentArchive
+
+
+def archive_released_plates(using, released_before, chunk_size=1000):
+    """Move plates released before ``released_before``; returns the count."""
+    moved = 0
+    last_pk = 0
+    while True:
+        with transaction.atomic(using=using):
+            chunk = list(
+                Plate.objects.using(using).select_for_update()
+                .filter(released_at__lt=released_before, pk__gt=last_pk)
+                .order_by('pk')[:chunk_size]
+            )
+            if not chunk:
+                return moved
+            PlateArchive.objects.using(using).bulk_create([
+                PlateArchive(
+                    plate_id=plate.plate_id, vehicle_id=plate.vehicle_id, plate_number=plate.plate_number,
+                    region=plate.region, assigned_at=plate.assigned_at, released_at=plate.released_at,
+                )
+                for plate in chunk
+            ], ignore_conflicts=True)
+            Plate.objects.using(using).filter(pk__in=[plate.pk for plate in chunk]).delete()
+        last_pk = chunk[-1].pk
+        moved += len(chunk)
+
+
+def archive_old_accidents(using, older_than, keep_latest, chunk_size=1000):
+    """
+    Move accidents dated before ``older_than``, except each vehicle's
+    ``keep_latest`` most recent ones (which the dossier still shows).
+    Returns the count.
+    """
+    catalog = parts.catalog(using)
+    moved = 0
+    last_pk = 0
+    while True:
+        with transaction.atomic(using=using):
+            candidates = list(
+                Accident.objects.using(using).select_for_update()
+                .filter(date__lt=older_than, pk__gt=last_pk)
+                .order_by('pk')[:chunk_size]
+            )
+            if not candidates:
+                return moved
+            last_pk = candidates[-1].pk
+
+            protected = set()
+            if keep_latest:
+                protected = set(
+                    Accident.objects.using(using)
+                    .filter(vehicle_id__in={accident.vehicle_id for accident in candidates})
+                    .annotate(row=Window(
+                        RowNumber(),
+                        partition_by=[F('vehicle_id')],
+                        order_by=[F('date').desc(), F('accident_id').desc()],
+                    ))
+                    .filter(row__lte=keep_latest)
+                    .values_list('accident_id', flat=True)
+                )
+            movable = [accident for accident in candidates if accident.pk not in protected]
+            if not movable:
+                continue
+
+            AccidentArchive.objects.using(using).bulk_create([
+                AccidentArchive(
+                    accident_id=accident.accident_id, vehicle_id=accident.vehicle_id, date=accident.date,
+                    severity=accident.severity, location=accident.location, description=accident.description,
+                    fault_party=accident.fault_party,
+                    damaged_part_ids=sorted(part.part_id for part in catalog.decode(accident.damaged_parts_mask)),
+                )
+                for accident in movable
+            ], ignore_conflicts=True)
+            Accident.objects.using(using).filter(pk__in=[accident.pk for accident in movable]).delete()
+        moved += len(movable)
+
+
+def _archived(flag):
+    return Value(flag, output_field=BooleanField())
+
+
+def plate_assignments(plate_norm, using):
+    """Every vehicle that has carried ``plate_norm``, newest first."""
+    columns = ('plate_id', 'vehicle_id', 'vehicle__vin', 'region', 'assigned_at', 'released_at')
+    live = Plate.objects.using(using).filter(plate_number=plate_norm).values(*columns).annotate(archived=_archived(False))
+    archived = PlateArchive.objects.using(using).filter(plate_number=plate_norm).values(*columns).annotate(archived=_archived(True))
+    return [
+        {
+            'plate_id': row['plate_id'],
+            'vehicle_id': row['vehicle_id'],
+            'vin': row['vehicle__vin'],
+            'region': row['region'],
+            'assigned_at': row['assigned_at'],
+            'released_at': row['released_at'],
+            'archived': row['archived'],
+        }
+        for row in live.union(archived, all=True).order_by('-assigned_at')
+    ]
+
+
+def vehicle_plates(vehicle_id, using):
+    columns = ('plate_number', 'region', 'assigned_at', 'released_at')
+    live = Plate.objects.using(using).filter(vehicle_id=vehicle_id).values(*columns).annotate(archived=_archived(False))
+    archived = PlateArchive.objects.using(using).filter(vehicle_id=vehicle_id).values(*columns).annotate(archived=_archived(True))
+    return list(live.union(archived, all=True).order_by('-assigned_at'))
+
+
+def vehicle_accidents(vehicle_id, using):
+    """Full accident history of a vehicle, newest first, with damaged parts."""
+    columns = ('accident_id', 'date', 'severity', 'location', 'description', 'fault_party')
+    live = Accident.objects.using(using).filter(vehicle_id=vehicle_id).values(*columns).annotate(archived=_archived(False))
+    archived = AccidentArchive.objects.using(using).filter(vehicle_id=vehicle_id).values(*columns).annotate(archived=_archived(True))
+    accidents = list(live.union(archived, all=True).order_by('-date', '-accident_id'))
+
+    catalog = parts.catalog(using)
+    archived_ids = [row['accident_id'] for row in accidents if row['archived']]
+    masks = dict(
+        Accident.objects.using(using).filter(vehicle_id=vehicle_id).values_list('accident_id', 'damaged_parts_mask')
+    )
+    if archived_ids:
+        for accident_id, part_ids in AccidentArchive.objects.using(using).filter(
+            accident_id__in=archived_ids
+        ).values_list('accident_id', 'damaged_part_ids'):
+            masks[accident_id] = parts.mask_of([pk for pk in part_ids if pk in catalog.by_pk], using)
+    for row in accidents:
+        row['damaged_parts'] = [part_data(part) for part in catalog.decode(masks.get(row['accident_id'], 0))]
+    return accidents
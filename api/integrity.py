@@ -0,0 +1,237 @@
+"""
+Registry consistency audit (``manage.py audit_registry``).
+
+Each check is one SQL statement over a primary-key range of one table, so
+the tables are scanned in chunks that any number of worker processes can
+take in any order; chunk bounds come from ``MIN``/``MAX`` of the primary
+key, never from ``OFFSET``. Workers open their own connections and make
+them read-only (``PRAGMA query_only`` on SQLite,
+``default_transaction_read_only`` on PostgreSQL).
+
+The run has a fixed time budget: statements still running when it ends
+are interrupted (SQLite progress handler, PostgreSQL ``statement_timeout``)
+and chunks not started are skipped. The report lists the pk ranges left
+unscanned, so a truncated run says exactly what it did not cover. Chunks
+are queued round-robin across checks, so every check gets some coverage
+even when the budget runs out.
+"""
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, TimeoutError, as_completed
+
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.db.utils import OperationalError
+from django.utils import timezone
+
+# ``today`` checks take the date as a third parameter
+CHECKS = {
+    'multiple_active_plates': {
+        'table': 'vehicles',
+        'pk': 'vehicle_id',
+        'sql': (
+            "SELECT vehicle_id, COUNT(*) AS active_plates FROM plates "
+            "WHERE released_at IS NULL AND vehicle_id BETWEEN %s AND %s "
+            "GROUP BY vehicle_id HAVING COUNT(*) > 1"
+        ),
+    },
+    # uq_active_plate is UNIQUE (plate_number, released_at), and NULLs are
+    # distinct in a unique index: it never stops two active rows
+    'duplicate_active_plates': {
+        'table': 'plates',
+        'pk': 'plate_id',
+        'sql': (
+            "SELECT p.plate_id, p.plate_number, p.vehicle_id FROM plates p "
+            "WHERE p.plate_id BETWEEN %s AND %s AND p.released_at IS NULL AND EXISTS ("
+            "SELECT 1 FROM plates q WHERE q.plate_number = p.plate_number "
+            "AND q.released_at IS NULL AND q.plate_id < p.plate_id)"
+        ),
+    },
+    'overlapping_policies': {
+        'table': 'insurance_policies',
+        'pk': 'policy_id',
+        'sql': (
+            "SELECT p.policy_id, q.policy_id AS overlaps_policy_id, p.vehicle_id, p.type "
+            "FROM insurance_policies p JOIN insurance_policies q "
+            "ON q.vehicle_id = p.vehicle_id AND q.type = p.type AND q.policy_id < p.policy_id "
+            "AND q.status <> 'cancelled' AND q.valid_from <= p.valid_to AND p.valid_from <= q.valid_to "
+            "WHERE p.policy_id BETWEEN %s AND %s AND p.status <> 'cancelled'"
+        ),
+    },
+    'expired_active_policies': {
+        'table': 'insurance_policies',
+        'pk': 'policy_id',
+        'sql': (
+            "SELECT policy_id, vehicle_id, type, valid_to FROM insurance_policies "
+            "WHERE policy_id BETWEEN %s AND %s AND status = 'active' AND valid_to < %s"
+        ),
+        'today': True,
+    },
+    'expired_valid_licenses': {
+        'table': 'driver_licenses',
+        'pk': 'license_id',
+        'sql': (
+            "SELECT license_id, owner_id, expires_at FROM driver_licenses "
+            "WHERE license_id BETWEEN %s AND %s AND status = 'valid' AND expires_at < %s"
+        ),
+        'today': True,
+    },
+    'orphaned_owners': {
+        'table': 'owners',
+        'pk': 'owner_id',
+        'sql': (
+            "SELECT o.owner_id FROM owners o WHERE o.owner_id BETWEEN %s AND %s "
+            "AND NOT EXISTS (SELECT 1 FROM vehicles v WHERE v.owner_id = o.owner_id) "
+            "AND NOT EXISTS (SELECT 1 FROM driver_licenses l WHERE l.owner_id = o.owner_id)"
+        ),
+    },
+}
+
+# How long to wait past the budget for workers to notice it
+GRACE = 30.0
+
+_deadline_at = None
+
+
+def pk_bounds(alias, table, pk):
+    with connections[alias].cursor() as cursor:
+        cursor.execute(f'SELECT MIN({pk}), MAX({pk}) FROM {table}')
+        return cursor.fetchone()
+
+
+def make_read_only(sender, connection, **kwargs):
+    """``connection_created`` handler, connected in audit workers only."""
+    if connection.vendor == 'sqlite':
+        connection.connection.execute('PRAGMA query_only = ON')
+        connection.connection.set_progress_handler(lambda: time.time() > _deadline_at, 10000)
+    elif connection.vendor == 'postgresql':
+        with connection.connection.cursor() as cursor:
+            cursor.execute('SET default_transaction_read_only = on')
+
+
+def _init_worker(deadline_at):
+    global _deadline_at
+    _deadline_at = deadline_at
+    import django
+    django.setup()  # no-op when forked from a configured parent
+    connection_created.connect(make_read_only, dispatch_uid='api.integrity.make_read_only')
+
+
+def scan_chunk(alias, name, lo, hi, today, max_samples):
+    """Run one check over ``lo..hi``; returns its status, finding count and first rows."""
+    remaining = _deadline_at - time.time()
+    if remaining <= 0:
+        return {'status': 'skipped'}
+    check = CHECKS[name]
+    connection = connections[alias]
+    params = [lo, hi, today] if check.get('today') else [lo, hi]
+    started = time.monotonic()
+    found, samples = 0, []
+    try:
+        with connection.cursor() as cursor:
+            if connection.vendor == 'postgresql':
+                cursor.execute('SET statement_timeout = %s', [max(1, int(remaining * 1000))])
+            cursor.execute(check['sql'], params)
+            columns = [column[0] for column in cursor.description]
+            for row in cursor:
+                found += 1
+                if len(samples) < max_samples:
+                    samples.append(dict(zip(columns, row)))
+    except OperationalError:
+        if time.time() < _deadline_at:
+            raise
+        return {'status': 'timeout'}
+    return {'status': 'ok', 'found': found, 'samples': samples, 'seconds': time.monotonic() - started}
+
+
+def plan(aliases, names, chunk_size):
+    """``(report skeleton, tasks)``; tasks interleave the checks chunk by chunk."""
+    databases, queues = {}, []
+    for alias in aliases:
+        bounds = {}
+        databases[alias] = {}
+        for name in names:
+            check = CHECKS[name]
+            if check['table'] not in bounds:
+                bounds[check['table']] = pk_bounds(alias, check['table'], check['pk'])
+            lo, hi = bounds[check['table']]
+            chunks = [] if lo is None else [
+                (start, min(start + chunk_size - 1, hi)) for start in range(lo, hi + 1, chunk_size)
+            ]
+            databases[alias][name] = {
+                'table': check['table'],
+                'pk_range': [lo, hi],
+                'chunks': len(chunks),
+                'scanned_chunks': 0,
+                'found': 0,
+                'samples': [],
+                'unscanned': [],
+                'errors': [],
+                'seconds': 0.0,
+            }
+            queues.append([(alias, name, chunk_lo, chunk_hi) for chunk_lo, chunk_hi in chunks])
+    rounds = max((len(queue) for queue in queues), default=0)
+    tasks = [queue[i] for i in range(rounds) for queue in queues if i < len(queue)]
+    return databases, tasks
+
+
+def _collect(entry, future, lo, hi, max_samples):
+    try:
+        result = future.result()
+    except Exception as e:
+        entry['errors'].append({'pk_range': [lo, hi], 'error': str(e)})
+        result = {'status': 'error'}
+    if result['status'] != 'ok':
+        entry['unscanned'].append([lo, hi])
+        return
+    entry['scanned_chunks'] += 1
+    entry['found'] += result['found']
+    entry['seconds'] += result['seconds']
+    entry['samples'].extend(result['samples'][:max_samples - len(entry['samples'])])
+
+
+def run(aliases, names=None, chunk_size=50000, workers=None, time_budget=3600.0, max_samples=100):
+    """Audit ``aliases`` and return the report (a JSON-serializable dict apart from dates)."""
+    names = list(names or CHECKS)
+    workers = workers or min(4, os.cpu_count() or 1)
+    started_at, started = timezone.now(), time.time()
+    deadline_at = started + time_budget
+    today = timezone.localdate()
+    databases, tasks = plan(aliases, names, chunk_size)
+
+    # Workers are forked: never hand them this process's connections
+    connections.close_all()
+    pool = ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(deadline_at,))
+    futures = {pool.submit(scan_chunk, *task, today, max_samples): task for task in tasks}
+    stuck = False
+    try:
+        for future in as_completed(futures, timeout=max(0.0, deadline_at - time.time()) + GRACE):
+            alias, name, lo, hi = futures.pop(future)
+            _collect(databases[alias][name], future, lo, hi, max_samples)
+    except TimeoutError:
+        # A worker stuck past the budget (e.g. connecting): give up on it
+        stuck = True
+        for future, (alias, name, lo, hi) in futures.items():
+            if future.done():
+                _collect(databases[alias][name], future, lo, hi, max_samples)
+            else:
+                databases[alias][name]['unscanned'].append([lo, hi])
+    finally:
+        pool.shutdown(wait=not stuck, cancel_futures=True)
+
+    complete = True
+    for checks in databases.values():
+        for entry in checks.values():
+            entry['unscanned'].sort()
+            entry['seconds'] = round(entry['seconds'], 3)
+            complete = complete and entry['scanned_chunks'] == entry['chunks']
+    return {
+        'started_at': started_at,
+        'elapsed': round(time.time() - started, 3),
+        'time_budget': time_budget,
+        'complete': complete,
+        'today': today,
+        'workers': workers,
+        'chunk_size': chunk_size,
+        'databases': databases,
+    }
@@ -0,0 +1,71 @@
+"""
+Kazakhstan plate numbers: folding, validation and region.
+
+``parse`` turns raw input into the canonical form stored in
+``plates.plate_number`` and checks it against the formats issued since
+2012: ``123ABC02`` (individuals) and ``123AB02`` (legal entities), where
+the last two digits are the region code. Separators are dropped, Latin
+letters upper-cased and the Cyrillic letters that look like Latin ones
+(А/A, В/B, Е/E, К/K, ...) folded into them, in one ``str.translate``
+through a precomputed table (drivers' keyboards and OCR produce those
+freely). Validation is one compiled regex. Input that is not a plate is
+rejected before it reaches a cache or a database.
+
+Lookups also accept ``legacy`` numbers: the same shape with a suffix that
+is not a region code (``123ABC45``). The registry holds such numbers from
+before the format was enforced; they are found as stored, with no region,
+but never issued again (``api.replating`` uses the strict parse).
+"""
+import re
+import string
+
+# Cyrillic (and Kazakh) letters with a Latin twin on a plate, upper and lower case
+CYRILLIC = 'АВЕКМНОРСТХУІҮ'
+LATIN = 'ABEKMHOPCTXYIY'
+SEPARATORS = ' \t\n\r\v\f\u00a0\u2007\u2009\u202f-'
+
+_FOLDS = {
+    **dict(zip(CYRILLIC, LATIN)),
+    **dict(zip(CYRILLIC.lower(), LATIN)),
+    **dict(zip(string.ascii_lowercase, string.ascii_uppercase)),
+    **dict.fromkeys(SEPARATORS),
+}
+# Indexed by code point: str.translate looks a list up about three times
+# faster than a dict; code points past its end are left as they are
+FOLD = [chr(code) for code in range(max(map(ord, _FOLDS)) + 1)]
+for _char, _folded in _FOLDS.items():
+    FOLD[ord(_char)] = _folded
+
+# 01 Astana ... 17 Shymkent, 18 Abai, 19 Zhetisu, 20 Ulytau
+REGIONS = frozenset(f'{code:02d}' for code in range(1, 21))
+
+# Longer input is rejected without looking at it
+MAX_INPUT = 32
+
+FORMAT = re.compile(r'[0-9]{3}[A-Z]{2,3}(?:0[1-9]|1[0-9]|20)')
+LEGACY_FORMAT = re.compile(r'[0-9]{3}[A-Z]{2,3}[0-9]{2}')
+
+
+def normalize(value):
+    """Canonical spelling of ``value``, valid plate or not."""
+    return value.translate(FOLD)
+
+
+def parse(value, legacy=False):
+    """
+    ``(plate_number, region)`` for a plate, or ``(None, None)``.
+
+    With ``legacy`` a number of the old shape comes back as
+    ``(plate_number, None)`` instead of being rejected.
+    """
+    if len(value) > MAX_INPUT:
+        return None, None
+    # Most input is already canonical: one regex and no translation
+    if len(value) > 8 or FORMAT.fullmatch(value) is None:
+        value = value.translate(FOLD)
+        if FORMAT.fullmatch(value) is None:
+            if legacy and LEGACY_FORMAT.fullmatch(value) is not None:
+                return value, None
+            return None, None
+    return value, value[-2:]
+
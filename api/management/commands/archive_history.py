@@ -0,0 +1,62 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from api import dossier, history, shards
+from api.models import Plate, Accident
+
+
+class Command(BaseCommand):
+    help = (
+        'Переносит снятые номера и старые ДТП из рабочих таблиц в архивные '
+        '(plates_archive, accidents_archive) порциями, каждая в своей транзакции'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--plate-retention-days', type=int, default=365,
+                            help='Сколько дней хранить снятые номера в рабочей таблице (по умолчанию 365)')
+        parser.add_argument('--accident-retention-days', type=int, default=5 * 365,
+                            help='ДТП старше этого срока переносятся в архив (по умолчанию 1825)')
+        parser.add_argument('--keep-latest', type=int, default=dossier.MAX_ACCIDENTS,
+                            help='Сколько последних ДТП каждого ТС всегда оставлять в рабочей таблице '
+                                 f'(по умолчанию {dossier.MAX_ACCIDENTS} — наибольшее значение ?accidents= в досье; '
+                                 'при меньшем значении глубокие запросы досье не увидят перенесённые ДТП)')
+        parser.add_argument('--chunk-size', type=int, default=1000,
+                            help='Размер порции (строк на транзакцию)')
+        parser.add_argument('--database', action='append', dest='databases',
+                            help='Шард для архивации (можно указать несколько раз, по умолчанию все)')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Только посчитать кандидатов, ничего не переносить')
+
+    def handle(self, *args, **options):
+        if options['chunk_size'] < 1 or options['keep_latest'] < 0:
+            raise CommandError('--chunk-size должен быть > 0, --keep-latest >= 0')
+        if options['keep_latest'] < dossier.MAX_ACCIDENTS:
+            self.stderr.write(self.style.WARNING(
+                f"--keep-latest {options['keep_latest']} < {dossier.MAX_ACCIDENTS}: check_plate с "
+                f"?accidents= больше {options['keep_latest']} не покажет перенесённые в архив ДТП"
+            ))
+        databases = options['databases'] or shards.aliases()
+        unknown = set(databases) - set(shards.aliases())
+        if unknown:
+            raise CommandError(f"Неизвестные шарды: {', '.join(sorted(unknown))}")
+
+        now = timezone.now()
+        released_before = now - timedelta(days=options['plate_retention_days'])
+        accidents_before = now.date() - timedelta(days=options['accident_retention_days'])
+
+        for alias in databases:
+            if options['dry_run']:
+                plates = Plate.objects.using(alias).filter(released_at__lt=released_before).count()
+                accidents = Accident.objects.using(alias).filter(date__lt=accidents_before).count()
+                self.stdout.write(
+                    f"[{alias}] кандидатов: номеров {plates}, ДТП {accidents} "
+                    f"(последние {options['keep_latest']} ДТП каждого ТС останутся)"
+                )
+                continue
+            plates = history.archive_released_plates(alias, released_before, options['chunk_size'])
+            accidents = history.archive_old_accidents(
+                alias, accidents_before, options['keep_latest'], options['chunk_size']
+            )
+            self.stdout.write(self.style.SUCCESS(f"[{alias}] в архив перенесено: номеров {plates}, ДТП {accidents}"))
@@ -0,0 +1,71 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+from django.core.serializers.json import DjangoJSONEncoder
+
+from api import integrity, shards
+
+
+class Command(BaseCommand):
+    help = (
+        'Проверка целостности реестра: несколько активных номеров у ТС, дубли активных номеров, '
+        'пересекающиеся полисы одного типа, просроченные полисы и удостоверения в активном статусе, '
+        'владельцы без ТС и удостоверений. Таблицы сканируются порциями по первичному ключу '
+        'в пуле процессов с read-only соединениями; отчёт в JSON'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--check', action='append', dest='checks', choices=sorted(integrity.CHECKS),
+                            help='Проверка (можно указать несколько раз, по умолчанию все)')
+        parser.add_argument('--database', action='append', dest='databases',
+                            help='Шард для проверки (можно указать несколько раз, по умолчанию все)')
+        parser.add_argument('--chunk-size', type=int, default=50000,
+                            help='Диапазон первичного ключа на одну порцию (по умолчанию 50000)')
+        parser.add_argument('--workers', type=int, default=None,
+                            help='Число процессов (по умолчанию min(4, число CPU))')
+        parser.add_argument('--time-budget', type=float, default=3600.0,
+                            help='Бюджет времени в секундах: что не успело, попадает в unscanned (по умолчанию 3600)')
+        parser.add_argument('--max-samples', type=int, default=100,
+                            help='Сколько найденных строк каждой проверки включать в отчёт (по умолчанию 100)')
+        parser.add_argument('--output', default='-',
+                            help='Файл для JSON-отчёта (по умолчанию stdout)')
+        parser.add_argument('--fail-on-findings', action='store_true',
+                            help='Завершиться с ошибкой, если найдены нарушения или проверка не завершена')
+
+    def handle(self, *args, **options):
+        if options['chunk_size'] < 1 or options['time_budget'] <= 0 or options['max_samples'] < 0:
+            raise CommandError('--chunk-size и --time-budget должны быть > 0, --max-samples >= 0')
+        if options['workers'] is not None and options['workers'] < 1:
+            raise CommandError('--workers должен быть > 0')
+        databases = options['databases'] or shards.aliases()
+        unknown = set(databases) - set(shards.aliases())
+        if unknown:
+            raise CommandError(f"Неизвестные шарды: {', '.join(sorted(unknown))}")
+
+        report = integrity.run(
+            databases,
+            options['checks'],
+            chunk_size=options['chunk_size'],
+            workers=options['workers'],
+            time_budget=options['time_budget'],
+            max_samples=options['max_samples'],
+        )
+        text = json.dumps(report, cls=DjangoJSONEncoder, ensure_ascii=False, indent=2)
+        total = sum(entry['found'] for checks in report['databases'].values() for entry in checks.values())
+        if options['output'] == '-':
+            self.stdout.write(text)
+        else:
+            with open(options['output'], 'w', encoding='utf-8') as f:
+                f.write(text)
+            # Summary only when stdout is not the report itself
+            for alias, checks in report['databases'].items():
+                for name, entry in checks.items():
+                    line = (f"[{alias}] {name}: нарушений {entry['found']}, "
+                            f"порций {entry['scanned_chunks']}/{entry['chunks']}")
+                    self.stdout.write(line if entry['found'] or entry['unscanned'] else self.style.SUCCESS(line))
+            if not report['complete']:
+                self.stdout.write(self.style.WARNING(
+                    f"Бюджет {report['time_budget']:g} с исчерпан: непроверенные диапазоны в unscanned"
+                ))
+        if options['fail_on_findings'] and (total or not report['complete']):
+            raise CommandError(f'Найдено нарушений: {total}' + ('' if report['complete'] else ', проверка не завершена'))
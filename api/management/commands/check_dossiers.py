@@ -0,0 +1,66 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from api import materialized, shards
+
+
+class Command(BaseCommand):
+    help = (
+        'Сверяет готовые досье (materialized_dossiers) со сборкой из таблиц реестра: '
+        'несовпадающие (mismatched), отсутствующие для действующих номеров (missing) и записи '
+        'снятых номеров (orphaned). ТС из очереди обновления пропускаются. Диапазоны ТС '
+        'проверяются в пуле процессов; отчёт в JSON'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--database', action='append', dest='databases',
+                            help='Шард (можно указать несколько раз, по умолчанию все)')
+        parser.add_argument('--chunk-size', type=int, default=1000,
+                            help='Диапазон vehicle_id на одну порцию (по умолчанию 1000)')
+        parser.add_argument('--workers', type=int, default=None,
+                            help='Число процессов (по умолчанию min(4, число CPU))')
+        parser.add_argument('--max-samples', type=int, default=100,
+                            help='Сколько номеров каждого вида расхождений включать в отчёт (по умолчанию 100)')
+        parser.add_argument('--fix', action='store_true',
+                            help='Поставить ТС с расхождениями в очередь и сразу пересобрать их досье')
+        parser.add_argument('--fail-on-mismatch', action='store_true',
+                            help='Завершиться с ошибкой, если найдены расхождения')
+
+    def handle(self, *args, **options):
+        if options['chunk_size'] < 1 or options['max_samples'] < 0:
+            raise CommandError('--chunk-size должен быть > 0, --max-samples >= 0')
+        if options['workers'] is not None and options['workers'] < 1:
+            raise CommandError('--workers должен быть > 0')
+        databases = options['databases'] or shards.aliases()
+        unknown = set(databases) - set(shards.aliases())
+        if unknown:
+            raise CommandError(f"Неизвестные шарды: {', '.join(sorted(unknown))}")
+
+        kinds = ('missing', 'mismatched', 'orphaned')
+        report = {alias: {'checked': 0, **{kind: 0 for kind in kinds}, 'samples': {kind: [] for kind in kinds}}
+                  for alias in databases}
+        # --fix needs every affected vehicle, not just the samples
+        max_samples = None if options['fix'] else options['max_samples']
+        for alias, result in materialized.run_parallel(
+            materialized.check_range, databases, options['chunk_size'], options['workers'], (max_samples,),
+        ):
+            entry = report[alias]
+            entry['checked'] += result['checked']
+            for kind in kinds:
+                entry[kind] += result['counts'][kind]
+                entry['samples'][kind].extend(result[kind])
+
+        total = 0
+        for alias, entry in report.items():
+            found = sum(entry[kind] for kind in kinds)
+            total += found
+            if options['fix'] and found:
+                vehicles = {vehicle_id for kind in kinds for _, vehicle_id in entry['samples'][kind]}
+                materialized.mark(alias, vehicles, drain_on_commit=False)
+                entry['fixed_vehicles'] = materialized.drain(alias)
+            for kind in kinds:
+                entry['samples'][kind] = [plate for plate, _ in entry['samples'][kind][:options['max_samples']]]
+        self.stdout.write(json.dumps(report, ensure_ascii=False, indent=2))
+        if options['fail_on_mismatch'] and total:
+            raise CommandError(f'Найдено расхождений: {total}')
@@ -0,0 +1,77 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from api import dossier, export, kzplates
+from api.search import decode_cursor, encode_cursor
+
+
+class Command(BaseCommand):
+    help = (
+        'Выгружает досье всех действующих номеров в сжатый NDJSON (по строке на номер) для партнёров. '
+        'Номера читаются порциями по первичному ключу, память не растёт с размером реестра; '
+        'после каждой порции в файл пишется строка с курсором для продолжения'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--output', default='-',
+                            help='Файл выгрузки (по умолчанию stdout); продолжение с --cursor пишите в новый файл')
+        parser.add_argument('--compression', choices=list(export.COMPRESSORS), default=None,
+                            help='gzip, zstd или none (по умолчанию по расширению файла, иначе gzip)')
+        parser.add_argument('--region', default=None, help='Только номера региона')
+        parser.add_argument('--since', default=None,
+                            help='Только номера, выданные с этого момента, и ТС с изменившимися ДТП или полисами '
+                                 '(дата или дата-время ISO)')
+        parser.add_argument('--cursor', default=None, help='Продолжить с курсора из последней контрольной строки')
+        parser.add_argument('--fields', default=None, help='Разделы досье через запятую (по умолчанию все)')
+        parser.add_argument('--exclude', default=None, help='Исключить разделы досье')
+        parser.add_argument('--accidents', type=int, default=dossier.DEFAULT_ACCIDENTS,
+                            help=f'Сколько последних ДТП включать (по умолчанию {dossier.DEFAULT_ACCIDENTS})')
+        parser.add_argument('--chunk-size', type=int, default=None,
+                            help='Номеров в порции (по умолчанию DOSSIER_EXPORT CHUNK_SIZE)')
+
+    def handle(self, *args, **options):
+        if options['chunk_size'] is not None and options['chunk_size'] < 1:
+            raise CommandError('--chunk-size должен быть > 0')
+        compression = options['compression']
+        if compression is None:
+            compression = next(
+                (name for name, compressor in export.COMPRESSORS.items()
+                 if compressor.suffix and options['output'].endswith(compressor.suffix)),
+                'gzip',
+            )
+        if compression not in export.available_compressions():
+            raise CommandError(f'Сжатие {compression} недоступно: установите пакет zstandard')
+        params = {key: options[key] for key in ('fields', 'exclude', 'accidents') if options[key] is not None}
+        try:
+            sections, accidents_limit = dossier.parse_params(params)
+            since = export.parse_since(options['since']) if options['since'] else None
+            if options['region'] is not None and options['region'] not in kzplates.REGIONS:
+                raise ValueError('--region: код региона от 01 до 20')
+            cursor = decode_cursor(options['cursor'])
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        to_file = options['output'] != '-'
+        done = {'count': 0, 'cursor': cursor}
+
+        def progress(count, position):
+            done.update(count=count, cursor=position)
+
+        chunks = export.stream(sections, accidents_limit, options['region'], since, cursor, compression,
+                               options['chunk_size'], progress)
+        # Not appended on resume: the interrupted file may end inside a compressed block
+        out = open(options['output'], 'wb') if to_file else sys.stdout.buffer
+        try:
+            for chunk in chunks:
+                out.write(chunk)
+        finally:
+            if to_file:
+                out.close()
+            else:
+                out.flush()
+        if to_file:
+            self.stdout.write(self.style.SUCCESS(
+                f"Выгружено досье: {done['count']} в {options['output']} ({compression}), "
+                f"курсор {encode_cursor(done['cursor'])}"
+            ))
@@ -0,0 +1,116 @@
+import random
+from urllib.parse import urlsplit
+from wsgiref.util import setup_testing_defaults
+
+from django.conf import settings
+from django.core.handlers.wsgi import WSGIHandler
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Max, Min
+from django.test import override_settings
+from django.urls import reverse
+
+from api import profiling, shards
+from api.models import Plate
+from api.views import normalize_plate
+
+ACCEPT = {'json': 'application/json', 'msgpack': 'application/msgpack'}
+
+
+class Command(BaseCommand):
+    help = (
+        'Профилирует N проверок номера через полный стек (middleware, представление, рендерер) '
+        'и печатает самые затратные функции, разбивку времени (драйвер БД, ORM, DRF, код api) '
+        'и строки с наибольшими выделениями памяти. Набор данных — база из настроек (SQLITE_PATH); '
+        'обращения попадают в журнал от клиента profile_lookups'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--count', type=int, default=200, help='Сколько проверок профилировать (по умолчанию 200)')
+        parser.add_argument('--plate', action='append', dest='plates',
+                            help='Номер для проверки (можно указать несколько раз) вместо случайной выборки')
+        parser.add_argument('--sample', type=int, default=100,
+                            help='Сколько случайных действующих номеров взять (по умолчанию 100)')
+        parser.add_argument('--database', default=None, help='Шард для выборки номеров (по умолчанию основной)')
+        parser.add_argument('--query', default='', help='Параметры запроса, например "fields=vehicle,insurance"')
+        parser.add_argument('--accept', choices=sorted(ACCEPT), default='json', help='Формат ответа')
+        parser.add_argument('--no-cache', action='store_true',
+                            help='Отключить кэш досье (DOSSIER_CACHE TTL = 0), чтобы каждая проверка шла в базу')
+        parser.add_argument('--warmup', type=int, default=5, help='Проверок до начала профилирования (по умолчанию 5)')
+        parser.add_argument('--profiler', choices=['auto', 'cprofile'], default='cprofile',
+                            help='cprofile (по умолчанию) или auto — pyinstrument, если установлен')
+        parser.add_argument('--no-memory', action='store_true', help='Без tracemalloc (он замедляет выделения памяти)')
+        parser.add_argument('--sort', choices=['tottime', 'cumulative', 'ncalls'], default='tottime',
+                            help='Сортировка функций (по умолчанию tottime)')
+        parser.add_argument('--top', type=int, default=25, help='Сколько строк выводить (по умолчанию 25)')
+        parser.add_argument('--output', default=None, help='Сохранить данные cProfile (.prof) в файл')
+
+    def sample_plates(self, alias, size):
+        plates = Plate.objects.using(alias).filter(released_at__isnull=True)
+        bounds = plates.aggregate(lo=Min('plate_id'), hi=Max('plate_id'))
+        if bounds['lo'] is None:
+            return []
+        # Random points in the key range instead of ORDER BY RANDOM() over the table
+        found = set()
+        for _ in range(size * 2):
+            plate = plates.filter(plate_id__gte=random.randint(bounds['lo'], bounds['hi'])).order_by('plate_id').first()
+            if plate is not None:
+                found.add(plate.plate_number)
+            if len(found) >= size:
+                break
+        return sorted(found)
+
+    def request(self, handler, url, accept):
+        """One GET through the production WSGI stack (no test client hooks); returns the status code."""
+        parts = urlsplit(url)
+        environ = {'PATH_INFO': parts.path, 'QUERY_STRING': parts.query, 'HTTP_ACCEPT': accept,
+                   'HTTP_X_CLIENT_ID': 'profile_lookups'}
+        setup_testing_defaults(environ)
+        statuses = []
+        response = handler(environ, lambda status, headers, exc_info=None: statuses.append(status))
+        try:
+            for _ in response:
+                pass
+        finally:
+            getattr(response, 'close', lambda: None)()
+        return int(statuses[0].split()[0])
+
+    def handle(self, *args, **options):
+        if options['count'] < 1 or options['sample'] < 1 or options['warmup'] < 0:
+            raise CommandError('--count и --sample должны быть > 0, --warmup >= 0')
+        alias = options['database'] or shards.default_shard()
+        if alias not in shards.aliases():
+            raise CommandError(f'Неизвестный шард: {alias}')
+        plates = [normalize_plate(plate) for plate in options['plates'] or []] or self.sample_plates(
+            alias, options['sample'])
+        if not plates:
+            raise CommandError(f'В шарде {alias} нет действующих номеров')
+
+        handler, accept = WSGIHandler(), ACCEPT[options['accept']]
+        query = f"?{options['query']}" if options['query'] else ''
+        urls = [reverse('check_plate', args=[plates[i % len(plates)]]) + query for i in range(options['count'])]
+        # The middleware must not start a second profiler inside this one
+        overrides = {'PROFILING': dict(getattr(settings, 'PROFILING', {}), ENABLED=False)}
+        if options['no_cache']:
+            overrides['DOSSIER_CACHE'] = dict(getattr(settings, 'DOSSIER_CACHE', {}), TTL=0)
+
+        statuses = {}
+        with override_settings(**overrides):
+            for url in urls[:options['warmup']]:
+                self.request(handler, url, accept)
+            with profiling.Profile(options['profiler'], not options['no_memory']) as profile:
+                for url in urls:
+                    code = self.request(handler, url, accept)
+                    statuses[code] = statuses.get(code, 0) + 1
+
+        self.stdout.write(profile.report(
+            f"{options['count']} lookups of {len(plates)} plates on {alias}, "
+            f"{'no cache' if options['no_cache'] else 'cache on'}, responses {statuses}",
+            options['top'], options['sort'], options['count'],
+        ))
+        self.stdout.write(self.style.SUCCESS(
+            f"В среднем {profile.elapsed / options['count'] * 1000:.2f} мс и "
+            f"{profile.sql_count / options['count']:.1f} SQL-запроса на проверку"
+        ))
+        if options['output'] and not profile.sampling:
+            profile.dump(options['output'])
+            self.stdout.write(f"Данные cProfile: {options['output']}")
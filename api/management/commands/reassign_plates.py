@@ -0,0 +1,63 @@
+import csv
+import json
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from api import replating
+from api.views import normalize_plate
+
+
+class Command(BaseCommand):
+    help = (
+        'Массовая перерегистрация номеров из CSV (vin,plate): старые номера снимаются, новые выдаются '
+        'порциями в транзакциях. Пары проверяются целиком, конфликты (номер занят ТС вне файла, '
+        'неизвестный VIN, дубли, номер другого шарда) пропускаются и попадают в отчёт'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='CSV-файл с колонками vin,plate (заголовок необязателен); "-" — stdin')
+        parser.add_argument('--chunk-size', type=int, default=1000,
+                            help='Сколько перерегистраций в одной транзакции (по умолчанию 1000)')
+        parser.add_argument('--dry-run', action='store_true', help='Только проверить пары, ничего не записывать')
+        parser.add_argument('--output', default=None, help='Файл для JSON-отчёта с конфликтами')
+
+    def _read(self, f):
+        pairs = []
+        for line, row in enumerate(csv.reader(f), 1):
+            if not row or not ''.join(row).strip():
+                continue
+            if line == 1 and [cell.strip().lower() for cell in row[:2]] == ['vin', 'plate']:
+                continue
+            if len(row) < 2:
+                raise CommandError(f'Строка {line}: ожидается vin,plate')
+            pairs.append((row[0].strip().upper(), normalize_plate(row[1])))
+        return pairs
+
+    def handle(self, *args, **options):
+        if options['chunk_size'] < 1:
+            raise CommandError('--chunk-size должен быть > 0')
+        if options['path'] == '-':
+            pairs = self._read(sys.stdin)
+        else:
+            try:
+                with open(options['path'], newline='', encoding='utf-8') as f:
+                    pairs = self._read(f)
+            except OSError as e:
+                raise CommandError(f'Не удалось прочитать {options["path"]}: {e}')
+        if not pairs:
+            raise CommandError('Нет пар vin,plate')
+
+        report = replating.reassign(pairs, chunk_size=options['chunk_size'], dry_run=options['dry_run'])
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as f:
+                json.dump(report, f, ensure_ascii=False, indent=2)
+        for conflict in report['conflicts'][:20]:
+            self.stdout.write(f"{conflict['vin']} -> {conflict['plate']}: {conflict['reason']}")
+        if len(report['conflicts']) > 20:
+            self.stdout.write(f"... ещё конфликтов: {len(report['conflicts']) - 20}")
+        verb = 'Будет перерегистрировано' if options['dry_run'] else 'Перерегистрировано'
+        self.stdout.write(self.style.SUCCESS(
+            f"{verb}: {report['reassigned']} из {len(pairs)}, без изменений {len(report['unchanged'])}, "
+            f"конфликтов {len(report['conflicts'])}, транзакций {report['chunks']}"
+        ))
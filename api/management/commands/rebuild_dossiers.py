@@ -0,0 +1,56 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from api import materialized, shards
+
+
+class Command(BaseCommand):
+    help = (
+        'Пересобирает готовые досье (materialized_dossiers) всех действующих номеров: диапазоны ТС '
+        'обрабатываются в пуле процессов. С --pending — только ТС из очереди обновления и досье, '
+        'у которых истёк срок действия полиса (для запуска по cron)'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--database', action='append', dest='databases',
+                            help='Шард (можно указать несколько раз, по умолчанию все)')
+        parser.add_argument('--pending', action='store_true',
+                            help='Обработать только очередь и устаревшие по дате досье, в этом процессе')
+        parser.add_argument('--chunk-size', type=int, default=1000,
+                            help='Диапазон vehicle_id на одну порцию (по умолчанию 1000)')
+        parser.add_argument('--workers', type=int, default=None,
+                            help='Число процессов (по умолчанию min(4, число CPU))')
+
+    def handle(self, *args, **options):
+        if options['chunk_size'] < 1:
+            raise CommandError('--chunk-size должен быть > 0')
+        if options['workers'] is not None and options['workers'] < 1:
+            raise CommandError('--workers должен быть > 0')
+        databases = options['databases'] or shards.aliases()
+        unknown = set(databases) - set(shards.aliases())
+        if unknown:
+            raise CommandError(f"Неизвестные шарды: {', '.join(sorted(unknown))}")
+
+        if options['pending']:
+            for alias in databases:
+                expired = materialized.queue_expired(alias)
+                vehicles = materialized.drain(alias)
+                self.stdout.write(self.style.SUCCESS(
+                    f"[{alias}] обновлено ТС: {vehicles} (из них с истёкшим полисом: {expired})"
+                ))
+            return
+
+        started = timezone.now()
+        stored = dict.fromkeys(databases, 0)
+        for alias, count in materialized.run_parallel(
+            materialized.rebuild_range, databases, options['chunk_size'], options['workers'],
+        ):
+            stored[alias] += count
+        for alias in databases:
+            # Changes made during the rebuild are still queued
+            vehicles = materialized.drain(alias)
+            purged = materialized.purge(alias, started)
+            self.stdout.write(self.style.SUCCESS(
+                f"[{alias}] сохранено досье: {stored[alias]}, обновлено из очереди ТС: {vehicles}, "
+                f"удалено устаревших записей: {purged}"
+            ))
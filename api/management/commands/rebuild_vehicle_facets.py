@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from api import search, shards
+
+
+class Command(BaseCommand):
+    help = 'Пересчитывает счётчики фасетов поиска ТС (vehicle_facet_counts) по данным таблицы vehicles'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--database', action='append', dest='databases',
+                            help='Шард для пересчёта (можно указать несколько раз, по умолчанию все)')
+
+    def handle(self, *args, **options):
+        databases = options['databases'] or shards.aliases()
+        unknown = set(databases) - set(shards.aliases())
+        if unknown:
+            raise CommandError(f"Неизвестные шарды: {', '.join(sorted(unknown))}")
+        for alias in databases:
+            rows = search.rebuild_facets(alias)
+            self.stdout.write(self.style.SUCCESS(f"[{alias}] пересчитано значений фасетов: {rows}"))
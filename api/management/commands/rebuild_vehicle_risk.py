@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from api import risk, shards
+
+
+class Command(BaseCommand):
+    help = (
+        'Пересчитывает сводку риска ТС (vehicle_risk_summaries) по таблицам ДТП, архива ДТП и полисов. '
+        'Нужна после массовой загрузки в обход ORM или для исправления расхождений'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=5000, help='Сколько ТС пересчитывать за один проход')
+        parser.add_argument('--database', action='append', dest='databases',
+                            help='Шард для пересчёта (можно указать несколько раз, по умолчанию все)')
+
+    def handle(self, *args, **options):
+        if options['chunk_size'] < 1:
+            raise CommandError('--chunk-size должен быть > 0')
+        databases = options['databases'] or shards.aliases()
+        unknown = set(databases) - set(shards.aliases())
+        if unknown:
+            raise CommandError(f"Неизвестные шарды: {', '.join(sorted(unknown))}")
+        for alias in databases:
+            vehicles = risk.rebuild(alias, options['chunk_size'])
+            self.stdout.write(self.style.SUCCESS(f"[{alias}] пересчитано ТС: {vehicles}"))
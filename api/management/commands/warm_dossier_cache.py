@@ -0,0 +1,40 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from api import cache
+from api.stats import hottest_plates
+from api.views import normalize_plate
+
+
+class Command(BaseCommand):
+    help = (
+        'Загружает в кэш досье самых запрашиваемых номеров. Запускается перед тем, как worker-процессы '
+        'начнут принимать трафик; с общим кэшем (SHARED_CACHE_BACKEND) прогрев выполняется один раз на все процессы'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--top', type=int, default=None,
+                            help='Сколько самых запрашиваемых номеров загрузить (по умолчанию DOSSIER_CACHE PREWARM_TOP_K)')
+        parser.add_argument('--plate', action='append', dest='plates',
+                            help='Загрузить конкретный номер (можно указать несколько раз) вместо топа')
+        parser.add_argument('--batch-size', type=int, default=500, help='Сколько досье собирать за один проход')
+        parser.add_argument('--invalidate', action='store_true',
+                            help='Сначала сбросить все закэшированные досье (новое поколение ключей)')
+
+    def handle(self, *args, **options):
+        config = cache.get_config()
+        if not config['TTL']:
+            raise CommandError('Кэш досье отключён (DOSSIER_CACHE TTL = 0)')
+        if options['batch_size'] < 1:
+            raise CommandError('--batch-size должен быть > 0')
+        top = config['PREWARM_TOP_K'] if options['top'] is None else options['top']
+        if top < 0:
+            raise CommandError('--top должен быть >= 0')
+
+        if options['invalidate']:
+            cache.invalidate()
+            self.stdout.write(f"Кэш досье сброшен, поколение ключей: {cache.generation()}")
+        plates = [normalize_plate(plate) for plate in options['plates']] if options['plates'] else hottest_plates(top)
+        warmed = cache.warm(plates, options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(
+            f"Загружено досье: {warmed} из {len(plates)} (кэш {config['ALIAS']}, поколение {cache.generation()})"
+        ))
@@ -0,0 +1,418 @@
+"""
+Materialized dossiers (``materialized_dossiers``).
+
+One row per active plate, keyed by the normalized number, holds the full
+dossier (every section, the last ``ACCIDENTS`` accidents) as the JSON text
+``check_plate`` sends. A lookup that finds a current row is one
+primary-key read; a subset of sections or fewer accidents is cut from it.
+A row is current when it was built with this ``SCHEMA_VERSION``, its
+vehicle is not waiting in ``dossier_refresh_queue`` and the calendar has
+not flipped an ``osago_active``/``kasko_active`` flag in it yet
+(``expires_on``). Anything else falls back to live assembly.
+
+The queue is what makes refreshes durable: the signal handlers below add
+the affected vehicles inside the transaction that changes a contributing
+row, and once it commits a callback rebuilds up to ``INLINE_LIMIT`` of
+them. The rest, and whatever a crash left behind, wait for ``manage.py
+rebuild_dossiers --pending``. A refresh deletes the vehicles' queue rows
+before reading anything. On SQLite that takes the write lock; on
+PostgreSQL it waits for the writer that queued them. Either way a change
+that commits during a refresh still leaves its queue row.
+
+``manage.py rebuild_dossiers`` rebuilds every row in worker processes
+without locks. Rows carry ``built_at`` and an older build never overwrites
+a newer one; a released plate keeps an empty row, so a slow build cannot
+bring it back. ``manage.py check_dossiers`` compares stored rows with live
+assembly.
+
+Bulk writes bypass the handlers and must call ``mark`` (``api.replating``
+does). Run ``rebuild_dossiers`` after ``rebuild_vehicle_risk``.
+"""
+import datetime
+import functools
+import json
+import logging
+import os
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from django.conf import settings
+from django.db import connections, transaction
+from django.db.models import Exists, OuterRef, Q, QuerySet
+from django.utils import timezone
+from rest_framework.renderers import JSONRenderer
+
+from . import dossier, shards
+from .integrity import pk_bounds
+from .models import Accident, DossierRefresh, DriverLicense, InsurancePolicy, MaterializedDossier, Vehicle
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    'ENABLED': True,
+    'ACCIDENTS': dossier.DEFAULT_ACCIDENTS,
+    'INLINE_LIMIT': 100,
+    'CHUNK_SIZE': 500,
+}
+
+# Bump when the stored layout changes: older rows are then ignored until rebuilt
+SCHEMA_VERSION = 1
+
+ALL_SECTIONS = frozenset(dossier.SECTIONS)
+
+UPSERT_SQL = (
+    "INSERT INTO materialized_dossiers "
+    "(plate_number, vehicle_id, version, accidents_limit, expires_on, body, built_at) "
+    "VALUES (%s, %s, %s, %s, %s, %s, %s) "
+    "ON CONFLICT (plate_number) DO UPDATE SET "
+    "vehicle_id = excluded.vehicle_id, version = excluded.version, accidents_limit = excluded.accidents_limit, "
+    "expires_on = excluded.expires_on, body = excluded.body, built_at = excluded.built_at "
+    "WHERE materialized_dossiers.built_at <= excluded.built_at"
+)
+
+# What current() selects, for one plate; plain SQL since building the
+# queryset would cost more than running it
+LOOKUP_SQL = (
+    "SELECT d.body, d.accidents_limit FROM materialized_dossiers d "
+    "WHERE d.plate_number = %s AND d.version = %s AND d.accidents_limit >= %s AND d.body IS NOT NULL "
+    "AND (d.expires_on IS NULL OR d.expires_on > %s) "
+    "AND NOT EXISTS (SELECT 1 FROM dossier_refresh_queue q WHERE q.vehicle_id = d.vehicle_id)"
+)
+
+# DO UPDATE rather than DO NOTHING: the row lock is what makes a concurrent
+# refresh on PostgreSQL wait for this transaction
+QUEUE_SQL = (
+    "INSERT INTO dossier_refresh_queue (vehicle_id, queued_at) VALUES (%s, %s) "
+    "ON CONFLICT (vehicle_id) DO UPDATE SET queued_at = excluded.queued_at"
+)
+# WHERE keeps SQLite from reading ON CONFLICT as a join constraint
+QUEUE_SELECT_SQL = (
+    "INSERT INTO dossier_refresh_queue (vehicle_id, queued_at) "
+    "SELECT DISTINCT changed.vehicle_id, %s FROM ({}) AS changed WHERE changed.vehicle_id IS NOT NULL "
+    "ON CONFLICT (vehicle_id) DO UPDATE SET queued_at = excluded.queued_at"
+)
+
+_renderer = JSONRenderer()
+_stats = Counter()
+_drainers = {}
+
+
+def get_config():
+    config = dict(DEFAULTS)
+    config.update(getattr(settings, 'MATERIALIZED_DOSSIERS', {}))
+    return config
+
+
+def stats():
+    hits, misses = _stats['hits'], _stats['misses']
+    return {
+        'hits': hits,
+        'misses': misses,
+        'refreshed': _stats['refreshed'],
+        'hit_ratio': round(hits / (hits + misses), 4) if hits + misses else None,
+    }
+
+
+def current(using, today=None):
+    """Rows that may be served: this layout, not queued, not past ``expires_on``."""
+    today = today or timezone.localdate()
+    return (
+        MaterializedDossier.objects.using(using)
+        .filter(version=SCHEMA_VERSION, body__isnull=False)
+        .filter(Q(expires_on__isnull=True) | Q(expires_on__gt=today))
+        .exclude(Exists(DossierRefresh.objects.using(using).filter(vehicle_id=OuterRef('vehicle_id'))))
+    )
+
+
+def project(body, sections, accidents_limit):
+    """The JSON text of ``check_plate`` for ``sections`` cut from a stored full dossier."""
+    stored = json.loads(body)
+    result = {'plate': stored['plate']}
+    for section in dossier.SECTIONS:
+        if section in sections:
+            result[section] = stored[section]
+    if 'accidents' in result:
+        result['accidents'] = result['accidents'][:accidents_limit]
+    return _renderer.render(result).decode()
+
+
+def lookup(plate_norm, sections, accidents_limit):
+    """Dossier JSON text from the table, or None when there is no current row."""
+    config = get_config()
+    if not config['ENABLED'] or accidents_limit > config['ACCIDENTS']:
+        return None
+    connection = connections[shards.alias_for_plate(plate_norm)]
+    with connection.cursor() as cursor:
+        cursor.execute(LOOKUP_SQL, [
+            plate_norm, SCHEMA_VERSION, accidents_limit, connection.ops.adapt_datefield_value(timezone.localdate()),
+        ])
+        found = cursor.fetchone()
+    if found is None:
+        _stats['misses'] += 1
+        return None
+    _stats['hits'] += 1
+    body, stored_limit = found
+    if sections == ALL_SECTIONS and accidents_limit == stored_limit:
+        return body
+    return project(body, sections, accidents_limit)
+
+
+def expires_on(risk_data, today):
+    """The day an ``*_active`` flag of ``risk_data`` turns false, or None."""
+    if risk_data is None:
+        return None
+    ends = [
+        risk_data[key] + datetime.timedelta(days=1)
+        for key in ('osago_valid_to', 'kasko_valid_to')
+        if risk_data[key] is not None and risk_data[key] >= today
+    ]
+    return min(ends, default=None)
+
+
+def _rows(using, plates, built_at, accidents_limit):
+    """Upsert parameters for the dossiers of ``plates``, read after ``built_at``."""
+    connection = connections[using]
+    today = timezone.localdate()
+    return [
+        (
+            built['plate'], plate.vehicle_id, SCHEMA_VERSION, accidents_limit,
+            connection.ops.adapt_datefield_value(expires_on(built['risk'], today)),
+            _renderer.render(built).decode(),
+            connection.ops.adapt_datetimefield_value(built_at),
+        )
+        for plate, built in zip(plates, dossier.build_dossiers(plates, ALL_SECTIONS, accidents_limit, cached=False))
+    ]
+
+
+def _store(using, rows):
+    if rows:
+        with connections[using].cursor() as cursor:
+            cursor.executemany(UPSERT_SQL, rows)
+    return len(rows)
+
+
+def refresh(vehicle_ids, using):
+    """Rebuild the rows of ``vehicle_ids`` and take them off the queue; returns how many plates were stored."""
+    vehicle_ids = sorted({pk for pk in vehicle_ids if pk is not None})
+    if not vehicle_ids:
+        return 0
+    accidents_limit = get_config()['ACCIDENTS']
+    with transaction.atomic(using=using):
+        # Before any read: see the module docstring
+        DossierRefresh.objects.using(using).filter(vehicle_id__in=vehicle_ids).delete()
+        built_at = timezone.now()
+        plates = list(dossier.active_plates(ALL_SECTIONS, using).filter(vehicle_id__in=vehicle_ids))
+        stored = _store(using, _rows(using, plates, built_at, accidents_limit))
+        MaterializedDossier.objects.using(using).filter(vehicle_id__in=vehicle_ids, body__isnull=False).exclude(
+            pk__in=[plate.plate_number for plate in plates]
+        ).update(body=None, built_at=built_at)
+    _stats['refreshed'] += len(vehicle_ids)
+    return stored
+
+
+def drain(using, limit=None):
+    """Refresh queued vehicles, oldest first, up to ``limit``; returns how many were refreshed."""
+    chunk_size = get_config()['CHUNK_SIZE']
+    done = 0
+    while limit is None or done < limit:
+        size = chunk_size if limit is None else min(chunk_size, limit - done)
+        ids = list(
+            DossierRefresh.objects.using(using).order_by('queued_at', 'vehicle_id').values_list('vehicle_id', flat=True)[:size]
+        )
+        if not ids:
+            break
+        refresh(ids, using)
+        done += len(ids)
+    return done
+
+
+def queue_expired(using):
+    """Queue vehicles whose rows have passed ``expires_on``; returns how many were queued."""
+    return mark(using, MaterializedDossier.objects.using(using).filter(
+        expires_on__lte=timezone.localdate(), body__isnull=False,
+    ).values('vehicle_id'), drain_on_commit=False)
+
+
+def _drain_after_commit(using):
+    try:
+        drain(using, get_config()['INLINE_LIMIT'])
+    except Exception:
+        # The queue rows stay; lookups fall back to live assembly meanwhile
+        logger.exception('could not refresh materialized dossiers on %s', using)
+
+
+def mark(using, vehicles, drain_on_commit=True):
+    """
+    Queue vehicles for a refresh in the current transaction.
+
+    ``vehicles`` is an iterable of ids or a queryset of ``vehicle_id``
+    values, queued with one INSERT ... SELECT. Returns the rows written.
+    Does nothing while ``ENABLED`` is off: rebuild after turning it on.
+    """
+    if not get_config()['ENABLED']:
+        return 0
+    connection = connections[using]
+    queued_at = connection.ops.adapt_datetimefield_value(timezone.now())
+    with connection.cursor() as cursor:
+        if isinstance(vehicles, QuerySet):
+            sql, params = vehicles.query.get_compiler(using).as_sql()
+            cursor.execute(QUEUE_SELECT_SQL.format(sql), [queued_at, *params])
+            count = cursor.rowcount
+        else:
+            rows = [(pk, queued_at) for pk in {pk for pk in vehicles if pk is not None}]
+            if not rows:
+                return 0
+            cursor.executemany(QUEUE_SQL, rows)
+            count = len(rows)
+    if drain_on_commit:
+        callback = _drainers.setdefault(using, functools.partial(_drain_after_commit, using))
+        # One refresh per transaction however many rows it changed; per
+        # savepoint, since rolling one back drops the callbacks it added
+        savepoints = set(connection.savepoint_ids)
+        if not any(entry[0] == savepoints and entry[1] is callback for entry in connection.run_on_commit):
+            transaction.on_commit(callback, using=using)
+    return count
+
+
+def remember_vehicle(sender, instance, raw, using, **kwargs):
+    """``pre_save`` handler for plates, policies and accidents: an edit may move the row to another vehicle."""
+    instance._dossier_vehicle_before = None
+    if not raw and not instance._state.adding:
+        instance._dossier_vehicle_before = (
+            sender.objects.using(using).filter(pk=instance.pk).values_list('vehicle_id', flat=True).first()
+        )
+
+
+def vehicle_row_changed(sender, instance, using, **kwargs):
+    """``post_save``/``post_delete`` handler for ``Plate``, ``InsurancePolicy`` and ``Accident``."""
+    before = instance.__dict__.pop('_dossier_vehicle_before', None)
+    mark(using, [instance.vehicle_id, before])
+
+
+def vehicle_changed(sender, instance, using, **kwargs):
+    """``post_save``/``post_delete`` handler for ``Vehicle``."""
+    mark(using, [instance.pk])
+
+
+def owner_changed(sender, instance, using, **kwargs):
+    """``post_save``/``pre_delete`` handler for ``Owner`` (deleting it unlinks its vehicles)."""
+    mark(using, Vehicle.objects.using(using).filter(owner_id=instance.pk).values('vehicle_id'))
+
+
+def remember_license_owner(sender, instance, raw, using, **kwargs):
+    """``pre_save`` handler for ``DriverLicense``."""
+    instance._dossier_owner_before = None
+    if not raw and not instance._state.adding:
+        instance._dossier_owner_before = (
+            DriverLicense.objects.using(using).filter(pk=instance.pk).values_list('owner_id', flat=True).first()
+        )
+
+
+def license_changed(sender, instance, using, **kwargs):
+    """``post_save``/``post_delete`` handler for ``DriverLicense``."""
+    owners = {instance.owner_id, instance.__dict__.pop('_dossier_owner_before', None)} - {None}
+    mark(using, Vehicle.objects.using(using).filter(owner_id__in=owners).values('vehicle_id'))
+
+
+def insurer_changed(sender, instance, using, **kwargs):
+    """``post_save``/``pre_delete`` handler for ``Insurer``: its name is in every policy it issued."""
+    if not kwargs.get('created'):
+        mark(using, InsurancePolicy.objects.using(using).filter(insurer_id=instance.pk).values('vehicle_id'))
+
+
+def part_changed(sender, instance, using, **kwargs):
+    """``post_save``/``pre_delete`` handler for ``CarPart``."""
+    if not kwargs.get('created'):
+        mark(using, Accident.objects.using(using).filter(damaged_parts=instance.pk).values('vehicle_id'))
+
+
+def damaged_parts_changed(sender, instance, action, reverse, pk_set, using, **kwargs):
+    """``m2m_changed`` handler for ``Accident.damaged_parts``."""
+    if not reverse:
+        if action in ('post_add', 'post_remove', 'post_clear'):
+            mark(using, [instance.vehicle_id])
+    elif action == 'pre_clear':
+        part_changed(sender, instance, using)
+    elif action in ('post_add', 'post_remove') and pk_set:
+        mark(using, Accident.objects.using(using).filter(pk__in=pk_set).values('vehicle_id'))
+
+
+def rebuild_range(alias, lo, hi):
+    """Rebuild the rows of vehicles ``lo..hi`` without touching the queue; returns how many plates were stored."""
+    built_at = timezone.now()
+    plates = list(dossier.active_plates(ALL_SECTIONS, alias).filter(vehicle_id__gte=lo, vehicle_id__lte=hi))
+    rows = _rows(alias, plates, built_at, get_config()['ACCIDENTS'])
+    # Only writes in the transaction: a SQLite reader cannot wait to become a writer
+    with transaction.atomic(using=alias):
+        stored = _store(alias, rows)
+        MaterializedDossier.objects.using(alias).filter(
+            vehicle_id__range=(lo, hi), body__isnull=False, built_at__lt=built_at,
+        ).exclude(pk__in=[plate.plate_number for plate in plates]).update(body=None, built_at=built_at)
+    return stored
+
+
+def check_range(alias, lo, hi, max_samples=100):
+    """
+    Compare the rows of vehicles ``lo..hi`` with live assembly.
+
+    Queued vehicles are expected to differ and are skipped.
+    """
+    accidents_limit = get_config()['ACCIDENTS']
+    queued = set(
+        DossierRefresh.objects.using(alias).filter(vehicle_id__range=(lo, hi)).values_list('vehicle_id', flat=True)
+    )
+    stored = {
+        plate_number: (vehicle_id, body)
+        for plate_number, vehicle_id, body in current(alias).filter(vehicle_id__range=(lo, hi))
+        .values_list('plate_number', 'vehicle_id', 'body')
+    }
+    plates = [
+        plate for plate in dossier.active_plates(ALL_SECTIONS, alias).filter(vehicle_id__gte=lo, vehicle_id__lte=hi)
+        if plate.vehicle_id not in queued
+    ]
+    result = {'checked': len(plates), 'missing': [], 'mismatched': [], 'orphaned': []}
+    live = dossier.build_dossiers(plates, ALL_SECTIONS, accidents_limit, cached=False)
+    for plate, built in zip(plates, live):
+        found = stored.pop(plate.plate_number, None)
+        if found is None:
+            result['missing'].append((plate.plate_number, plate.vehicle_id))
+        elif found[1] != _renderer.render(built).decode():
+            result['mismatched'].append((plate.plate_number, plate.vehicle_id))
+    # Rows left over are current but their plate is no longer active on that vehicle
+    result['orphaned'] = [
+        (plate_number, vehicle_id) for plate_number, (vehicle_id, _) in stored.items() if vehicle_id not in queued
+    ]
+    counts = {key: len(result[key]) for key in ('missing', 'mismatched', 'orphaned')}
+    for key in counts:
+        result[key] = result[key][:max_samples]
+    result['counts'] = counts
+    return result
+
+
+def _init_worker():
+    import django
+    django.setup()  # no-op when forked from a configured parent
+
+
+def run_parallel(task, aliases, chunk_size=1000, workers=None, args=()):
+    """Run ``task(alias, lo, hi, *args)`` over vehicle id ranges in worker processes; yields ``(alias, result)``."""
+    workers = workers or min(4, os.cpu_count() or 1)
+    ranges = []
+    for alias in aliases:
+        lo, hi = pk_bounds(alias, 'vehicles', 'vehicle_id')
+        if lo is not None:
+            ranges += [(alias, start, min(start + chunk_size - 1, hi)) for start in range(lo, hi + 1, chunk_size)]
+    # Workers are forked: never hand them this process's connections
+    connections.close_all()
+    with ProcessPoolExecutor(workers, initializer=_init_worker) as pool:
+        futures = {pool.submit(task, alias, lo, hi, *args): alias for alias, lo, hi in ranges}
+        for future in as_completed(futures):
+            yield futures[future], future.result()
+
+
+def purge(using, before):
+    """
+    After a full rebuild started at ``before``: delete the rows it did not
+    write (released plates, deleted vehicles); returns how many went.
+    """
+    return MaterializedDossier.objects.using(using).filter(built_at__lt=before).delete()[0]
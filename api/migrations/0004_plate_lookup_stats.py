@@ -0,0 +1,25 @@
+# Generated by Django 4.2.7 on 2026-10-19 13:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0003_carpart_remove_accident_damage_details_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PlateLookupStat',
+            fields=[
+                ('plate_number', models.TextField(primary_key=True, serialize=False)),
+                ('lookups', models.BigIntegerField(default=0)),
+                ('last_lookup_at', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'db_table': 'plate_lookup_stats',
+                'indexes': [models.Index(fields=['-lookups'], name='plate_lookup_stats_hot')],
+            },
+        ),
+    ]
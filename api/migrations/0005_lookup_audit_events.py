@@ -0,0 +1,30 @@
+# Generated by Django 4.2.7 on 2026-10-19 13:19
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0004_plate_lookup_stats'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LookupAuditEvent',
+            fields=[
+                ('event_id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('occurred_at', models.DateTimeField()),
+                ('plate_number', models.TextField()),
+                ('client', models.TextField(help_text='X-Client-Id или пользователь')),
+                ('remote_addr', models.GenericIPAddressField(blank=True, null=True)),
+                ('endpoint', models.CharField(max_length=50)),
+                ('sections', models.TextField(blank=True, help_text='Запрошенные разделы досье')),
+                ('status_code', models.SmallIntegerField()),
+            ],
+            options={
+                'db_table': 'lookup_audit_events',
+                'indexes': [models.Index(fields=['plate_number', 'occurred_at'], name='audit_plate_time'), models.Index(fields=['client', 'occurred_at'], name='audit_client_time')],
+            },
+        ),
+    ]
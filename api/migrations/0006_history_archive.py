@@ -0,0 +1,47 @@
+# Generated by Django 4.2.7 on 2026-10-19 13:33
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0005_lookup_audit_events'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AccidentArchive',
+            fields=[
+                ('accident_id', models.BigIntegerField(primary_key=True, serialize=False)),
+                ('date', models.DateField()),
+                ('severity', models.CharField(blank=True, choices=[('minor', 'Minor'), ('moderate', 'Moderate'), ('severe', 'Severe'), ('total', 'Total')], max_length=10, null=True)),
+                ('location', models.TextField(blank=True, null=True)),
+                ('description', models.TextField(blank=True, null=True)),
+                ('fault_party', models.CharField(choices=[('owner', 'Owner'), ('other', 'Other'), ('unknown', 'Unknown')], default='unknown', max_length=10)),
+                ('damaged_part_ids', models.JSONField(blank=True, default=list)),
+                ('archived_at', models.DateTimeField(auto_now_add=True)),
+                ('vehicle', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='archived_accidents', to='api.vehicle')),
+            ],
+            options={
+                'db_table': 'accidents_archive',
+            },
+        ),
+        migrations.CreateModel(
+            name='PlateArchive',
+            fields=[
+                ('plate_id', models.BigIntegerField(primary_key=True, serialize=False)),
+                ('plate_number', models.TextField()),
+                ('region', models.TextField(blank=True, null=True)),
+                ('assigned_at', models.DateTimeField()),
+                ('released_at', models.DateTimeField()),
+                ('archived_at', models.DateTimeField(auto_now_add=True)),
+                ('vehicle', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='archived_plates', to='api.vehicle')),
+            ],
+            options={
+                'db_table': 'plates_archive',
+                'indexes': [models.Index(fields=['plate_number'], name='plates_archive_number')],
+            },
+        ),
+    ]
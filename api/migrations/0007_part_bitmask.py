@@ -0,0 +1,51 @@
+# Generated by Django 4.2.7 on 2026-10-19 13:37
+
+import api.fields
+from django.db import migrations, models
+from django.db.models import BigIntegerField, F, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+
+
+def fill_masks(apps, schema_editor):
+    using = schema_editor.connection.alias
+    CarPart = apps.get_model('api', 'CarPart')
+    Accident = apps.get_model('api', 'Accident')
+    Through = Accident.damaged_parts.through
+
+    # Name order, so shards loaded with the same catalog get the same bits
+    parts = list(CarPart.objects.using(using).order_by('name'))
+    if len(parts) > 63:
+        raise RuntimeError(f'{len(parts)} car parts do not fit a 63-bit mask')
+    for bit, part in enumerate(parts):
+        part.bit = bit
+    CarPart.objects.using(using).bulk_update(parts, ['bit'])
+
+    bits = (
+        Through.objects.using(using).filter(accident_id=OuterRef('pk'))
+        .values('accident_id')
+        .annotate(mask=Sum(Value(1, output_field=BigIntegerField()).bitleftshift(F('carpart__bit')),
+                           output_field=BigIntegerField()))
+        .values('mask')
+    )
+    Accident.objects.using(using).update(damaged_parts_mask=Coalesce(Subquery(bits), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0006_history_archive'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='accident',
+            name='damaged_parts_mask',
+            field=api.fields.PartMaskField(default=0, editable=False, help_text='Поврежденные детали битовой маской по CarPart.bit (синхронизируется с damaged_parts)'),
+        ),
+        migrations.AddField(
+            model_name='carpart',
+            name='bit',
+            field=models.PositiveSmallIntegerField(editable=False, help_text='Номер бита детали в Accident.damaged_parts_mask (назначается автоматически)', null=True, unique=True),
+        ),
+        migrations.RunPython(fill_masks, migrations.RunPython.noop, hints={'model_name': 'accident'}),
+    ]
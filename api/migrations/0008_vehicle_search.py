@@ -0,0 +1,58 @@
+# Generated by Django 4.2.7 on 2026-10-19 13:39
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def count_facets(apps, schema_editor):
+    using = schema_editor.connection.alias
+    Vehicle = apps.get_model('api', 'Vehicle')
+    VehicleFacetCount = apps.get_model('api', 'VehicleFacetCount')
+    rows = []
+    for facet in ('make', 'model', 'year', 'color'):
+        for value, vehicles in Vehicle.objects.using(using).values_list(facet).annotate(n=Count('*')).order_by():
+            rows.append(VehicleFacetCount(facet=facet, value='' if value is None else str(value), vehicles=vehicles))
+    VehicleFacetCount.objects.using(using).bulk_create(rows)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0007_part_bitmask'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='VehicleFacetCount',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('facet', models.CharField(max_length=10)),
+                ('value', models.TextField(blank=True, help_text='Значение фасета; пустая строка — не указано')),
+                ('vehicles', models.BigIntegerField(default=0)),
+            ],
+            options={
+                'db_table': 'vehicle_facet_counts',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='vehicle',
+            index=models.Index(fields=['make', 'model', 'vehicle_id'], name='vehicles_make_model'),
+        ),
+        migrations.AddIndex(
+            model_name='vehicle',
+            index=models.Index(fields=['make', 'year'], name='vehicles_make_year'),
+        ),
+        migrations.AddIndex(
+            model_name='vehicle',
+            index=models.Index(fields=['color', 'vehicle_id'], name='vehicles_color'),
+        ),
+        migrations.AddIndex(
+            model_name='vehicle',
+            index=models.Index(fields=['year', 'vehicle_id'], name='vehicles_year'),
+        ),
+        migrations.AddConstraint(
+            model_name='vehiclefacetcount',
+            constraint=models.UniqueConstraint(fields=('facet', 'value'), name='uq_vehicle_facet_value'),
+        ),
+        migrations.RunPython(count_facets, migrations.RunPython.noop, hints={'model_name': 'vehiclefacetcount'}),
+    ]
@@ -0,0 +1,66 @@
+# Generated by Django 4.2.7 on 2026-10-19 13:43
+
+from django.db import migrations, models
+from django.db.models import Count, Max, Q
+import django.db.models.deletion
+
+
+def summarize(apps, schema_editor):
+    using = schema_editor.connection.alias
+    Vehicle = apps.get_model('api', 'Vehicle')
+    VehicleRiskSummary = apps.get_model('api', 'VehicleRiskSummary')
+    accident_models = [apps.get_model('api', 'Accident'), apps.get_model('api', 'AccidentArchive')]
+    InsurancePolicy = apps.get_model('api', 'InsurancePolicy')
+
+    last_pk = 0
+    while True:
+        ids = list(Vehicle.objects.using(using).filter(pk__gt=last_pk).order_by('pk').values_list('pk', flat=True)[:5000])
+        if not ids:
+            return
+        rows = {pk: VehicleRiskSummary(vehicle_id=pk) for pk in ids}
+        for model in accident_models:
+            for vehicle_id, n, at_fault, last in (
+                model.objects.using(using).filter(vehicle_id__in=ids).values('vehicle_id')
+                .annotate(n=Count('*'), at_fault=Count('pk', filter=Q(fault_party='owner')), last=Max('date'))
+                .order_by().values_list('vehicle_id', 'n', 'at_fault', 'last')
+            ):
+                row = rows[vehicle_id]
+                row.accidents += n
+                row.at_fault_accidents += at_fault
+                row.last_accident_at = max(filter(None, [row.last_accident_at, last]), default=None)
+        for vehicle_id, osago, kasko in (
+            InsurancePolicy.objects.using(using).filter(vehicle_id__in=ids, status='active').values('vehicle_id')
+            .annotate(osago=Max('valid_to', filter=Q(type='OSAGO')), kasko=Max('valid_to', filter=Q(type='KASKO')))
+            .order_by().values_list('vehicle_id', 'osago', 'kasko')
+        ):
+            rows[vehicle_id].osago_valid_to = osago
+            rows[vehicle_id].kasko_valid_to = kasko
+        VehicleRiskSummary.objects.using(using).bulk_create(rows.values())
+        last_pk = ids[-1]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0008_vehicle_search'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='VehicleRiskSummary',
+            fields=[
+                ('vehicle', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='risk', serialize=False, to='api.vehicle')),
+                ('accidents', models.PositiveIntegerField(default=0, help_text='Всего ДТП, включая архивные')),
+                ('at_fault_accidents', models.PositiveIntegerField(default=0, help_text='ДТП по вине владельца')),
+                ('last_accident_at', models.DateField(blank=True, help_text='Дата последнего ДТП', null=True)),
+                ('osago_valid_to', models.DateField(blank=True, help_text='Окончание самого позднего активного полиса ОСАГО', null=True)),
+                ('kasko_valid_to', models.DateField(blank=True, help_text='Окончание самого позднего активного полиса КАСКО', null=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'db_table': 'vehicle_risk_summaries',
+                'indexes': [models.Index(fields=['-accidents', '-vehicle'], name='risk_accidents'), models.Index(fields=['-at_fault_accidents', '-vehicle'], name='risk_at_fault'), models.Index(fields=['-last_accident_at', '-vehicle'], name='risk_last_accident'), models.Index(fields=['osago_valid_to'], name='risk_osago'), models.Index(fields=['kasko_valid_to'], name='risk_kasko')],
+            },
+        ),
+        migrations.RunPython(summarize, migrations.RunPython.noop, hints={'model_name': 'vehiclerisksummary'}),
+    ]
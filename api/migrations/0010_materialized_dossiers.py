@@ -0,0 +1,40 @@
+# Generated by Django 4.2.7 on 2026-10-19 14:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0009_vehicle_risk'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MaterializedDossier',
+            fields=[
+                ('plate_number', models.TextField(primary_key=True, serialize=False)),
+                ('vehicle_id', models.BigIntegerField(db_index=True)),
+                ('version', models.PositiveSmallIntegerField(help_text='Версия формата досье (materialized.SCHEMA_VERSION)')),
+                ('accidents_limit', models.PositiveSmallIntegerField(help_text='Сколько последних ДТП сохранено')),
+                ('expires_on', models.DateField(blank=True, help_text='С этой даты меняется признак действия ОСАГО/КАСКО, досье устарело', null=True)),
+                ('body', models.TextField(blank=True, null=True)),
+                ('built_at', models.DateTimeField()),
+            ],
+            options={
+                'db_table': 'materialized_dossiers',
+                'indexes': [models.Index(fields=['expires_on'], name='materialized_expires')],
+            },
+        ),
+        migrations.CreateModel(
+            name='DossierRefresh',
+            fields=[
+                ('vehicle_id', models.BigIntegerField(primary_key=True, serialize=False)),
+                ('queued_at', models.DateTimeField()),
+            ],
+            options={
+                'db_table': 'dossier_refresh_queue',
+                'indexes': [models.Index(fields=['queued_at'], name='dossier_refresh_queued')],
+            },
+        ),
+    ]
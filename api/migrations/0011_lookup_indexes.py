@@ -0,0 +1,75 @@
+# Generated by Django 4.2.7 on 2026-10-19 14:48
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0010_materialized_dossiers'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='platearchive',
+            name='plates_archive_number',
+        ),
+        migrations.AlterField(
+            model_name='accident',
+            name='vehicle',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='accidents', to='api.vehicle'),
+        ),
+        migrations.AlterField(
+            model_name='accidentarchive',
+            name='vehicle',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='archived_accidents', to='api.vehicle'),
+        ),
+        migrations.AlterField(
+            model_name='driverlicense',
+            name='owner',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='driver_licenses', to='api.owner'),
+        ),
+        migrations.AlterField(
+            model_name='plate',
+            name='vehicle',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='plates', to='api.vehicle'),
+        ),
+        migrations.AlterField(
+            model_name='platearchive',
+            name='vehicle',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='archived_plates', to='api.vehicle'),
+        ),
+        migrations.AddIndex(
+            model_name='accident',
+            index=models.Index(fields=['vehicle', '-date', '-accident_id'], name='accidents_vehicle_date'),
+        ),
+        migrations.AddIndex(
+            model_name='accidentarchive',
+            index=models.Index(fields=['vehicle', '-date', '-accident_id'], name='accidents_archive_vehicle'),
+        ),
+        migrations.AddIndex(
+            model_name='carpart',
+            index=models.Index(fields=['category', 'name'], name='car_parts_ordering'),
+        ),
+        migrations.AddIndex(
+            model_name='driverlicense',
+            index=models.Index(fields=['owner', '-expires_at', '-license_id'], name='licenses_owner_expires'),
+        ),
+        migrations.AddIndex(
+            model_name='plate',
+            index=models.Index(fields=['vehicle', '-assigned_at'], name='plates_vehicle_assigned'),
+        ),
+        migrations.AddIndex(
+            model_name='plate',
+            index=models.Index(fields=['plate_number', '-assigned_at'], name='plates_number_assigned'),
+        ),
+        migrations.AddIndex(
+            model_name='platearchive',
+            index=models.Index(fields=['plate_number', '-assigned_at'], name='plates_archive_number'),
+        ),
+        migrations.AddIndex(
+            model_name='platearchive',
+            index=models.Index(fields=['vehicle', '-assigned_at'], name='plates_archive_vehicle'),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 4.2.7 on 2026-10-19 14:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0011_lookup_indexes'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='vehicle',
+            name='vehicles_make_year',
+        ),
+        migrations.AddIndex(
+            model_name='plate',
+            index=models.Index(condition=models.Q(('released_at__isnull', True)), fields=['region', 'vehicle'], name='plates_active_region'),
+        ),
+        migrations.AddIndex(
+            model_name='vehicle',
+            index=models.Index(fields=['make', 'vehicle_id'], name='vehicles_make'),
+        ),
+        migrations.AddIndex(
+            model_name='vehicle',
+            index=models.Index(fields=['make', 'year', 'vehicle_id'], name='vehicles_make_year'),
+        ),
+    ]
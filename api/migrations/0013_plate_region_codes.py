@@ -0,0 +1,35 @@
+# Generated by Django 4.2.7 on 2026-10-19 16:05
+
+from django.db import migrations
+from django.db.models.functions import Right
+
+# Plates loaded before the region code was taken from the number carry
+# free text ('Region7') or nothing in plates.region. The region filters of
+# search and export, and shard routing, read the code from the last two
+# digits of the number; store that instead. Numbers whose suffix is not a
+# region code (01-20) keep a lookup path, see api.kzplates.
+TWO_DIGITS = r'^[0-9]{2}$'
+ENDS_WITH_TWO_DIGITS = r'[0-9]{2}$'
+
+
+def backfill_regions(apps, schema_editor):
+    using = schema_editor.connection.alias
+    for name in ('Plate', 'PlateArchive'):
+        model = apps.get_model('api', name)
+        (
+            model.objects.using(using)
+            .exclude(region__regex=TWO_DIGITS)
+            .filter(plate_number__regex=ENDS_WITH_TWO_DIGITS)
+            .update(region=Right('plate_number', 2))
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0012_search_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_regions, migrations.RunPython.noop, hints={'model_name': 'plate'}),
+    ]
@@ -1,6 +1,8 @@
-from django.db import models
+from django.db import models, router, transaction
 from django.core.validators import RegexValidator
 
+from .fields import PartMaskField
+
 
 class Owner(models.Model):
     owner_id = models.BigAutoField(primary_key=True)
@@ -27,7 +29,7 @@ class DriverLicense(models.Model):
     ]
 
     license_id = models.BigAutoField(primary_key=True)
-    owner = models.ForeignKey(Owner, on_delete=models.CASCADE, related_name='driver_licenses')
+    owner = models.ForeignKey(Owner, on_delete=models.CASCADE, related_name='driver_licenses', db_index=False)
     number = models.TextField(unique=True)
     categories = models.TextField()
     issued_at = models.DateField()
@@ -36,6 +38,11 @@ class DriverLicense(models.Model):
 
     class Meta:
         db_table = 'driver_licenses'
+        # Latest license per owner (api.dossier, api.sqljson) is read off the
+        # front of this index; it also serves the owner foreign key
+        indexes = [
+            models.Index(fields=['owner', '-expires_at', '-license_id'], name='licenses_owner_expires'),
+        ]
 
     def __str__(self):
         return f"{self.number} ({self.owner.full_name})"
@@ -54,6 +61,15 @@ class Vehicle(models.Model):
 
     class Meta:
         db_table = 'vehicles'
+        # Filter combinations of /api/vehicles/search/; the trailing key keeps
+        # keyset pages (ORDER BY vehicle_id) an ordered index range scan
+        indexes = [
+            models.Index(fields=['make', 'vehicle_id'], name='vehicles_make'),
+            models.Index(fields=['make', 'model', 'vehicle_id'], name='vehicles_make_model'),
+            models.Index(fields=['make', 'year', 'vehicle_id'], name='vehicles_make_year'),
+            models.Index(fields=['color', 'vehicle_id'], name='vehicles_color'),
+            models.Index(fields=['year', 'vehicle_id'], name='vehicles_year'),
+        ]
 
     def __str__(self):
         return f"{self.make} {self.model} ({self.year}) - {self.vin}"
@@ -61,7 +77,7 @@ class Vehicle(models.Model):
 
 class Plate(models.Model):
     plate_id = models.BigAutoField(primary_key=True)
-    vehicle = models.ForeignKey(Vehicle, on_delete=models.CASCADE, related_name='plates')
+    vehicle = models.ForeignKey(Vehicle, on_delete=models.CASCADE, related_name='plates', db_index=False)
     plate_number = models.TextField()
     region = models.TextField(null=True, blank=True)
     assigned_at = models.DateTimeField(auto_now_add=True)
@@ -75,6 +91,15 @@ class Plate(models.Model):
                 name='uq_active_plate'
             )
         ]
+        # Histories (api.history) list assignments newest first; also serves
+        # the vehicle foreign key
+        indexes = [
+            models.Index(fields=['vehicle', '-assigned_at'], name='plates_vehicle_assigned'),
+            models.Index(fields=['plate_number', '-assigned_at'], name='plates_number_assigned'),
+            # Region filter of the vehicle search, in keyset (vehicle_id) order
+            models.Index(fields=['region', 'vehicle'], name='plates_active_region',
+                         condition=models.Q(released_at__isnull=True)),
+        ]
 
     def __str__(self):
         return f"{self.plate_number} ({self.vehicle})"
@@ -117,6 +142,11 @@ class InsurancePolicy(models.Model):
     def __str__(self):
         return f"{self.policy_number} ({self.type})"
 
+    def save(self, *args, **kwargs):
+        # The risk summary handlers (api.risk) commit or roll back with the row
+        with transaction.atomic(using=kwargs.get('using') or router.db_for_write(type(self), instance=self)):
+            super().save(*args, **kwargs)
+
 
 class CarPart(models.Model):
     """Модель для деталей автомобиля"""
@@ -124,14 +154,33 @@ class CarPart(models.Model):
     name = models.CharField(max_length=100, unique=True, help_text="Название детали")
     category = models.CharField(max_length=50, help_text="Категория детали")
     description = models.TextField(null=True, blank=True, help_text="Описание детали")
+    bit = models.PositiveSmallIntegerField(
+        unique=True, null=True, editable=False,
+        help_text="Номер бита детали в Accident.damaged_parts_mask (назначается автоматически)"
+    )
+
+    MAX_PARTS = 63  # bits of a signed 64-bit mask
 
     class Meta:
         db_table = 'car_parts'
         ordering = ['category', 'name']
+        indexes = [
+            models.Index(fields=['category', 'name'], name='car_parts_ordering'),
+        ]
 
     def __str__(self):
         return f"{self.name} ({self.category})"
 
+    def save(self, *args, **kwargs):
+        if self.bit is None:
+            used = CarPart.objects.using(kwargs.get('using') or router.db_for_write(CarPart, instance=self)).aggregate(
+                top=models.Max('bit')
+            )['top']
+            self.bit = 0 if used is None else used + 1
+            if self.bit >= self.MAX_PARTS:
+                raise ValueError(f'No free bit for car part {self.name!r}: at most {self.MAX_PARTS} parts')
+        super().save(*args, **kwargs)
+
 
 class Accident(models.Model):
     FAULT_CHOICES = [
@@ -147,16 +196,187 @@ class Accident(models.Model):
     ]
 
     accident_id = models.BigAutoField(primary_key=True)
-    vehicle = models.ForeignKey(Vehicle, on_delete=models.CASCADE, related_name='accidents')
+    vehicle = models.ForeignKey(Vehicle, on_delete=models.CASCADE, related_name='accidents', db_index=False)
     date = models.DateField()
     severity = models.CharField(max_length=10, choices=SEVERITY_CHOICES, null=True, blank=True)
     location = models.TextField(null=True, blank=True)
     description = models.TextField(null=True, blank=True)
     fault_party = models.CharField(max_length=10, choices=FAULT_CHOICES, default='unknown')
     damaged_parts = models.ManyToManyField(CarPart, blank=True, related_name='accidents', help_text="Поврежденные детали")
+    damaged_parts_mask = PartMaskField(
+        default=0, editable=False,
+        help_text="Поврежденные детали битовой маской по CarPart.bit (синхронизируется с damaged_parts)"
+    )
 
     class Meta:
         db_table = 'accidents'
+        # Last N accidents per vehicle, newest first (api.dossier, api.sqljson,
+        # api.history); also serves the vehicle foreign key
+        indexes = [
+            models.Index(fields=['vehicle', '-date', '-accident_id'], name='accidents_vehicle_date'),
+        ]
 
     def __str__(self):
         return f"Accident {self.accident_id} - {self.vehicle} ({self.date})"
+
+    def save(self, *args, **kwargs):
+        # The risk summary handlers (api.risk) commit or roll back with the row
+        with transaction.atomic(using=kwargs.get('using') or router.db_for_write(type(self), instance=self)):
+            super().save(*args, **kwargs)
+
+
+class PlateArchive(models.Model):
+    """Снятые с учёта номера, перенесённые из plates (см. команду archive_history)"""
+    plate_id = models.BigIntegerField(primary_key=True)
+    vehicle = models.ForeignKey(Vehicle, on_delete=models.CASCADE, related_name='archived_plates', db_index=False)
+    plate_number = models.TextField()
+    region = models.TextField(null=True, blank=True)
+    assigned_at = models.DateTimeField()
+    released_at = models.DateTimeField()
+    archived_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        db_table = 'plates_archive'
+        indexes = [
+            models.Index(fields=['plate_number', '-assigned_at'], name='plates_archive_number'),
+            models.Index(fields=['vehicle', '-assigned_at'], name='plates_archive_vehicle'),
+        ]
+
+    def __str__(self):
+        return f"{self.plate_number} ({self.assigned_at:%Y-%m-%d} - {self.released_at:%Y-%m-%d})"
+
+
+class AccidentArchive(models.Model):
+    """Старые аварии, перенесённые из accidents; детали хранятся списком part_id"""
+    accident_id = models.BigIntegerField(primary_key=True)
+    vehicle = models.ForeignKey(Vehicle, on_delete=models.CASCADE, related_name='archived_accidents', db_index=False)
+    date = models.DateField()
+    severity = models.CharField(max_length=10, choices=Accident.SEVERITY_CHOICES, null=True, blank=True)
+    location = models.TextField(null=True, blank=True)
+    description = models.TextField(null=True, blank=True)
+    fault_party = models.CharField(max_length=10, choices=Accident.FAULT_CHOICES, default='unknown')
+    damaged_part_ids = models.JSONField(default=list, blank=True)
+    archived_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        db_table = 'accidents_archive'
+        indexes = [
+            models.Index(fields=['vehicle', '-date', '-accident_id'], name='accidents_archive_vehicle'),
+        ]
+
+    def __str__(self):
+        return f"Archived accident {self.accident_id} ({self.date})"
+
+
+class VehicleRiskSummary(models.Model):
+    """Сводные показатели риска ТС, поддерживаются при изменении ДТП и полисов (см. api.risk)"""
+    vehicle = models.OneToOneField(Vehicle, on_delete=models.CASCADE, primary_key=True, related_name='risk')
+    accidents = models.PositiveIntegerField(default=0, help_text="Всего ДТП, включая архивные")
+    at_fault_accidents = models.PositiveIntegerField(default=0, help_text="ДТП по вине владельца")
+    last_accident_at = models.DateField(null=True, blank=True, help_text="Дата последнего ДТП")
+    osago_valid_to = models.DateField(null=True, blank=True, help_text="Окончание самого позднего активного полиса ОСАГО")
+    kasko_valid_to = models.DateField(null=True, blank=True, help_text="Окончание самого позднего активного полиса КАСКО")
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        db_table = 'vehicle_risk_summaries'
+        indexes = [
+            models.Index(fields=['-accidents', '-vehicle'], name='risk_accidents'),
+            models.Index(fields=['-at_fault_accidents', '-vehicle'], name='risk_at_fault'),
+            models.Index(fields=['-last_accident_at', '-vehicle'], name='risk_last_accident'),
+            models.Index(fields=['osago_valid_to'], name='risk_osago'),
+            models.Index(fields=['kasko_valid_to'], name='risk_kasko'),
+        ]
+
+    def __str__(self):
+        return f"Risk of {self.vehicle_id}: {self.accidents} accidents"
+
+
+class VehicleFacetCount(models.Model):
+    """Число ТС по значению фасета (марка, модель, год, цвет) для поиска без фильтров, см. api.search"""
+    facet = models.CharField(max_length=10)
+    value = models.TextField(blank=True, help_text="Значение фасета; пустая строка — не указано")
+    vehicles = models.BigIntegerField(default=0)
+
+    class Meta:
+        db_table = 'vehicle_facet_counts'
+        constraints = [
+            models.UniqueConstraint(fields=['facet', 'value'], name='uq_vehicle_facet_value'),
+        ]
+
+    def __str__(self):
+        return f"{self.facet}={self.value}: {self.vehicles}"
+
+
+class PlateLookupStat(models.Model):
+    """Накопленное число успешных проверок номера (пишется пакетами, см. api.stats)"""
+    plate_number = models.TextField(primary_key=True)
+    lookups = models.BigIntegerField(default=0)
+    last_lookup_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        db_table = 'plate_lookup_stats'
+        indexes = [
+            models.Index(fields=['-lookups'], name='plate_lookup_stats_hot'),
+        ]
+
+    def __str__(self):
+        return f"{self.plate_number}: {self.lookups}"
+
+
+class LookupAuditEvent(models.Model):
+    """Журнал обращений к персональным данным (кто и когда проверял номер)"""
+    event_id = models.BigAutoField(primary_key=True)
+    occurred_at = models.DateTimeField()
+    plate_number = models.TextField()
+    client = models.TextField(help_text="X-Client-Id или пользователь")
+    remote_addr = models.GenericIPAddressField(null=True, blank=True)
+    endpoint = models.CharField(max_length=50)
+    sections = models.TextField(blank=True, help_text="Запрошенные разделы досье")
+    status_code = models.SmallIntegerField()
+
+    class Meta:
+        db_table = 'lookup_audit_events'
+        indexes = [
+            models.Index(fields=['plate_number', 'occurred_at'], name='audit_plate_time'),
+            models.Index(fields=['client', 'occurred_at'], name='audit_client_time'),
+        ]
+
+    def __str__(self):
+        return f"{self.occurred_at} {self.client} -> {self.plate_number}"
+
+
+class MaterializedDossier(models.Model):
+    """Готовое досье действующего номера в JSON (см. api.materialized); пустое body — номер снят"""
+    plate_number = models.TextField(primary_key=True)
+    vehicle_id = models.BigIntegerField(db_index=True)
+    version = models.PositiveSmallIntegerField(help_text="Версия формата досье (materialized.SCHEMA_VERSION)")
+    accidents_limit = models.PositiveSmallIntegerField(help_text="Сколько последних ДТП сохранено")
+    expires_on = models.DateField(null=True, blank=True,
+                                  help_text="С этой даты меняется признак действия ОСАГО/КАСКО, досье устарело")
+    body = models.TextField(null=True, blank=True)
+    built_at = models.DateTimeField()
+
+    class Meta:
+        db_table = 'materialized_dossiers'
+        indexes = [
+            models.Index(fields=['expires_on'], name='materialized_expires'),
+        ]
+
+    def __str__(self):
+        return f"Dossier of {self.plate_number} ({self.built_at})"
+
+
+class DossierRefresh(models.Model):
+    """Очередь ТС, чьи готовые досье нужно пересобрать (пишется в транзакции изменения)"""
+    vehicle_id = models.BigIntegerField(primary_key=True)
+    queued_at = models.DateTimeField()
+
+    class Meta:
+        db_table = 'dossier_refresh_queue'
+        indexes = [
+            models.Index(fields=['queued_at'], name='dossier_refresh_queued'),
+        ]
+
+    def __str__(self):
+        return f"Refresh {self.vehicle_id} ({self.queued_at})"
@@ -0,0 +1,163 @@
+"""
+Damaged parts as a bitmask.
+
+``Accident.damaged_parts_mask`` mirrors the ``damaged_parts`` M2M with one
+bit per ``CarPart.bit``. The M2M stays the source of truth; the handlers
+below keep the mask in step on every ``add``/``remove``/``set``/``clear``
+and when a part is deleted. Bulk writes to the through table bypass
+``m2m_changed`` and must call ``refresh_masks`` afterwards.
+
+The part catalog is tiny and almost never changes, so each process keeps
+it in memory per database alias: dossiers decode masks without a query,
+and filtering by part is a bitwise predicate on ``accidents`` alone::
+
+    Accident.objects.filter(damaged_parts_mask__has_any=parts.mask_of(['Лобовое стекло']))
+
+A ``CarPart`` write in one worker must reach the others: the copy is
+tagged with a generation counter kept in the fragment cache
+(``FRAGMENT_CACHE['ALIAS']``), which every process re-reads at most every
+``CATALOG_CHECK`` seconds and rebuilds its copy when it moved.
+"""
+import threading
+import time
+
+from django.core.cache import caches
+from django.db import connections
+from django.db.models import BigIntegerField, F, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+
+from . import fragments
+from .models import Accident, CarPart
+
+Through = Accident.damaged_parts.through
+
+# Bump when the catalog layout changes (the cache may outlive a deploy)
+SCHEMA_VERSION = 1
+
+# {using: (generation, Catalog, checked_at)}
+_catalogs = {}
+_lock = threading.Lock()
+
+
+class Catalog:
+    def __init__(self, parts):
+        self.parts = sorted(parts, key=lambda part: (part.category, part.name))
+        self.by_pk = {part.part_id: part for part in self.parts}
+        self.by_name = {part.name: part for part in self.parts}
+
+    def decode(self, mask):
+        """Parts whose bits are set in ``mask``, in ``CarPart`` ordering."""
+        return [part for part in self.parts if part.bit is not None and mask >> part.bit & 1]
+
+
+def generation_key(using):
+    return f'parts:v{SCHEMA_VERSION}:{using}:generation'
+
+
+def generation(using, config=None):
+    """Shared catalog generation of shard ``using``; seeded with a time-based value when missing."""
+    cache = caches[(config or fragments.get_config())['ALIAS']]
+    key = generation_key(using)
+    value = cache.get(key)
+    if value is None:
+        cache.add(key, time.time_ns(), None)
+        value = cache.get(key)
+    return value
+
+
+def catalog(using='default'):
+    config = fragments.get_config()
+    entry = _catalogs.get(using)
+    if entry is not None and time.monotonic() - entry[2] < config['CATALOG_CHECK']:
+        return entry[1]
+    # Read the generation before the rows: a write in between bumps it
+    # again, so this copy is replaced at the next check
+    current = generation(using, config)
+    with _lock:
+        entry = _catalogs.get(using)
+        if entry is not None and entry[0] == current:
+            found = entry[1]
+        else:
+            found = Catalog(CarPart.objects.using(using).all())
+        _catalogs[using] = (current, found, time.monotonic())
+    return found
+
+
+def invalidate(using=None):
+    """Drop the catalog of ``using`` (all shards when None) in every worker."""
+    cache = caches[fragments.get_config()['ALIAS']]
+    with _lock:
+        aliases = list(connections) if using is None else [using]
+        for alias in aliases:
+            try:
+                cache.incr(generation_key(alias))
+            except ValueError:
+                cache.set(generation_key(alias), time.time_ns(), None)
+        if using is None:
+            _catalogs.clear()
+        else:
+            _catalogs.pop(using, None)
+
+
+def mask_of(parts, using='default'):
+    """Mask for ``parts``: ``CarPart`` instances, part ids or part names."""
+    found = catalog(using)
+    mask = 0
+    for part in parts:
+        if not isinstance(part, CarPart):
+            part = found.by_pk.get(part) if isinstance(part, int) else found.by_name.get(part)
+            if part is None:
+                raise ValueError('unknown car part')
+        mask |= 1 << part.bit
+    return mask
+
+
+def refresh_masks(using, accident_ids=None):
+    """Recompute masks from the through table in one UPDATE."""
+    # Each (accident, part) pair is unique, so a sum of distinct powers of two is their OR
+    bits = (
+        Through.objects.using(using).filter(accident_id=OuterRef('pk'))
+        .values('accident_id')
+        # A bigint 1: PostgreSQL shifts an int4 modulo 32, so bits 31+ would be lost
+        .annotate(mask=Sum(Value(1, output_field=BigIntegerField()).bitleftshift(F('carpart__bit')),
+                           output_field=BigIntegerField()))
+        .values('mask')
+    )
+    accidents = Accident.objects.using(using)
+    if accident_ids is not None:
+        accidents = accidents.filter(pk__in=accident_ids)
+    return accidents.update(damaged_parts_mask=Coalesce(Subquery(bits), 0))
+
+
+def sync_mask(sender, instance, action, reverse, pk_set, using, **kwargs):
+    """``m2m_changed`` handler for ``Accident.damaged_parts``."""
+    if action == 'pre_clear' and reverse:
+        # Clearing from the part side: remember who loses it before the rows go
+        instance._cleared_accident_ids = list(
+            Through.objects.using(using).filter(carpart_id=instance.pk).values_list('accident_id', flat=True)
+        )
+        return
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse:
+        refresh_masks(using, [instance.pk])
+        instance.damaged_parts_mask = (
+            Accident.objects.using(using).values_list('damaged_parts_mask', flat=True).get(pk=instance.pk)
+        )
+    elif action == 'post_clear':
+        refresh_masks(using, instance.__dict__.pop('_cleared_accident_ids', []))
+    elif pk_set:
+        refresh_masks(using, pk_set)
+
+
+def drop_part_bit(sender, instance, using, **kwargs):
+    """``pre_delete`` handler: the cascade on the through table sends no ``m2m_changed``."""
+    if instance.bit is not None:
+        Accident.objects.using(using).filter(damaged_parts_mask__has_any=1 << instance.bit).update(
+            damaged_parts_mask=F('damaged_parts_mask').bitand(~(1 << instance.bit))
+        )
+
+
+def catalog_changed(sender, using, **kwargs):
+    """``post_save`` / ``post_delete`` handler for ``CarPart``."""
+    invalidate(using)
@@ -0,0 +1,253 @@
+"""
+On-demand request profiling (``ProfilingMiddleware``, ``manage.py profile_lookups``).
+
+A request is profiled when it carries the ``X-Profile`` header with the
+configured ``TOKEN`` (or any value from a staff session), or when it is
+picked by ``SAMPLE_RATE``. It then runs under a CPU profiler
+(pyinstrument's sampling profiler when installed, else cProfile), with
+``tracemalloc`` tracing allocations and every SQL statement timed. The
+report splits the time between the database driver, the ORM, DRF (views,
+renderers) and this app's code, lists the hottest functions and the
+lines that allocated the most, and is written to ``DIRECTORY``, which
+keeps the last ``MAX_PROFILES`` reports. The response names the report
+in ``X-Profile-Id``.
+
+One request per process is profiled at a time; ``tracemalloc`` is
+process-wide, so allocations by other threads during it are counted too.
+Streaming responses are profiled up to the first byte only.
+"""
+import cProfile
+import io
+import itertools
+import logging
+import os
+import pstats
+import random
+import tempfile
+import threading
+import time
+import tracemalloc
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.db import connections
+from django.urls import Resolver404, resolve
+from django.utils.crypto import constant_time_compare
+
+try:
+    import pyinstrument
+except ImportError:
+    pyinstrument = None
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    'ENABLED': True,
+    'TOKEN': '',
+    'SAMPLE_RATE': 0.0,
+    'VIEWS': (),
+    'PROFILER': 'auto',
+    'MEMORY': True,
+    'TRACEMALLOC_FRAMES': 1,
+    'DIRECTORY': os.path.join(tempfile.gettempdir(), 'car_registry_profiles'),
+    'MAX_PROFILES': 50,
+    'TOP': 25,
+}
+
+HEADER = 'HTTP_X_PROFILE'
+
+# Where tottime is spent, by the first match in the source path (or, for
+# C functions, the function name: "<method 'execute' of 'sqlite3.Cursor' ...>")
+AREAS = (
+    ('database', ('sqlite3.', 'psycopg', 'CursorWrapper.execute')),
+    ('orm', (f'django{os.sep}db{os.sep}',)),
+    ('drf', (f'rest_framework{os.sep}',)),
+    ('app', (f'{os.sep}api{os.sep}',)),
+    ('django', (f'django{os.sep}',)),
+)
+
+_busy = threading.Lock()
+_sequence = itertools.count()
+
+
+def get_config():
+    config = dict(DEFAULTS)
+    config.update(getattr(settings, 'PROFILING', {}))
+    return config
+
+
+def area_of(filename, function):
+    source = function if filename == '~' else filename
+    for area, markers in AREAS:
+        if any(marker in source for marker in markers):
+            return area
+    return 'builtins' if filename == '~' else 'other'
+
+
+class Profile:
+    """A CPU profile, SQL timing and allocation snapshot of the code run inside ``with``."""
+
+    def __init__(self, profiler='auto', memory=True, frames=1):
+        # 'auto' and 'pyinstrument' sample when pyinstrument is installed
+        self.sampling = profiler != 'cprofile' and pyinstrument is not None
+        self.memory = memory
+        self.frames = frames
+        self.sql_count = 0
+        self.sql_time = 0.0
+        self.elapsed = 0.0
+        self.peak_memory = None
+        self.allocations = []
+        self._profiler = None
+        self._stack = None
+        self._traced = False
+
+    def _time_sql(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.sql_count += 1
+            self.sql_time += time.perf_counter() - started
+
+    def __enter__(self):
+        self._stack = ExitStack()
+        for alias in settings.DATABASES:
+            self._stack.enter_context(connections[alias].execute_wrapper(self._time_sql))
+        if self.memory:
+            self._traced = not tracemalloc.is_tracing()
+            if self._traced:
+                tracemalloc.start(self.frames)
+            tracemalloc.reset_peak()
+            self._before = tracemalloc.take_snapshot()
+        self._profiler = pyinstrument.Profiler(async_mode='disabled') if self.sampling else cProfile.Profile()
+        self._started = time.perf_counter()
+        if self.sampling:
+            self._profiler.start()
+        else:
+            self._profiler.enable()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.sampling:
+            self._profiler.stop()
+        else:
+            self._profiler.disable()
+        self.elapsed = time.perf_counter() - self._started
+        self._stack.close()
+        if self.memory:
+            self.peak_memory = tracemalloc.get_traced_memory()[1]
+            after = tracemalloc.take_snapshot()
+            self.allocations = after.compare_to(self._before, 'lineno')
+            if self._traced:
+                tracemalloc.stop()
+            self._before = None
+        return False
+
+    def areas(self):
+        """Seconds of tottime per area; empty for the sampling profiler."""
+        if self.sampling:
+            return {}
+        totals = dict.fromkeys([area for area, _ in AREAS] + ['builtins', 'other'], 0.0)
+        for (filename, _, function), (_, _, tottime, _, _) in pstats.Stats(self._profiler).stats.items():
+            totals[area_of(filename, function)] += tottime
+        return totals
+
+    def report(self, label='', top=25, sort='tottime', calls=1):
+        out = io.StringIO()
+        out.write(f"{label}\n" if label else '')
+        out.write(f"elapsed {self.elapsed * 1000:.1f} ms over {calls} call(s); "
+                  f"SQL {self.sql_count} statements, {self.sql_time * 1000:.1f} ms\n")
+        areas = self.areas()
+        if areas:
+            total = sum(areas.values()) or 1.0
+            out.write('time by area (tottime): ' + ', '.join(
+                f"{area} {seconds * 1000:.1f} ms ({seconds / total:.0%})" for area, seconds in areas.items() if seconds
+            ) + '\n')
+        if self.peak_memory is not None:
+            out.write(f"traced memory peak {self.peak_memory / 1024:.0f} KiB\n")
+        out.write('\n')
+        if self.sampling:
+            out.write(self._profiler.output_text(unicode=True, color=False))
+        else:
+            stats = pstats.Stats(self._profiler, stream=out)
+            stats.sort_stats(sort).print_stats(top)
+        if self.allocations:
+            out.write("\ntop allocations (net, by line):\n")
+            for stat in self.allocations[:top]:
+                out.write(f"  {stat}\n")
+        return out.getvalue()
+
+    def dump(self, path):
+        """Save the raw cProfile data (pstats format, e.g. for snakeviz)."""
+        if not self.sampling:
+            self._profiler.dump_stats(path)
+
+
+def save(profile, label, config):
+    """Write the report to the ring buffer; returns its id."""
+    directory = config['DIRECTORY']
+    os.makedirs(directory, exist_ok=True)
+    stem = f"{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}-{next(_sequence):06d}-{label}"
+    with open(os.path.join(directory, f'{stem}.txt'), 'w', encoding='utf-8') as f:
+        f.write(profile.report(label, config['TOP']))
+    profile.dump(os.path.join(directory, f'{stem}.prof'))
+
+    # Reports written within one clock tick share an mtime: this one sorts
+    # last among them, so it is never the one pruned, and the names order
+    # this process's others
+    reports = sorted(
+        (entry for entry in os.scandir(directory) if entry.name.endswith('.txt')),
+        key=lambda entry: (entry.stat().st_mtime, entry.name == f'{stem}.txt', entry.name),
+    )
+    for entry in reports[:max(0, len(reports) - config['MAX_PROFILES'])]:
+        for path in (entry.path, entry.path[:-len('.txt')] + '.prof'):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+    return stem
+
+
+def _url_name(request):
+    try:
+        return resolve(request.path_info).url_name
+    except Resolver404:
+        return None
+
+
+def wanted(request, config):
+    header = request.META.get(HEADER)
+    if header is not None:
+        if config['TOKEN'] and constant_time_compare(header, config['TOKEN']):
+            return True
+        user = getattr(request, 'user', None)
+        return bool(user is not None and user.is_staff)
+    if config['SAMPLE_RATE'] and random.random() < config['SAMPLE_RATE']:
+        return not config['VIEWS'] or _url_name(request) in config['VIEWS']
+    return False
+
+
+class ProfilingMiddleware:
+    """Profiles requests asked for with ``X-Profile`` or picked by ``SAMPLE_RATE``."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        config = get_config()
+        if not config['ENABLED'] or not wanted(request, config):
+            return self.get_response(request)
+        if not _busy.acquire(blocking=False):
+            return self.get_response(request)
+        try:
+            with Profile(config['PROFILER'], config['MEMORY'], config['TRACEMALLOC_FRAMES']) as profile:
+                response = self.get_response(request)
+            label = (request.resolver_match.url_name if request.resolver_match else None) or 'request'
+            try:
+                response['X-Profile-Id'] = save(profile, label, config)
+            except OSError:
+                # A full or read-only disk must not fail the request
+                logger.exception('could not save profile of %s', request.path)
+            return response
+        finally:
+            _busy.release()
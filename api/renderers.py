@@ -0,0 +1,112 @@
+"""
+MessagePack renderer and parser for internal callers.
+
+Dates travel as a 4-byte extension (days since 1970-01-01) and datetimes
+as the standard MessagePack timestamp extension, so neither side formats
+or parses ISO strings. ``unpackb`` decodes both back to ``date`` and
+``datetime`` objects.
+"""
+import datetime
+import json
+import struct
+import uuid
+from decimal import Decimal
+
+from django.core.serializers.json import DjangoJSONEncoder
+from rest_framework.exceptions import ParseError
+from rest_framework.parsers import BaseParser
+from rest_framework.renderers import BaseRenderer
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+MEDIA_TYPE = 'application/msgpack'
+STREAM_MEDIA_TYPE = 'application/msgpack-seq'
+DATE_EXT = 1
+EPOCH = datetime.date(1970, 1, 1)
+_DAYS = struct.Struct('>i')
+
+
+def _default(obj):
+    if isinstance(obj, datetime.datetime):
+        if obj.tzinfo is None:
+            obj = obj.replace(tzinfo=datetime.timezone.utc)
+        return msgpack.Timestamp.from_datetime(obj)
+    if isinstance(obj, datetime.date):
+        return msgpack.ExtType(DATE_EXT, _DAYS.pack((obj - EPOCH).days))
+    if isinstance(obj, (Decimal, uuid.UUID)):
+        return str(obj)
+    raise TypeError(f'Cannot serialize {type(obj).__name__} to MessagePack')
+
+
+def _ext_hook(code, data):
+    if code == DATE_EXT:
+        return EPOCH + datetime.timedelta(days=_DAYS.unpack(data)[0])
+    if code == -1:
+        return msgpack.Timestamp.from_bytes(data).to_datetime()
+    return msgpack.ExtType(code, data)
+
+
+def packb(data):
+    return msgpack.packb(data, default=_default, use_bin_type=True)
+
+
+def unpackb(payload):
+    # timestamp=3: msgpack decodes extension -1 itself, to Timestamp by default
+    return msgpack.unpackb(payload, ext_hook=_ext_hook, raw=False, timestamp=3)
+
+
+def unpacker(stream=None):
+    """Incremental decoder for a ``application/msgpack-seq`` stream."""
+    return msgpack.Unpacker(stream, ext_hook=_ext_hook, raw=False, timestamp=3)
+
+
+class MessagePackRenderer(BaseRenderer):
+    media_type = MEDIA_TYPE
+    format = 'msgpack'
+    charset = None
+    render_style = 'binary'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        return packb(data)
+
+
+class XMessagePackRenderer(MessagePackRenderer):
+    """Same encoding under the legacy ``application/x-msgpack`` type."""
+    media_type = 'application/x-msgpack'
+
+
+class MessagePackSequenceRenderer(MessagePackRenderer):
+    """Concatenated MessagePack objects, one per item of a list."""
+    media_type = STREAM_MEDIA_TYPE
+    format = 'msgpack-seq'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        return b''.join(packb(item) for item in data or [])
+
+
+class NDJSONRenderer(BaseRenderer):
+    """Newline-delimited JSON, one line per item of a list."""
+    media_type = 'application/x-ndjson'
+    format = 'ndjson'
+    charset = 'utf-8'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        return ''.join(json.dumps(item, cls=DjangoJSONEncoder) + '\n' for item in data or []).encode()
+
+
+class MessagePackParser(BaseParser):
+    media_type = MEDIA_TYPE
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        try:
+            return unpackb(stream.read())
+        except Exception as e:
+            raise ParseError(f'MessagePack parse error - {e}')
+
+
+STREAM_RENDERERS = [NDJSONRenderer] + ([MessagePackSequenceRenderer] if msgpack is not None else [])
@@ -0,0 +1,210 @@
+"""
+Bulk plate reassignment (re-plating waves, fleet transfers).
+
+``reassign`` takes ``(vin, new plate)`` pairs and validates them as a set:
+duplicates inside the batch, unknown VINs, plates routed to another shard
+than the vehicle, and new plates that are active on a vehicle outside the
+batch (the intent of ``uq_active_plate``, which SQLite cannot enforce for
+``released_at IS NULL``). Valid pairs are then written in chunked
+transactions: one ``UPDATE`` releases the chunk's current plates, one
+``bulk_create`` inserts the new ones. Pairs that hand a plate from one
+vehicle of the batch to another (swaps, chains) are kept in the same
+chunk, so the plate is released before it is reissued.
+
+Each chunk re-checks its new plates inside the transaction, so a plate
+issued concurrently since validation is reported rather than duplicated.
+The dossier cache is invalidated once per batch, not per row; the
+materialized dossiers of every vehicle in a chunk are queued for a
+refresh in its transaction (the bulk writes send no signals).
+"""
+import re
+
+from django.db import transaction
+from django.utils import timezone
+
+from . import cache as dossier_cache
+from . import kzplates, materialized, shards
+from .models import Plate, Vehicle
+
+VIN_RE = re.compile(r'^[A-HJ-NPR-Z0-9]{17}$')
+
+# Values per IN (...) while validating; SQLite binds at most 32766
+LOOKUP_CHUNK = 5000
+
+
+def _lookup(queryset, field, values, *columns):
+    values = list(values)
+    rows = []
+    for start in range(0, len(values), LOOKUP_CHUNK):
+        rows.extend(queryset.filter(**{f'{field}__in': values[start:start + LOOKUP_CHUNK]}).values_list(*columns))
+    return rows
+
+
+def _conflict(vin, plate, reason, **details):
+    return {'vin': vin, 'plate': plate, 'reason': reason, **details}
+
+
+def validate(pairs):
+    """
+    Split normalized ``(vin, plate)`` pairs into ``(accepted, unchanged, conflicts)``.
+    Plates must be canonical (``kzplates.parse``); others are ``invalid_plate``.
+
+    ``accepted`` is ``{alias: [assignment, ...]}`` where an assignment is a
+    dict with ``vin``, ``plate``, ``region``, ``vehicle_id`` and ``holder`` (the vehicle
+    of the batch currently carrying ``plate``, or None).
+    """
+    conflicts, unchanged = [], []
+    vin_counts, plate_counts = {}, {}
+    for vin, plate in pairs:
+        vin_counts[vin] = vin_counts.get(vin, 0) + 1
+        plate_counts[plate] = plate_counts.get(plate, 0) + 1
+
+    candidates = []
+    for vin, plate in pairs:
+        parsed, region = kzplates.parse(plate)
+        if not VIN_RE.match(vin):
+            conflicts.append(_conflict(vin, plate, 'invalid_vin'))
+        elif parsed != plate:
+            conflicts.append(_conflict(vin, plate, 'invalid_plate'))
+        elif vin_counts[vin] > 1:
+            conflicts.append(_conflict(vin, plate, 'duplicate_vin'))
+        elif plate_counts[plate] > 1:
+            conflicts.append(_conflict(vin, plate, 'duplicate_plate'))
+        else:
+            candidates.append((vin, plate, region))
+
+    vins = [vin for vin, _, _ in candidates]
+    located = {}
+    for alias, rows in shards.fan_out(
+        lambda alias: _lookup(Vehicle.objects.using(alias), 'vin', vins, 'vin', 'vehicle_id')
+    ).items():
+        for vin, vehicle_id in rows:
+            located[vin] = (alias, vehicle_id)
+
+    by_alias = {}
+    for vin, plate, region in candidates:
+        if vin not in located:
+            conflicts.append(_conflict(vin, plate, 'unknown_vin'))
+            continue
+        alias, vehicle_id = located[vin]
+        if shards.alias_for_region(region) != alias:
+            conflicts.append(_conflict(vin, plate, 'wrong_shard', vehicle_shard=alias))
+            continue
+        by_alias.setdefault(alias, []).append(
+            {'vin': vin, 'plate': plate, 'region': region, 'vehicle_id': vehicle_id, 'holder': None}
+        )
+
+    accepted = {}
+    for alias, assignments in by_alias.items():
+        active = Plate.objects.using(alias).filter(released_at__isnull=True)
+        vehicle_ids = [a['vehicle_id'] for a in assignments]
+        current = dict(_lookup(active, 'vehicle_id', vehicle_ids, 'vehicle_id', 'plate_number'))
+        holders = dict(_lookup(active, 'plate_number', [a['plate'] for a in assignments], 'plate_number', 'vehicle_id'))
+        pending = []
+        for assignment in assignments:
+            if current.get(assignment['vehicle_id']) == assignment['plate']:
+                unchanged.append({'vin': assignment['vin'], 'plate': assignment['plate']})
+            else:
+                assignment['holder'] = holders.get(assignment['plate'])
+                pending.append(assignment)
+        accepted[alias] = _drop_taken(pending, lambda a: a['holder'], conflicts)
+    return accepted, unchanged, conflicts
+
+
+def _drop_taken(assignments, holder_of, conflicts):
+    """
+    Assignments whose plate is free or held by a vehicle that gets a new
+    plate in the same batch; the others become ``plate_in_use`` conflicts,
+    repeatedly, since dropping one can strand the plate it was to free.
+    """
+    while True:
+        moving = {a['vehicle_id'] for a in assignments}
+        kept = []
+        for assignment in assignments:
+            holder = holder_of(assignment)
+            if holder is not None and holder not in moving:
+                conflicts.append(_conflict(assignment['vin'], assignment['plate'], 'plate_in_use',
+                                           holder_vehicle_id=holder))
+            else:
+                kept.append(assignment)
+        if len(kept) == len(assignments):
+            return kept
+        assignments = kept
+
+
+def chunks(assignments, chunk_size):
+    """
+    Chunks of at most ``chunk_size`` assignments (more only for one long
+    chain), never separating a plate's release from its reissue.
+    """
+    by_vehicle = {a['vehicle_id']: a for a in assignments}
+    parent = {vehicle_id: vehicle_id for vehicle_id in by_vehicle}
+
+    def find(vehicle_id):
+        while parent[vehicle_id] != vehicle_id:
+            parent[vehicle_id] = parent[parent[vehicle_id]]
+            vehicle_id = parent[vehicle_id]
+        return vehicle_id
+
+    for assignment in assignments:
+        holder = assignment['holder']
+        if holder is not None and holder in by_vehicle:
+            parent[find(assignment['vehicle_id'])] = find(holder)
+
+    groups = {}
+    for assignment in assignments:
+        groups.setdefault(find(assignment['vehicle_id']), []).append(assignment)
+    chunk = []
+    for group in groups.values():
+        if chunk and len(chunk) + len(group) > chunk_size:
+            yield chunk
+            chunk = []
+        chunk.extend(group)
+    if chunk:
+        yield chunk
+
+
+def _write_chunk(alias, chunk, conflicts):
+    """Release and reissue one chunk in a transaction; returns how many plates were issued."""
+    with transaction.atomic(using=alias):
+        plates = Plate.objects.using(alias)
+        holders = dict(
+            plates.filter(plate_number__in=[a['plate'] for a in chunk], released_at__isnull=True)
+            .values_list('plate_number', 'vehicle_id')
+        )
+        chunk = _drop_taken(chunk, lambda a: holders.get(a['plate']), conflicts)
+        now = timezone.now()
+        plates.filter(vehicle_id__in=[a['vehicle_id'] for a in chunk], released_at__isnull=True).update(released_at=now)
+        plates.bulk_create([
+            Plate(vehicle_id=a['vehicle_id'], plate_number=a['plate'], region=a['region'], assigned_at=now)
+            for a in chunk
+        ])
+        materialized.mark(alias, [a['vehicle_id'] for a in chunk])
+        return len(chunk)
+
+
+def reassign(pairs, chunk_size=1000, dry_run=False):
+    """
+    Give each vehicle its new plate; ``pairs`` are normalized ``(vin, plate)``.
+
+    Returns ``{'reassigned', 'unchanged', 'conflicts', 'chunks', 'dry_run'}``;
+    ``reassigned`` is a count, the others list the affected pairs.
+    """
+    accepted, unchanged, conflicts = validate(pairs)
+    reassigned = written_chunks = 0
+    if not dry_run:
+        for alias, assignments in accepted.items():
+            for chunk in chunks(assignments, chunk_size):
+                reassigned += _write_chunk(alias, chunk, conflicts)
+                written_chunks += 1
+        if reassigned:
+            dossier_cache.invalidate()
+    else:
+        reassigned = sum(len(assignments) for assignments in accepted.values())
+    return {
+        'reassigned': reassigned,
+        'unchanged': unchanged,
+        'conflicts': conflicts,
+        'chunks': written_chunks,
+        'dry_run': dry_run,
+    }
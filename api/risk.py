@@ -0,0 +1,198 @@
+"""
+Per-vehicle risk summary.
+
+``vehicle_risk_summaries`` holds what scoring needs per vehicle: accident
+count (live and archived), at-fault count (``fault_party == 'owner'``),
+last accident date and the end date of the latest active OSAGO and KASKO
+policy. "Has active OSAGO" is then ``osago_valid_to >= today`` on an
+indexed column, which stays true to the calendar without any write when a
+policy runs out.
+
+The signal handlers below keep the row current inside the transaction
+that changes the accident or policy (``Accident.save`` and
+``InsurancePolicy.save`` are atomic; deletes already are). A new accident
+is an increment; edits and deletes recount that vehicle (and the previous
+one when an accident or policy moves to another vehicle). Moving an
+accident to the archive leaves the totals alone. Bulk writes bypass the
+handlers; ``manage.py rebuild_vehicle_risk`` recounts everything.
+"""
+from django.db import connections
+from django.db.models import Count, Max, Q
+from django.utils import timezone
+
+from .models import Accident, AccidentArchive, InsurancePolicy, Vehicle, VehicleRiskSummary
+
+AT_FAULT = 'owner'
+
+INCREMENT_SQL = (
+    "INSERT INTO vehicle_risk_summaries (vehicle_id, accidents, at_fault_accidents, last_accident_at, updated_at) "
+    "VALUES (%s, 1, %s, %s, %s) "
+    "ON CONFLICT (vehicle_id) DO UPDATE SET "
+    "accidents = vehicle_risk_summaries.accidents + 1, "
+    "at_fault_accidents = vehicle_risk_summaries.at_fault_accidents + excluded.at_fault_accidents, "
+    "last_accident_at = CASE WHEN vehicle_risk_summaries.last_accident_at >= excluded.last_accident_at "
+    "THEN vehicle_risk_summaries.last_accident_at ELSE excluded.last_accident_at END, "
+    "updated_at = excluded.updated_at"
+)
+
+ACCIDENT_FIELDS = ('accidents', 'at_fault_accidents', 'last_accident_at')
+POLICY_FIELDS = ('osago_valid_to', 'kasko_valid_to')
+
+
+def risk_data(summary):
+    if summary is None:
+        return None
+    today = timezone.localdate()
+    return {
+        'accidents': summary.accidents,
+        'at_fault_accidents': summary.at_fault_accidents,
+        'last_accident_at': summary.last_accident_at,
+        'osago_active': summary.osago_valid_to is not None and summary.osago_valid_to >= today,
+        'osago_valid_to': summary.osago_valid_to,
+        'kasko_active': summary.kasko_valid_to is not None and summary.kasko_valid_to >= today,
+        'kasko_valid_to': summary.kasko_valid_to,
+    }
+
+
+def summaries_by_vehicle(vehicle_ids, using):
+    """``{vehicle_id: risk data}``; None for vehicles without a summary yet."""
+    found = VehicleRiskSummary.objects.using(using).in_bulk(vehicle_ids)
+    return {vehicle_id: risk_data(found.get(vehicle_id)) for vehicle_id in vehicle_ids}
+
+
+def accident_totals(vehicle_ids, using):
+    """Accident fields recounted from ``accidents`` plus ``accidents_archive``."""
+    totals = {vehicle_id: {'accidents': 0, 'at_fault_accidents': 0, 'last_accident_at': None} for vehicle_id in vehicle_ids}
+    for model in (Accident, AccidentArchive):
+        rows = (
+            model.objects.using(using).filter(vehicle_id__in=vehicle_ids)
+            .values('vehicle_id')
+            .annotate(n=Count('*'), at_fault=Count('pk', filter=Q(fault_party=AT_FAULT)), last=Max('date'))
+            .order_by()
+        )
+        for row in rows:
+            total = totals[row['vehicle_id']]
+            total['accidents'] += row['n']
+            total['at_fault_accidents'] += row['at_fault']
+            if total['last_accident_at'] is None or row['last'] > total['last_accident_at']:
+                total['last_accident_at'] = row['last']
+    return totals
+
+
+def policy_totals(vehicle_ids, using):
+    """Policy fields recounted from ``insurance_policies``."""
+    totals = {vehicle_id: {'osago_valid_to': None, 'kasko_valid_to': None} for vehicle_id in vehicle_ids}
+    rows = (
+        InsurancePolicy.objects.using(using).filter(vehicle_id__in=vehicle_ids, status='active')
+        .values('vehicle_id')
+        .annotate(
+            osago_valid_to=Max('valid_to', filter=Q(type='OSAGO')),
+            kasko_valid_to=Max('valid_to', filter=Q(type='KASKO')),
+        )
+        .order_by()
+    )
+    for row in rows:
+        totals[row.pop('vehicle_id')].update(row)
+    return totals
+
+
+def recount(vehicle_ids, using, fields, create=True):
+    """Recount ``fields`` for a few vehicles; ``create=False`` only updates existing rows."""
+    vehicle_ids = [vehicle_id for vehicle_id in vehicle_ids if vehicle_id is not None]
+    values = {vehicle_id: {} for vehicle_id in vehicle_ids}
+    if set(fields) & set(ACCIDENT_FIELDS):
+        for vehicle_id, total in accident_totals(vehicle_ids, using).items():
+            values[vehicle_id].update(total)
+    if set(fields) & set(POLICY_FIELDS):
+        for vehicle_id, total in policy_totals(vehicle_ids, using).items():
+            values[vehicle_id].update(total)
+    for vehicle_id, changes in values.items():
+        updated = VehicleRiskSummary.objects.using(using).filter(vehicle_id=vehicle_id).update(
+            updated_at=timezone.now(), **changes
+        )
+        if not updated and create:
+            VehicleRiskSummary.objects.using(using).create(vehicle_id=vehicle_id, **changes)
+
+
+def rebuild(using, chunk_size=5000):
+    """Recount every vehicle on one shard in keyset chunks; returns the count."""
+    done = 0
+    last_pk = 0
+    while True:
+        ids = list(
+            Vehicle.objects.using(using).filter(pk__gt=last_pk).order_by('pk').values_list('pk', flat=True)[:chunk_size]
+        )
+        if not ids:
+            return done
+        accidents = accident_totals(ids, using)
+        policies = policy_totals(ids, using)
+        VehicleRiskSummary.objects.using(using).bulk_create(
+            [VehicleRiskSummary(vehicle_id=pk, **accidents[pk], **policies[pk]) for pk in ids],
+            update_conflicts=True,
+            unique_fields=['vehicle'],
+            update_fields=list(ACCIDENT_FIELDS + POLICY_FIELDS) + ['updated_at'],
+        )
+        last_pk = ids[-1]
+        done += len(ids)
+
+
+def vehicle_created(sender, instance, created, raw, using, **kwargs):
+    """``post_save`` handler for ``Vehicle``: every vehicle gets a zero row."""
+    if created and not raw:
+        VehicleRiskSummary.objects.using(using).get_or_create(vehicle_id=instance.pk)
+
+
+def remember_accident(sender, instance, raw, using, **kwargs):
+    """``pre_save`` handler for ``Accident``: an edit may move it to another vehicle."""
+    instance._risk_vehicle_before = None
+    if not raw and not instance._state.adding:
+        instance._risk_vehicle_before = (
+            Accident.objects.using(using).filter(pk=instance.pk).values_list('vehicle_id', flat=True).first()
+        )
+
+
+def accident_saved(sender, instance, created, raw, using, **kwargs):
+    """``post_save`` handler for ``Accident``."""
+    before = instance.__dict__.pop('_risk_vehicle_before', None)
+    if raw:
+        return
+    if created:
+        connection = connections[using]
+        with connection.cursor() as cursor:
+            cursor.execute(INCREMENT_SQL, [
+                instance.vehicle_id,
+                int(instance.fault_party == AT_FAULT),
+                connection.ops.adapt_datefield_value(instance.date),
+                connection.ops.adapt_datetimefield_value(timezone.now()),
+            ])
+    else:
+        recount({instance.vehicle_id, before}, using, ACCIDENT_FIELDS)
+
+
+def accident_deleted(sender, instance, using, **kwargs):
+    """``post_delete`` handler for ``Accident``."""
+    if AccidentArchive.objects.using(using).filter(pk=instance.pk).exists():
+        return  # moved to the archive, still counted
+    # No new rows here: the vehicle itself may be going away in this cascade
+    recount([instance.vehicle_id], using, ACCIDENT_FIELDS, create=False)
+
+
+def remember_policy(sender, instance, raw, using, **kwargs):
+    """``pre_save`` handler for ``InsurancePolicy``: an edit may move it to another vehicle."""
+    instance._risk_vehicle_before = None
+    if not raw and not instance._state.adding:
+        instance._risk_vehicle_before = (
+            InsurancePolicy.objects.using(using).filter(pk=instance.pk).values_list('vehicle_id', flat=True).first()
+        )
+
+
+def policy_saved(sender, instance, raw, using, **kwargs):
+    """``post_save`` handler for ``InsurancePolicy``."""
+    before = instance.__dict__.pop('_risk_vehicle_before', None)
+    if not raw:
+        recount({instance.vehicle_id, before}, using, POLICY_FIELDS)
+
+
+def policy_deleted(sender, instance, using, **kwargs):
+    """``post_delete`` handler for ``InsurancePolicy``."""
+    recount([instance.vehicle_id], using, POLICY_FIELDS, create=False)
@@ -0,0 +1,39 @@
+from . import shards
+
+
+class RegionShardRouter:
+    """
+    Keeps registry tables on every shard and everything else on ``default``.
+
+    Reads and writes follow the database of the instance involved; code
+    that starts a query without an instance picks the shard explicitly with
+    ``.using(shards.alias_for_plate(...))``.
+    """
+
+    def _is_registry(self, model):
+        return model._meta.app_label == 'api' and (
+            model._meta.model_name in shards.SHARDED_MODELS or model._meta.model_name in shards.REFERENCE_MODELS
+        )
+
+    def db_for_read(self, model, **hints):
+        instance = hints.get('instance')
+        if instance is not None and self._is_registry(model) and instance._state.db:
+            return instance._state.db
+        return None
+
+    db_for_write = db_for_read
+
+    def allow_relation(self, obj1, obj2, **hints):
+        if obj1._state.db and obj2._state.db:
+            return obj1._state.db == obj2._state.db
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if db == 'default':
+            return True
+        if db not in shards.aliases():
+            return None
+        # Shard-only databases hold just the registry tables
+        return app_label == 'api' and (
+            model_name in shards.SHARDED_MODELS or model_name in shards.REFERENCE_MODELS
+        )
@@ -0,0 +1,369 @@
+"""
+Faceted vehicle search.
+
+Filters map onto composite indexes that end in ``vehicle_id`` (on
+``vehicles``, and on active ``plates`` for the region), so a page is read
+in key order straight off an index instead of sorting every match. A year
+range is split into one such branch per year. Pages are keyset pages
+(``vehicle_id > last seen``) kept per shard in an opaque cursor, so a deep
+page costs the same as the first one.
+
+Facet counts for the unfiltered registry come from ``vehicle_facet_counts``,
+which the ``Vehicle`` signal handlers below keep current as vehicles are
+saved and deleted. With filters, the counts are one grouped
+``UNION ALL`` query over at most ``FACET_SCAN_LIMIT`` matching vehicles per
+shard. Bulk writes (``bulk_create``, ``QuerySet.update``) bypass the
+handlers; run ``manage.py rebuild_vehicle_facets`` afterwards.
+"""
+import base64
+import binascii
+import datetime
+import json
+from collections import Counter
+
+from django.db import connections, transaction
+from django.db.models import CharField, Count, Q, TextField, Value
+from django.db.models.expressions import RawSQL
+from django.db.models.functions import Cast
+from django.utils import timezone
+
+from . import kzplates, shards
+from .dossier import owner_data, vehicle_data
+from .models import Plate, Vehicle, VehicleFacetCount, VehicleRiskSummary
+from .risk import risk_data
+
+FACETS = ('make', 'model', 'year', 'color')
+DEFAULT_LIMIT = 50
+MAX_LIMIT = 200
+FACET_VALUES = 20
+# Filtered facets count the first this many matches per shard (in
+# vehicle_id order); the response says when the counts were capped
+FACET_SCAN_LIMIT = 10000
+# A year range wider than this is not split per year
+MAX_YEAR_BRANCHES = 100
+
+FILTERS = {
+    'make': 'make',
+    'model': 'model',
+    'color': 'color',
+    'year': 'year',
+    'iin': 'owner__iin',
+    'year_min': 'year__gte',
+    'year_max': 'year__lte',
+    'min_accidents': 'risk__accidents__gte',
+    'min_at_fault': 'risk__at_fault_accidents__gte',
+    'accident_since': 'risk__last_accident_at__gte',
+}
+INT_FILTERS = {'year', 'year_min', 'year_max', 'min_accidents', 'min_at_fault'}
+DATE_FILTERS = {'accident_since'}
+# Active policy of that type, see api.risk
+POLICY_FILTERS = {'osago': 'risk__osago_valid_to', 'kasko': 'risk__kasko_valid_to'}
+
+# Sort keys besides the default vehicle_id; all descending, ties by vehicle_id
+SORTS = {
+    'accidents': 'risk__accidents',
+    'at_fault': 'risk__at_fault_accidents',
+    'last_accident': 'risk__last_accident_at',
+}
+
+# Separate subqueries: SQLite answers a lone MIN or MAX from the index
+YEAR_BOUNDS_SQL = 'SELECT (SELECT MIN(year) FROM vehicles), (SELECT MAX(year) FROM vehicles)'
+
+UPSERT_SQL = (
+    "INSERT INTO vehicle_facet_counts (facet, value, vehicles) VALUES (%s, %s, %s) "
+    "ON CONFLICT (facet, value) DO UPDATE SET vehicles = vehicle_facet_counts.vehicles + excluded.vehicles"
+)
+
+
+def encode_cursor(cursor):
+    return base64.urlsafe_b64encode(json.dumps(cursor, separators=(',', ':')).encode()).decode()
+
+
+def decode_cursor(token, sort=None):
+    """
+    ``{alias: last vehicle_id}``, or ``{alias: [last sort value, last
+    vehicle_id]}`` when sorting by a risk field.
+    """
+    if not token:
+        return {}
+    try:
+        cursor = json.loads(base64.urlsafe_b64decode(token.encode()))
+    except (ValueError, binascii.Error):
+        raise ValueError('invalid cursor')
+    if sort is None:
+        valid = isinstance(cursor, dict) and all(isinstance(value, int) for value in cursor.values())
+    else:
+        valid = isinstance(cursor, dict) and all(
+            isinstance(value, list) and len(value) == 2 and isinstance(value[1], int) for value in cursor.values()
+        )
+    if not valid:
+        raise ValueError('invalid cursor')
+    return cursor
+
+
+def parse_params(params):
+    """
+    Read search query params; returns ``(filters, sort, cursor, limit, facets)``.
+
+    Raises ValueError with a client-facing message on bad input.
+    """
+    filters = {}
+    for name in list(FILTERS) + list(POLICY_FILTERS) + ['region']:
+        value = (params.get(name) or '').strip()
+        if not value:
+            continue
+        if name in INT_FILTERS:
+            try:
+                value = int(value)
+            except ValueError:
+                raise ValueError(f'{name} must be an integer')
+        elif name in DATE_FILTERS:
+            try:
+                value = datetime.date.fromisoformat(value)
+            except ValueError:
+                raise ValueError(f'{name} must be a date (YYYY-MM-DD)')
+        elif name in POLICY_FILTERS:
+            value = _flag(value)
+            if value is None:
+                raise ValueError(f'{name} must be true or false')
+        elif name == 'region' and value not in kzplates.REGIONS:
+            raise ValueError('region must be a region code from 01 to 20')
+        filters[name] = value
+
+    sort = params.get('sort') or None
+    if sort is not None and sort not in SORTS:
+        raise ValueError(f"sort must be one of: {', '.join(SORTS)}")
+
+    try:
+        limit = int(params.get('limit', DEFAULT_LIMIT))
+    except ValueError:
+        raise ValueError('limit must be an integer')
+    if not 1 <= limit <= MAX_LIMIT:
+        raise ValueError(f'limit must be between 1 and {MAX_LIMIT}')
+
+    facets = _flag(params.get('facets', '1')) is not False
+    return filters, sort, decode_cursor(params.get('cursor'), sort), limit, facets
+
+
+def _flag(value):
+    value = value.lower()
+    if value in ('1', 'true', 'yes'):
+        return True
+    if value in ('0', 'false', 'no'):
+        return False
+    return None
+
+
+def keyset_field(filters):
+    """Column the keyset order follows: the region filter pages through active plates."""
+    return 'plates__vehicle_id' if 'region' in filters else 'vehicle_id'
+
+
+def filter_vehicles(filters, using, after=None):
+    """Matching vehicles, only those with ``vehicle_id > after`` if given."""
+    conditions = {FILTERS[name]: value for name, value in filters.items() if name in FILTERS}
+    if 'region' in filters:
+        # Joined rather than EXISTS, so the partial index on active plates
+        # (region, vehicle_id) drives the page; the conditions go into one
+        # filter() call to share the join
+        conditions.update({'plates__region': filters['region'], 'plates__released_at__isnull': True})
+    if after is not None:
+        conditions[f'{keyset_field(filters)}__gt'] = after
+    queryset = Vehicle.objects.using(using).filter(**conditions)
+    today = timezone.localdate()
+    for name, field in POLICY_FILTERS.items():
+        if name in filters:
+            active = Q(**{f'{field}__gte': today})
+            queryset = queryset.filter(active if filters[name] else ~active)
+    return queryset
+
+
+def _branches(filters, using):
+    """
+    ``filters`` as a list of filter sets whose union is the same: a year
+    range becomes one exact year per branch, each read in key order off an
+    index ending in ``vehicle_id``. Under a region filter the plates index
+    drives the page and the year range is checked row by row instead.
+    """
+    if 'region' in filters or ('year_min' not in filters and 'year_max' not in filters):
+        return [filters]
+    with connections[using].cursor() as cursor:
+        cursor.execute(YEAR_BOUNDS_SQL)
+        lowest, highest = cursor.fetchone()
+    if lowest is None:
+        return [filters]
+    lowest = max(lowest, filters.get('year_min', lowest))
+    highest = min(highest, filters.get('year_max', highest))
+    if highest - lowest >= MAX_YEAR_BRANCHES:
+        return [filters]
+    rest = {name: value for name, value in filters.items() if name not in ('year_min', 'year_max')}
+    return [dict(rest, year=year) for year in range(lowest, highest + 1)]
+
+
+def first_ids(filters, using, after, limit):
+    """``(sql, params)`` selecting the first ``limit`` matching vehicle_ids after ``after``, in order."""
+    key = keyset_field(filters)
+    parts = [
+        filter_vehicles(branch, using, after).order_by(key).values_list('vehicle_id')[:limit].query.sql_with_params()
+        for branch in _branches(filters, using)
+    ]
+    if not parts:
+        return 'SELECT NULL WHERE 1 = 0', ()
+    if len(parts) == 1:
+        return parts[0]
+    sql = ' UNION ALL '.join(f'SELECT * FROM ({sql}) AS branch{i}' for i, (sql, _) in enumerate(parts))
+    return f'{sql} ORDER BY 1 LIMIT {int(limit)}', tuple(param for _, params in parts for param in params)
+
+
+def _summary(vehicle):
+    try:
+        return vehicle.risk
+    except VehicleRiskSummary.DoesNotExist:
+        return None
+
+
+def _json_value(value):
+    return value.isoformat() if isinstance(value, datetime.date) else value
+
+
+def search(filters, cursor, limit, sort=None):
+    """One page of matching vehicles across shards; returns ``(results, next_cursor)``."""
+    field = SORTS.get(sort)
+
+    def page(alias):
+        if field is None:
+            # Keys first, off the filter indexes; then the page's rows by key.
+            # A vehicle has one active plate ('multiple_active_plates' in
+            # api.integrity), so the region join repeats none
+            sql, params = first_ids(filters, alias, cursor.get(alias), limit + 1)
+            with connections[alias].cursor() as db_cursor:
+                db_cursor.execute(sql, params)
+                ids = list(dict.fromkeys(row[0] for row in db_cursor.fetchall()))
+            found = Vehicle.objects.using(alias).select_related('owner', 'risk').in_bulk(ids)
+            vehicles = [found[pk] for pk in ids if pk in found]
+        else:
+            queryset = filter_vehicles(filters, alias).select_related('owner', 'risk')
+            queryset = queryset.filter(**{f'{field}__isnull': False})
+            if alias in cursor:
+                value, after = cursor[alias]
+                queryset = queryset.filter(Q(**{f'{field}__lt': value}) | Q(**{field: value, 'vehicle_id__lt': after}))
+            queryset = queryset.order_by(f'-{field}', '-vehicle_id')
+            vehicles = list(queryset[:limit + 1])
+        plates = dict(
+            Plate.objects.using(alias)
+            .filter(vehicle_id__in=[vehicle.vehicle_id for vehicle in vehicles], released_at__isnull=True)
+            .values_list('vehicle_id', 'plate_number')
+        )
+        rows = []
+        for vehicle in vehicles:
+            summary = _summary(vehicle)
+            key = vehicle.vehicle_id if field is None else (getattr(summary, field.split('__')[1]), vehicle.vehicle_id)
+            rows.append((key, alias, dict(
+                vehicle_data(vehicle), plate=plates.get(vehicle.vehicle_id), owner=owner_data(vehicle.owner),
+                risk=risk_data(summary),
+            )))
+        return rows
+
+    rows = shards.merge_sorted(shards.fan_out(page), key=lambda row: row[0], reverse=field is not None)
+    next_cursor = dict(cursor)
+    for key, alias, _ in rows[:limit]:
+        next_cursor[alias] = key if field is None else [_json_value(key[0]), key[1]]
+    results = [result for _, _, result in rows[:limit]]
+    return results, (encode_cursor(next_cursor) if len(rows) > limit else None)
+
+
+def _facet_value(facet, value):
+    """Stored facet text back to the API value."""
+    if value in (None, ''):
+        return None
+    return int(value) if facet == 'year' else value
+
+
+def _grouped_counts(queryset):
+    """``[(facet, value text, vehicles)]`` for every facet in one statement."""
+    queryset = queryset.order_by()
+    grouped = [
+        queryset.values(facet=Value(facet, output_field=CharField()), value=Cast(facet, TextField()))
+        .annotate(vehicles=Count('*'))
+        .values_list('facet', 'value', 'vehicles')
+        for facet in FACETS
+    ]
+    return list(grouped[0].union(*grouped[1:], all=True))
+
+
+def facet_counts(filters):
+    """
+    ``(facets, exact)``: top values per facet, counted across shards.
+    ``exact`` is False when some shard had more than ``FACET_SCAN_LIMIT``
+    matches and only the first ones were counted.
+    """
+    def count(alias):
+        if not filters:
+            return list(
+                VehicleFacetCount.objects.using(alias).filter(vehicles__gt=0).values_list('facet', 'value', 'vehicles')
+            )
+        sql, params = first_ids(filters, alias, None, FACET_SCAN_LIMIT)
+        return _grouped_counts(Vehicle.objects.using(alias).filter(pk__in=RawSQL(sql, params)))
+
+    totals = {facet: Counter() for facet in FACETS}
+    exact = True
+    for rows in shards.fan_out(count).values():
+        counted = 0
+        for facet, value, vehicles in rows:
+            totals[facet][_facet_value(facet, value)] += vehicles
+            if facet == FACETS[0]:
+                counted += vehicles
+        exact = exact and not (filters and counted >= FACET_SCAN_LIMIT)
+    facets = {
+        facet: [{'value': value, 'count': vehicles} for value, vehicles in counter.most_common(FACET_VALUES)]
+        for facet, counter in totals.items()
+    }
+    return facets, exact
+
+
+def rebuild_facets(using):
+    """Recount ``vehicle_facet_counts`` on one shard from scratch."""
+    with transaction.atomic(using=using):
+        VehicleFacetCount.objects.using(using).all().delete()
+        VehicleFacetCount.objects.using(using).bulk_create([
+            VehicleFacetCount(facet=facet, value=value or '', vehicles=vehicles)
+            for facet, value, vehicles in _grouped_counts(Vehicle.objects.using(using))
+        ])
+    return VehicleFacetCount.objects.using(using).count()
+
+
+def _facet_keys(values):
+    return {(facet, '' if values[facet] is None else str(values[facet])) for facet in FACETS}
+
+
+def _bump(using, deltas):
+    rows = [(facet, value, delta) for (facet, value), delta in deltas.items() if delta]
+    if rows:
+        with connections[using].cursor() as cursor:
+            cursor.executemany(UPSERT_SQL, rows)
+
+
+def remember_facets(sender, instance, raw, using, **kwargs):
+    """``pre_save`` handler for ``Vehicle``: note the stored facet values."""
+    before = set()
+    if not raw and not instance._state.adding:
+        row = Vehicle.objects.using(using).filter(pk=instance.pk).values(*FACETS).first()
+        if row is not None:
+            before = _facet_keys(row)
+    instance._facets_before = before
+
+
+def count_saved(sender, instance, raw, using, **kwargs):
+    """``post_save`` handler for ``Vehicle``."""
+    before = instance.__dict__.pop('_facets_before', set())
+    if raw:
+        return
+    after = _facet_keys({facet: getattr(instance, facet) for facet in FACETS})
+    deltas = Counter(dict.fromkeys(after - before, 1))
+    deltas.update(dict.fromkeys(before - after, -1))
+    _bump(using, deltas)
+
+
+def count_deleted(sender, instance, using, **kwargs):
+    """``post_delete`` handler for ``Vehicle``."""
+    _bump(using, dict.fromkeys(_facet_keys({facet: getattr(instance, facet) for facet in FACETS}), -1))
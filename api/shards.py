@@ -0,0 +1,111 @@
+"""
+Region-based sharding of the registry.
+
+A vehicle and everything hanging off it (owner, licenses, plates,
+policies, accidents) live in one database alias chosen by the region code
+of its plate (the last two digits, e.g. ``123ABC02`` -> ``02``).
+``REGISTRY_SHARDS`` maps aliases to the region codes they hold; regions
+not listed go to ``REGISTRY_DEFAULT_SHARD``. Reference data (insurers, car
+parts) is replicated to every shard so joins stay local; operational
+tables (stats, audit, auth, admin) live on ``default`` only.
+
+Lookups by plate go straight to one shard. Everything else (lists, VIN
+lookups) fans out to all shards in parallel and merges the results.
+"""
+import contextvars
+import heapq
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import connections, transaction
+
+SHARDED_MODELS = {
+    'owner', 'driverlicense', 'vehicle', 'plate', 'insurancepolicy', 'accident', 'accident_damaged_parts',
+    'platearchive', 'accidentarchive', 'vehiclefacetcount', 'vehiclerisksummary', 'materializeddossier',
+    'dossierrefresh',
+}
+REFERENCE_MODELS = {'insurer', 'carpart'}
+
+REGION_SUFFIX = re.compile(r'(\d{2})$')
+
+
+def shard_map():
+    return getattr(settings, 'REGISTRY_SHARDS', {'default': []})
+
+
+def default_shard():
+    return getattr(settings, 'REGISTRY_DEFAULT_SHARD', 'default')
+
+
+def aliases():
+    return list(shard_map())
+
+
+def is_sharded():
+    return len(shard_map()) > 1
+
+
+def region_of(plate_norm):
+    """Region code from a normalized plate number, or None."""
+    match = REGION_SUFFIX.search(plate_norm or '')
+    return match.group(1) if match else None
+
+
+def alias_for_region(region):
+    for alias, regions in shard_map().items():
+        if region in regions:
+            return alias
+    return default_shard()
+
+
+def alias_for_plate(plate_norm):
+    return alias_for_region(region_of(plate_norm))
+
+
+def group_by_alias(plate_norms):
+    groups = {}
+    for plate_norm in plate_norms:
+        groups.setdefault(alias_for_plate(plate_norm), []).append(plate_norm)
+    return groups
+
+
+def _on_alias(fn, alias):
+    try:
+        return fn(alias)
+    finally:
+        # Worker threads get their own connections; don't leak them
+        connections[alias].close()
+
+
+def fan_out(fn, targets=None):
+    """
+    Call ``fn(alias)`` for every shard (or ``targets``) in parallel.
+
+    Returns ``{alias: result}``. With a single target the call runs on
+    the current thread. Worker threads see the caller's context variables
+    (e.g. the request's statement deadline).
+    """
+    targets = aliases() if targets is None else list(targets)
+    if len(targets) == 1:
+        return {targets[0]: fn(targets[0])}
+    with ThreadPoolExecutor(max_workers=len(targets), thread_name_prefix='shard') as pool:
+        futures = {alias: pool.submit(contextvars.copy_context().run, _on_alias, fn, alias) for alias in targets}
+        return {alias: future.result() for alias, future in futures.items()}
+
+
+def merge_sorted(results, key=None, reverse=False):
+    """Merge per-shard lists that are each already sorted."""
+    return list(heapq.merge(*results.values(), key=key, reverse=reverse))
+
+
+def write_parallel(rows_by_alias, writer):
+    """
+    Ingest helper: run ``writer(alias, rows)`` for every shard concurrently,
+    each inside its own transaction on that shard.
+    """
+    def write(alias):
+        with transaction.atomic(using=alias):
+            return writer(alias, rows_by_alias[alias])
+
+    return fan_out(write, rows_by_alias)
@@ -0,0 +1,189 @@
+"""
+Single-statement dossier in SQL.
+
+``load_dossier_json`` asks the database for the finished dossier as JSON
+text: one statement with correlated subqueries per section, built with
+``json_object``/``json_group_array`` on SQLite and
+``json_build_object``/``json_agg`` on PostgreSQL. No model instances or
+intermediate dicts are created, and ``check_plate`` writes the text to the
+response unchanged. The output matches ``dossier.build_dossiers`` rendered
+by DRF's ``JSONRenderer`` byte for byte (see the parity tests). SQLite
+already writes compact JSON; PostgreSQL's ``json`` output puts spaces
+around ``:`` and after ``,``, so its text is parsed and re-rendered
+compactly (plain dicts and lists, still no model instances).
+
+Only JSON responses take this path; other renderers and unsupported
+database vendors use the ORM path.
+"""
+import functools
+import json
+
+from django.conf import settings
+from django.db import connections
+from django.utils import timezone
+from rest_framework.renderers import JSONRenderer
+
+from . import shards
+
+DEFAULTS = {
+    'ENABLED': False,
+}
+
+VENDORS = ('sqlite', 'postgresql')
+
+_renderer = JSONRenderer()
+
+
+def get_config():
+    config = dict(DEFAULTS)
+    config.update(getattr(settings, 'SQL_JSON_DOSSIER', {}))
+    return config
+
+
+class SQLite:
+    # Values coming out of a subquery lose their JSON subtype, so nested
+    # documents go through json() to be embedded rather than quoted
+    def object(self, *pairs):
+        return 'json_object(' + ', '.join(f"'{key}', {value}" for key, value in pairs) + ')'
+
+    def nested(self, expr):
+        return f'json({expr})'
+
+    def array(self, select, order):
+        # SQLite < 3.44 has no ORDER BY inside aggregates; it aggregates
+        # rows in the order of the (ordered) subquery
+        return f'(SELECT json_group_array(json(rows.obj)) FROM ({select} ORDER BY {order}) rows)'
+
+    def boolean(self, condition):
+        return f"json(CASE WHEN {condition} THEN 'true' ELSE 'false' END)"
+
+    def collate(self, column):
+        return column
+
+    def document(self, expr):
+        return expr
+
+    def text(self, value):
+        return value
+
+
+class PostgreSQL:
+    def object(self, *pairs):
+        return 'json_build_object(' + ', '.join(f"'{key}', {value}" for key, value in pairs) + ')'
+
+    def nested(self, expr):
+        return expr
+
+    def array(self, select, order):
+        return f"(SELECT COALESCE(json_agg(rows.obj ORDER BY {order}), '[]'::json) FROM ({select}) rows)"
+
+    def boolean(self, condition):
+        return f'({condition})'
+
+    def collate(self, column):
+        # Same order as Python's str comparison in dossier code
+        return f'{column} COLLATE "C"'
+
+    def document(self, expr):
+        # Hand back text: psycopg2 would parse json values into dicts
+        return f'({expr})::text'
+
+    def text(self, value):
+        # json_build_object writes {"a" : 1, "b" : 2}: re-render as DRF does
+        return _renderer.render(json.loads(value)).decode()
+
+
+DIALECTS = {'sqlite': SQLite(), 'postgresql': PostgreSQL()}
+
+
+def _accidents(dialect):
+    parts = dialect.array(
+        'SELECT ' + dialect.object(
+            ('part_id', 'cp.part_id'), ('name', 'cp.name'),
+            ('category', 'cp.category'), ('description', 'cp.description'),
+        ) + ' AS obj, cp.category AS k1, cp.name AS k2 '
+        'FROM car_parts cp WHERE cp.bit IS NOT NULL AND ((a.damaged_parts_mask >> cp.bit) & 1) = 1',
+        f"{dialect.collate('k1')}, {dialect.collate('k2')}",
+    )
+    # LIMIT goes inside, ahead of the aggregate, so it applies per vehicle
+    return dialect.array(
+        'SELECT * FROM (SELECT ' + dialect.object(
+            ('accident_id', 'a.accident_id'), ('date', 'a.date'), ('severity', 'a.severity'),
+            ('location', 'a.location'), ('description', 'a.description'), ('fault_party', 'a.fault_party'),
+            ('damaged_parts', dialect.nested(parts)),
+        ) + ' AS obj, a.date AS k1, a.accident_id AS k2 '
+        'FROM accidents a WHERE a.vehicle_id = v.vehicle_id ORDER BY a.date DESC, a.accident_id DESC LIMIT %s) latest',
+        'k1 DESC, k2 DESC',
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def dossier_sql(vendor, sections):
+    """``(sql, param names)`` for one dossier with ``sections``."""
+    dialect = DIALECTS[vendor]
+    pairs = [('plate', 'p.plate_number')]
+    params = []
+    if 'vehicle' in sections:
+        pairs.append(('vehicle', dialect.object(
+            ('vehicle_id', 'v.vehicle_id'), ('vin', 'v.vin'), ('make', 'v.make'),
+            ('model', 'v.model'), ('year', 'v.year'), ('color', 'v.color'),
+        )))
+    if 'owner' in sections:
+        pairs.append(('owner', dialect.nested('CASE WHEN o.owner_id IS NULL THEN NULL ELSE ' + dialect.object(
+            ('owner_id', 'o.owner_id'), ('full_name', 'o.full_name'), ('iin', 'o.iin'),
+            ('dob', 'o.dob'), ('phone', 'o.phone'),
+        ) + ' END')))
+    if 'driver_license' in sections:
+        pairs.append(('driver_license', dialect.nested('(SELECT ' + dialect.object(
+            ('license_id', 'l.license_id'), ('number', 'l.number'), ('categories', 'l.categories'),
+            ('issued_at', 'l.issued_at'), ('expires_at', 'l.expires_at'), ('status', 'l.status'),
+        ) + ' FROM driver_licenses l WHERE l.owner_id = v.owner_id '
+            'ORDER BY l.expires_at DESC, l.license_id DESC LIMIT 1)')))
+    if 'insurance' in sections:
+        pairs.append(('insurance', dialect.nested(dialect.array(
+            'SELECT ' + dialect.object(
+                ('policy_number', 'ip.policy_number'), ('type', 'ip.type'), ('insurer', 'i.name'),
+                ('valid_from', 'ip.valid_from'), ('valid_to', 'ip.valid_to'), ('status', 'ip.status'),
+            ) + ' AS obj, ip.policy_id AS k1 FROM insurance_policies ip '
+            'LEFT JOIN insurers i ON i.insurer_id = ip.insurer_id WHERE ip.vehicle_id = v.vehicle_id',
+            'k1',
+        ))))
+    if 'accidents' in sections:
+        pairs.append(('accidents', dialect.nested(_accidents(dialect))))
+        params.append('limit')
+    if 'risk' in sections:
+        pairs.append(('risk', dialect.nested('(SELECT ' + dialect.object(
+            ('accidents', 'r.accidents'), ('at_fault_accidents', 'r.at_fault_accidents'),
+            ('last_accident_at', 'r.last_accident_at'),
+            ('osago_active', dialect.boolean('r.osago_valid_to IS NOT NULL AND r.osago_valid_to >= %s')),
+            ('osago_valid_to', 'r.osago_valid_to'),
+            ('kasko_active', dialect.boolean('r.kasko_valid_to IS NOT NULL AND r.kasko_valid_to >= %s')),
+            ('kasko_valid_to', 'r.kasko_valid_to'),
+        ) + ' FROM vehicle_risk_summaries r WHERE r.vehicle_id = v.vehicle_id)')))
+        params += ['today', 'today']
+    sql = (
+        'SELECT ' + dialect.document(dialect.object(*pairs)) + ' FROM plates p '
+        'JOIN vehicles v ON v.vehicle_id = p.vehicle_id '
+        'LEFT JOIN owners o ON o.owner_id = v.owner_id '
+        'WHERE p.plate_number = %s AND p.released_at IS NULL LIMIT 1'
+    )
+    return sql, tuple(params) + ('plate',)
+
+
+def supported(plate_norm):
+    return get_config()['ENABLED'] and connections[shards.alias_for_plate(plate_norm)].vendor in VENDORS
+
+
+def load_dossier_json(plate_norm, sections, accidents_limit):
+    """Dossier as JSON text, or None if the plate is not registered."""
+    connection = connections[shards.alias_for_plate(plate_norm)]
+    sql, names = dossier_sql(connection.vendor, frozenset(sections))
+    values = {
+        'plate': plate_norm,
+        'limit': accidents_limit,
+        'today': connection.ops.adapt_datefield_value(timezone.localdate()),
+    }
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [values[name] for name in names])
+        row = cursor.fetchone()
+    return DIALECTS[connection.vendor].text(row[0]) if row else None
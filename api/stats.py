@@ -0,0 +1,203 @@
+"""
+Write-behind lookup counters and hot-plate tracking.
+
+``check_plate`` only bumps an in-memory counter; a background thread
+flushes the accumulated deltas every ``FLUSH_INTERVAL`` seconds as one
+batched upsert into ``plate_lookup_stats``. A count-min sketch with a
+small top-K candidate set tracks the hottest plates of this process
+without keeping a counter per distinct plate.
+"""
+import atexit
+import logging
+import os
+import threading
+import time
+import zlib
+from collections import Counter
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+
+from .models import PlateLookupStat
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    'ENABLED': True,
+    'FLUSH_INTERVAL': 5.0,
+    'TOP_K': 100,
+    'SKETCH_WIDTH': 4096,
+    'SKETCH_DEPTH': 4,
+}
+
+UPSERT_SQL = (
+    "INSERT INTO plate_lookup_stats (plate_number, lookups, last_lookup_at) VALUES (%s, %s, %s) "
+    "ON CONFLICT (plate_number) DO UPDATE SET "
+    "lookups = plate_lookup_stats.lookups + excluded.lookups, "
+    "last_lookup_at = excluded.last_lookup_at"
+)
+
+
+def get_config():
+    config = dict(DEFAULTS)
+    config.update(getattr(settings, 'LOOKUP_STATS', {}))
+    return config
+
+
+class CountMinSketch:
+    """Approximate counts in ``width * depth`` cells; never underestimates."""
+
+    def __init__(self, width, depth):
+        self.width = width
+        self.depth = depth
+        self.rows = [[0] * width for _ in range(depth)]
+
+    def _cells(self, key):
+        data = key.encode()
+        for seed, row in enumerate(self.rows):
+            yield row, zlib.crc32(data, seed) % self.width
+
+    def add(self, key, count=1):
+        """Add ``count`` to ``key`` and return its new estimate."""
+        estimate = None
+        for row, index in self._cells(key):
+            row[index] += count
+            if estimate is None or row[index] < estimate:
+                estimate = row[index]
+        return estimate
+
+    def estimate(self, key):
+        return min(row[index] for row, index in self._cells(key))
+
+
+class HeavyHitters:
+    """Top-K keys by count-min estimate."""
+
+    def __init__(self, k, width, depth):
+        self.k = k
+        self.sketch = CountMinSketch(width, depth)
+        self.top = {}
+        self._floor = 0
+
+    def add(self, key, count=1):
+        estimate = self.sketch.add(key, count)
+        if key in self.top or len(self.top) < self.k:
+            self.top[key] = estimate
+        elif estimate > self._floor:
+            coldest = min(self.top, key=self.top.get)
+            del self.top[coldest]
+            self.top[key] = estimate
+        else:
+            return
+        if len(self.top) >= self.k:
+            self._floor = min(self.top.values())
+
+    def most_common(self, n=None):
+        ranked = sorted(self.top.items(), key=lambda item: item[1], reverse=True)
+        return ranked[:n] if n else ranked
+
+
+class LookupCounter:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pid = None
+        self._stop = None
+        self._reset()
+
+    def _reset(self):
+        config = get_config()
+        self.config = config
+        self.pending = Counter()
+        self.last_seen = {}
+        self.hot = HeavyHitters(config['TOP_K'], config['SKETCH_WIDTH'], config['SKETCH_DEPTH'])
+        self.flushed = 0
+        self.flush_errors = 0
+        self.pending_since = None
+
+    def _ensure_flusher(self):
+        # Threads do not survive fork(): each worker starts its own flusher
+        # and drops counts inherited from the parent
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self._reset()
+        self._stop = threading.Event()
+        thread = threading.Thread(target=self._run, args=(self._stop,), name='lookup-stats-flush', daemon=True)
+        thread.start()
+
+    def _run(self, stop):
+        while not stop.wait(self.config['FLUSH_INTERVAL']):
+            self.flush()
+        connection.close()
+
+    def record(self, plate_number):
+        if not self.config['ENABLED']:
+            return
+        now = timezone.now()
+        with self._lock:
+            self._ensure_flusher()
+            if not self.pending:
+                self.pending_since = time.time()
+            self.pending[plate_number] += 1
+            self.last_seen[plate_number] = now
+            self.hot.add(plate_number)
+
+    def flush(self):
+        """Write pending deltas in one transaction; returns the number of rows."""
+        with self._lock:
+            if not self.pending:
+                return 0
+            pending, last_seen, pending_since = self.pending, self.last_seen, self.pending_since
+            self.pending, self.last_seen, self.pending_since = Counter(), {}, None
+
+        rows = [
+            (plate, count, connection.ops.adapt_datetimefield_value(last_seen[plate]))
+            for plate, count in pending.items()
+        ]
+        try:
+            with transaction.atomic():
+                with connection.cursor() as cursor:
+                    cursor.executemany(UPSERT_SQL, rows)
+        except Exception:
+            # Put the deltas back so the next flush retries them
+            self.flush_errors += 1
+            logger.exception('Failed to flush %d lookup counters', len(rows))
+            with self._lock:
+                self.pending.update(pending)
+                for plate, seen in last_seen.items():
+                    self.last_seen.setdefault(plate, seen)
+                self.pending_since = min(filter(None, [self.pending_since, pending_since]), default=None)
+            return 0
+        self.flushed += len(rows)
+        return len(rows)
+
+    def stop(self):
+        if self._stop is not None and self._pid == os.getpid():
+            self._stop.set()
+            self.flush()
+
+    def lag(self):
+        """Age in seconds of the oldest count not yet in ``plate_lookup_stats``."""
+        pending_since = self.pending_since
+        return round(max(0.0, time.time() - pending_since), 3) if pending_since else 0.0
+
+    def snapshot(self, n=10):
+        return {
+            'pending': len(self.pending),
+            'flushed_rows': self.flushed,
+            'flush_errors': self.flush_errors,
+            'lag': self.lag(),
+            'hot': self.hot.most_common(n),
+        }
+
+
+lookups = LookupCounter()
+atexit.register(lookups.stop)
+
+
+def hottest_plates(limit):
+    """Most looked-up plates across all workers, from the persisted counters."""
+    return list(
+        PlateLookupStat.objects.order_by('-lookups').values_list('plate_number', flat=True)[:limit]
+    )
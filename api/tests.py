@@ -1,3 +1,1447 @@
-from django.test import TestCase
+import contextvars
+import gzip
+import importlib
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta, timezone as dt_timezone
+from decimal import Decimal
+from io import StringIO
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from django.apps import apps as django_apps
+from django.contrib import admin
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.core.management import call_command
+from django.db import connection
+from django.db.backends.sqlite3.base import DatabaseWrapper as SQLiteDatabaseWrapper
+from django.db.utils import OperationalError
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework.renderers import JSONRenderer
+
+from . import (
+    admission, audit, dbguard, dossier, export, fragments, health, integrity, kzplates, materialized, parts, profiling,
+    renderers, replating, risk, search, shards, sqljson, stats,
+)
+from . import cache as dossier_cache
+from .routers import RegionShardRouter
+from .models import (
+    Owner, DriverLicense, Vehicle, Plate, Insurer, InsurancePolicy, Accident, CarPart, PlateLookupStat, LookupAuditEvent,
+    PlateArchive, AccidentArchive, VehicleRiskSummary, VehicleFacetCount, MaterializedDossier, DossierRefresh,
+)
+
+
+def seed_registry():
+    """A few vehicles covering the dossier's edge cases; returns active plate numbers."""
+    today = date.today()
+    insurer = Insurer.objects.create(name='Jusan Insurance')
+    parts = [CarPart.objects.create(name=name, category=category) for name, category in [
+        ('Капот', 'Кузов'), ('Передний бампер', 'Кузов'), ('Лобовое стекло', 'Стекло'), ('Фара', 'Оптика'),
+    ]]
+    owner = Owner.objects.create(full_name='Иванов Иван', iin='900101300123', dob=date(1990, 1, 1))
+    DriverLicense.objects.create(owner=owner, number='KZ001', categories='B', issued_at=date(2010, 1, 1),
+                                 expires_at=date(2020, 1, 1), status='expired')
+    DriverLicense.objects.create(owner=owner, number='KZ002', categories='B,C', issued_at=date(2020, 1, 1),
+                                 expires_at=today + timedelta(days=365), status='valid')
+
+    fleet = Vehicle.objects.create(owner=owner, vin='WVWZZZ1JZXW000001', make='Toyota', model='Camry', year=2018)
+    ownerless = Vehicle.objects.create(vin='WVWZZZ1JZXW000002', make='Лада', color='белый')
+    bare = Vehicle.objects.create(owner=owner, vin='WVWZZZ1JZXW000003')
+    Plate.objects.create(vehicle=fleet, plate_number='123ABC02', region='02')
+    Plate.objects.create(vehicle=ownerless, plate_number='456DEF03', region='03')
+    Plate.objects.create(vehicle=bare, plate_number='789GHI04', region='04')
+
+    InsurancePolicy.objects.create(vehicle=fleet, insurer=insurer, policy_number='OSG-1', type='OSAGO',
+                                   valid_from=today - timedelta(days=10), valid_to=today + timedelta(days=355),
+                                   status='active')
+    InsurancePolicy.objects.create(vehicle=fleet, policy_number='KSK-1', type='KASKO', valid_from=date(2020, 1, 1),
+                                   valid_to=date(2021, 1, 1), status='expired')
+    for k in range(12):
+        accident = Accident.objects.create(vehicle=fleet, date=date(2023, 1, 1) + timedelta(days=k // 2),
+                                           severity='minor', location='Алматы', fault_party=['owner', 'other'][k % 2])
+        accident.damaged_parts.set(parts[:k % 5])
+    Accident.objects.create(vehicle=ownerless, date=date(2022, 5, 1), fault_party='unknown')
+    return ['123ABC02', '456DEF03', '789GHI04']
+
+
+class PlateParserTests(TestCase):
+    def test_parse(self):
+        cases = {
+            '123ABC02': ('123ABC02', '02'),
+            ' 123 abc 02\n': ('123ABC02', '02'),
+            '123-АВС-02': ('123ABC02', '02'),  # Cyrillic А, В, С
+            '777ХКМ\u00a017': ('777XKM17', '17'),
+            '123ав20': ('123AB20', '20'),
+            '123ABC21': (None, None),
+            '123ABC00': (None, None),
+            '12ABC02': (None, None),
+            '123ABCD02': (None, None),
+            '123ЖЖЖ02': (None, None),
+            '１２３ABC02': (None, None),
+            '': (None, None),
+        }
+        for value, expected in cases.items():
+            self.assertEqual(kzplates.parse(value), expected, value)
+        legacy = {
+            '123ABC45': ('123ABC45', None),
+            '123 авс 99': ('123ABC99', None),
+            '123ABC02': ('123ABC02', '02'),
+            '12ABC45': (None, None),
+        }
+        for value, expected in legacy.items():
+            self.assertEqual(kzplates.parse(value, legacy=True), expected, value)
+
+    def test_malformed_plates_never_reach_the_database(self):
+        with self.assertNumQueries(0):
+            response = self.client.get('/api/check/not-a-plate/')
+        self.assertEqual(response.status_code, 400)
+        with self.assertNumQueries(1), mock.patch.object(audit.writer, 'record'):
+            response = self.client.post('/api/check/batch/', {'plates': ['1 2', '123abc02', '123АВС02'],
+                                                              'fields': 'vehicle'}, content_type='application/json')
+        self.assertEqual(response.json(), {'results': {}, 'not_found': ['123ABC02'], 'invalid': ['1 2']})
+
+
+@override_settings(DOSSIER_CACHE={'TTL': 0})
+class LegacyPlateTests(TestCase):
+    """Numbers stored before the format was enforced stay reachable."""
+
+    def setUp(self):
+        vehicle = Vehicle.objects.create(vin='WVWZZZ1JZXW000021', make='Kia')
+        Plate.objects.create(vehicle=vehicle, plate_number='123ABC45', region='Region7')
+        PlateArchive.objects.create(plate_id=999, vehicle=vehicle, plate_number='456DEF11', region=None,
+                                    assigned_at=timezone.now(), released_at=timezone.now())
+        Plate.objects.create(vehicle=Vehicle.objects.create(vin='WVWZZZ1JZXW000022'), plate_number='789GHI02',
+                             region='02')
+
+    def test_lookups(self):
+        with mock.patch.object(audit.writer, 'record'), mock.patch.object(stats.lookups, 'record'):
+            for enabled in (False, True):
+                with override_settings(SQL_JSON_DOSSIER={'ENABLED': enabled}):
+                    response = self.client.get('/api/check/123 abc 45/?fields=vehicle')
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(response.json()['vehicle']['make'], 'Kia')
+            self.assertEqual(self.client.get('/api/check/123ABC46/').status_code, 404)
+            response = self.client.post('/api/check/batch/', {'plates': ['123ABC45'], 'fields': 'vehicle'},
+                                        content_type='application/json')
+            self.assertEqual(list(response.json()['results']), ['123ABC45'])
+        # Never issued again
+        self.assertEqual(replating.validate([('WVWZZZ1JZXW000022', '321CBA45')])[2][0]['reason'], 'invalid_plate')
+
+    def test_region_backfill(self):
+        migration = importlib.import_module('api.migrations.0013_plate_region_codes')
+        migration.backfill_regions(django_apps, mock.Mock(connection=connection))
+        self.assertEqual(dict(Plate.objects.values_list('plate_number', 'region')),
+                         {'123ABC45': '45', '789GHI02': '02'})
+        self.assertEqual(PlateArchive.objects.get().region, '11')
+
+
+@override_settings(DOSSIER_CACHE={'TTL': 0}, FRAGMENT_CACHE={'TTL': 0})
+class SparseFieldsetTests(TestCase):
+    """check_plate queries only what the requested sections need."""
+
+    # Queries per section for a plate with an owner, licenses and an insured policy
+    QUERIES = {
+        'vehicle': 0, 'owner': 2, 'driver_license': 2, 'insurance': 2, 'accidents': 1, 'risk': 1,
+    }
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.plates = seed_registry()
+
+    def setUp(self):
+        parts.invalidate()
+        parts.catalog()
+
+    def test_queries_per_section(self):
+        subsets = [frozenset([section]) for section in dossier.SECTIONS] + [
+            frozenset(), frozenset(['owner', 'driver_license']), frozenset(dossier.SECTIONS),
+        ]
+        for sections in subsets:
+            # One query finds the plate; owner and license share theirs
+            expected = 1 + sum(self.QUERIES[section] for section in sections)
+            if {'owner', 'driver_license'} <= sections:
+                expected -= self.QUERIES['owner']
+            with self.subTest(sections=sorted(sections)), self.assertNumQueries(expected):
+                found = dossier.load_dossier(self.plates[0], sections)
+            self.assertEqual(set(found), {'plate'} | sections)
+
+    def test_accident_depth(self):
+        with mock.patch.object(audit.writer, 'record'), mock.patch.object(stats.lookups, 'record'), \
+                override_settings(SQL_JSON_DOSSIER={'ENABLED': False}):
+            for query, expected in [('accidents=3', 3), ('accidents=100', 12), ('fields=vehicle,accidents', 10)]:
+                response = self.client.get(f'/api/check/123ABC02/?{query}', HTTP_ACCEPT='application/json')
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(len(response.json()['accidents']), expected)
+            response = self.client.get('/api/check/123ABC02/?accidents=0')
+            self.assertNotIn('accidents', response.json())
+            for query in ('accidents=-1', 'accidents=101', 'accidents=ten', 'fields=vehicle,foo', 'exclude=bar'):
+                response = self.client.get(f'/api/check/123ABC02/?{query}')
+                self.assertEqual(response.status_code, 400, query)
+                self.assertIn('detail', response.json())
+
+
+class AdmissionControlTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.plates = seed_registry()
+
+    def test_sheds_with_retry_after_when_slots_are_taken(self):
+        limiter = admission.ViewLimiter('check_plate', max_concurrency=1, max_queue=0, latency_budget=0.5)
+        with mock.patch.dict(admission._limiters, {'check_plate': limiter}), \
+                mock.patch.object(audit.writer, 'record'), mock.patch.object(stats.lookups, 'record'):
+            self.assertEqual(limiter.acquire(None), (True, None, 0))
+            response = self.client.get(f'/api/check/{self.plates[0]}/')
+            self.assertEqual(response.status_code, 503)
+            self.assertEqual(response.json(), {'detail': 'overloaded: queue_full'})
+            self.assertGreaterEqual(int(response['Retry-After']), 1)
+            limiter.release(0.01)
+            self.assertEqual(self.client.get(f'/api/check/{self.plates[0]}/').status_code, 200)
+            self.assertEqual(limiter.active, 0)
+
+    def test_streamed_body_holds_its_slot(self):
+        limiter = admission.ViewLimiter('stream_plates', max_concurrency=1, max_queue=0, latency_budget=0.5)
+        with mock.patch.dict(admission._limiters, {'stream_plates': limiter}):
+            response = self.client.get('/api/list/stream/')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(limiter.active, 1)
+            self.assertEqual(self.client.get('/api/list/stream/').status_code, 503)
+            b''.join(response.streaming_content)
+            self.assertEqual(limiter.active, 0)
+
+    def test_token_bucket_refills(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            buckets = admission.SharedTokenBuckets(rate=10, burst=2, slots=8, path=os.path.join(tmp, 'buckets'))
+            with mock.patch.object(admission.time, 'time', return_value=1000.0) as clock:
+                self.assertEqual([buckets.consume('client'), buckets.consume('client')], [0, 0])
+                self.assertAlmostEqual(buckets.consume('client'), 0.1)
+                self.assertEqual(buckets.consume('other'), 0)
+                clock.return_value = 1000.1
+                self.assertEqual(buckets.consume('client'), 0)
+                self.assertGreater(buckets.consume('client'), 0)
+                clock.return_value = 1010.0
+                self.assertEqual([buckets.consume('client'), buckets.consume('client')], [0, 0])
+
+            with mock.patch.object(admission, 'get_buckets', return_value=buckets), \
+                    mock.patch.object(audit.writer, 'record'):
+                while not buckets.consume('flood'):
+                    pass
+                response = self.client.get(f'/api/check/{self.plates[0]}/', HTTP_X_CLIENT_ID='flood')
+            self.assertEqual(response.status_code, 429)
+            self.assertIn('Retry-After', response)
+
+
+@override_settings(DOSSIER_CACHE={'TTL': 0})
+class HistoryArchiveTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.plates = seed_registry()
+        fleet = Vehicle.objects.get(vin='WVWZZZ1JZXW000001')
+        Accident.objects.bulk_create([
+            Accident(vehicle=fleet, date=date(2015, 1, 1) + timedelta(days=k)) for k in range(dossier.MAX_ACCIDENTS)
+        ])
+        Plate.objects.create(vehicle=fleet, plate_number='111AAA02', region='02',
+                             released_at=timezone.now() - timedelta(days=3))
+
+    def responses(self):
+        urls = [f'/api/check/{self.plates[0]}/?accidents={dossier.MAX_ACCIDENTS}',
+                f'/api/history/{self.plates[0]}/', '/api/history/111AAA02/']
+        with mock.patch.object(audit.writer, 'record'), mock.patch.object(stats.lookups, 'record'):
+            return [self.client.get(url).json() for url in urls]
+
+    def test_archiving_changes_no_response(self):
+        before = self.responses()
+        call_command('archive_history', '--plate-retention-days', '1', '--accident-retention-days', '0',
+                     stdout=StringIO())
+        # Only what lies beyond the deepest dossier (?accidents=MAX_ACCIDENTS) moves
+        self.assertEqual(PlateArchive.objects.count(), 1)
+        self.assertEqual(AccidentArchive.objects.count(), 12)
+        after = self.responses()
+        self.assertEqual(after[0], before[0])
+
+        def unflagged(body):
+            return {key: [{k: v for k, v in row.items() if k != 'archived'} for row in value]
+                    if isinstance(value, list) else value for key, value in body.items()}
+        for old, new in zip(before[1:], after[1:]):
+            self.assertEqual(unflagged(new), unflagged(old))
+            self.assertEqual(sum(row['archived'] for row in new['accidents']), 12)
+        self.assertTrue(after[2]['assignments'][-1]['archived'])
+
+
+class VehicleSearchTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        grow_registry(0, 30)
+
+    def get(self, **params):
+        return self.client.get('/api/vehicles/search/', params)
+
+    def walk(self, **params):
+        pages, cursor = [], None
+        while True:
+            body = self.get(**params, **({'cursor': cursor} if cursor else {})).json()
+            pages.append([row['vehicle_id'] for row in body['results']])
+            cursor = body['next']
+            if cursor is None:
+                return pages
+
+    def test_keyset_pages(self):
+        for filters, expected in [
+            ({}, Vehicle.objects.all()),
+            ({'make': 'Make1'}, Vehicle.objects.filter(make='Make1')),
+            ({'year_min': 2002, 'year_max': 2004}, Vehicle.objects.filter(year__range=(2002, 2004))),
+            ({'make': 'Make0', 'year_min': 2003}, Vehicle.objects.filter(make='Make0', year__gte=2003)),
+            ({'region': '05'}, Vehicle.objects.filter(plates__region='05', plates__released_at__isnull=True)),
+        ]:
+            pages = self.walk(limit=4, facets=0, **filters)
+            self.assertTrue(all(len(page) == 4 for page in pages[:-1]), filters)
+            flat = [pk for page in pages for pk in page]
+            self.assertEqual(flat, list(expected.order_by('vehicle_id').values_list('vehicle_id', flat=True)), filters)
+
+        first = self.get(limit=5).json()
+        cursor = search.decode_cursor(first['next'])
+        self.assertEqual(cursor, {'default': first['results'][-1]['vehicle_id']})
+        self.assertEqual(self.get(limit=5, cursor=search.encode_cursor(cursor)).json()['results'],
+                         self.get(limit=5, cursor=first['next']).json()['results'])
+        for bad in ('not-base64!', search.encode_cursor(['x']), search.encode_cursor({'default': 'x'})):
+            self.assertEqual(self.get(cursor=bad).status_code, 400)
+
+    def test_filtered_facets(self):
+        body = self.get(make='Make2', limit=1).json()
+        self.assertTrue(body['facets_exact'])
+        self.assertEqual(body['facets']['make'], [{'value': 'Make2', 'count': 10}])
+        with mock.patch.object(search, 'FACET_SCAN_LIMIT', 4):
+            body = self.get(make='Make2', limit=1).json()
+        self.assertFalse(body['facets_exact'])
+        self.assertEqual(body['facets']['make'], [{'value': 'Make2', 'count': 4}])
+
+    def test_facet_counters_follow_saves(self):
+        def counters():
+            return sorted(VehicleFacetCount.objects.filter(vehicles__gt=0).values_list('facet', 'value', 'vehicles'))
+
+        vehicle = Vehicle.objects.create(vin='FACET000000000001', make='Lada', model='Niva', year=1999)
+        vehicle.make = 'UAZ'
+        vehicle.color = 'green'
+        vehicle.save()
+        Vehicle.objects.filter(vin='GROW0000000000003').delete()
+        maintained = counters()
+        self.assertIn(('make', 'UAZ', 1), maintained)
+        self.assertNotIn('Lada', [value for _, value, _ in maintained])
+        search.rebuild_facets('default')
+        self.assertEqual(counters(), maintained)
+
+
+class SQLJSONDossierTests(TestCase):
+    """
+    The single-statement JSON dossier must match the ORM path byte for byte,
+    on the vendor of the test database (SQLite unless DATABASES says otherwise).
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.plates = seed_registry()
+
+    def assert_parity(self, sections, accidents_limit):
+        for plate in self.plates:
+            expected = JSONRenderer().render(dossier.load_dossier(plate, sections, accidents_limit)).decode()
+            self.assertEqual(sqljson.load_dossier_json(plate, sections, accidents_limit), expected)
+
+    def test_full_dossier(self):
+        self.assert_parity(frozenset(dossier.SECTIONS), dossier.DEFAULT_ACCIDENTS)
+
+    def test_accident_limits(self):
+        for limit in (1, 5, dossier.MAX_ACCIDENTS):
+            self.assert_parity(frozenset(dossier.SECTIONS), limit)
+
+    def test_section_subsets(self):
+        for section in dossier.SECTIONS:
+            self.assert_parity(frozenset([section]), dossier.DEFAULT_ACCIDENTS)
+        self.assert_parity(frozenset(), dossier.DEFAULT_ACCIDENTS)
+
+    def test_unknown_plate(self):
+        self.assertIsNone(sqljson.load_dossier_json('000XXX01', frozenset(dossier.SECTIONS), 10))
+
+    def test_postgresql_text_is_compacted(self):
+        # What json_build_object/json_agg write, spacing included
+        raw = ('{"plate" : "456DEF03", "vehicle" : {"vehicle_id" : 2, "make" : "Лада", "year" : null}, '
+               '"insurance" : [], "risk" : {"osago_active" : false, "last_accident_at" : "2022-05-01"}}')
+        self.assertEqual(sqljson.PostgreSQL().text(raw), JSONRenderer().render(json.loads(raw)).decode())
+        self.assertNotIn(' ', sqljson.PostgreSQL().text(raw))
+
+    @skipUnless(connection.vendor == 'postgresql', 'PostgreSQL json spacing needs a PostgreSQL test database')
+    def test_postgresql_parity(self):
+        self.assert_parity(frozenset(dossier.SECTIONS), dossier.MAX_ACCIDENTS)
+        for section in dossier.SECTIONS:
+            self.assert_parity(frozenset([section]), 1)
+
+    @override_settings(DOSSIER_CACHE={'TTL': 0})
+    def test_check_plate_response(self):
+        with mock.patch.object(audit.writer, 'record'), mock.patch.object(stats.lookups, 'record'):
+            bodies = {}
+            for enabled in (False, True):
+                with override_settings(SQL_JSON_DOSSIER={'ENABLED': enabled}):
+                    response = self.client.get('/api/check/123ABC02/?accidents=3', HTTP_ACCEPT='application/json')
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(response['Content-Type'], 'application/json')
+                bodies[enabled] = response.content
+            self.assertEqual(bodies[True], bodies[False])
+
+            with override_settings(SQL_JSON_DOSSIER={'ENABLED': True}):
+                self.assertEqual(self.client.get('/api/check/000XXX01/').status_code, 404)
+
+
+@override_settings(DOSSIER_CACHE={'TTL': 30, 'STALE_TTL': 300, 'GENERATION_CHECK': 0})
+class SharedDossierCacheTests(TestCase):
+    """Versioned keys on the local stand-in backend (locmem)."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.plates = seed_registry()
+
+    def lookup(self, plate):
+        loads = []
+        sections = frozenset(dossier.SECTIONS)
+
+        def loader():
+            loads.append(plate)
+            return dossier.load_dossier(plate, sections)
+        return dossier_cache.get_dossier(plate, sections, dossier.DEFAULT_ACCIDENTS, loader), loads
+
+    def test_warm_then_invalidate(self):
+        self.assertEqual(dossier_cache.warm(self.plates + ['000XXX01']), len(self.plates))
+        value, loads = self.lookup(self.plates[0])
+        self.assertEqual(loads, [])
+        self.assertEqual(value['plate'], self.plates[0])
+
+        generation = dossier_cache.generation()
+        dossier_cache.invalidate()
+        self.assertNotEqual(dossier_cache.generation(), generation)
+        _, loads = self.lookup(self.plates[0])
+        self.assertEqual(loads, [self.plates[0]])
+
+    def test_prewarm_runs_once_per_generation(self):
+        with mock.patch.object(dossier_cache, 'hottest_plates', return_value=self.plates), \
+                override_settings(DOSSIER_CACHE={'TTL': 30, 'PREWARM_TOP_K': 10, 'GENERATION_CHECK': 0}):
+            dossier_cache.invalidate()
+            self.assertEqual(dossier_cache.prewarm_on_startup(), len(self.plates))
+            self.assertEqual(dossier_cache.prewarm_on_startup(), 0)
+
+    def test_failed_prewarm_leaves_no_marker(self):
+        with mock.patch.object(dossier_cache, 'hottest_plates', return_value=self.plates), \
+                override_settings(DOSSIER_CACHE={'TTL': 30, 'PREWARM_TOP_K': 10, 'GENERATION_CHECK': 0}):
+            dossier_cache.invalidate()
+            with mock.patch.object(dossier_cache, 'warm', side_effect=dbguard.CircuitOpen('default', 1.0)), \
+                    self.assertLogs('api.cache', 'ERROR'):
+                self.assertEqual(dossier_cache.prewarm_on_startup(), 0)
+            self.assertFalse(dossier_cache.is_warm())
+            # The next worker to start does the warm
+            self.assertEqual(dossier_cache.prewarm_on_startup(), len(self.plates))
+            self.assertTrue(dossier_cache.is_warm())
+
+
+@override_settings(DOSSIER_CACHE={'TTL': 30, 'STALE_TTL': 300, 'GENERATION_CHECK': 0})
+class DossierCoalescingTests(TestCase):
+    """Concurrent misses share one load; expired entries are served while one refresh runs."""
+
+    SECTIONS = frozenset(['vehicle'])
+
+    def setUp(self):
+        dossier_cache.invalidate()
+
+    def wait_for(self, condition):
+        deadline = time.monotonic() + 5
+        while not condition():
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.005)
+
+    def test_concurrent_misses_share_one_load(self):
+        loads = []
+        release = threading.Event()
+
+        def loader():
+            loads.append(1)
+            release.wait(5)
+            return {'plate': '123ABC02'}
+
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            results = [pool.submit(dossier_cache.get_dossier, '123ABC02', self.SECTIONS, 10, loader)
+                       for _ in range(8)]
+            self.wait_for(lambda: dossier_cache.flights.stats()['waiters'] == 7)
+            release.set()
+            self.assertEqual([result.result() for result in results], [{'plate': '123ABC02'}] * 8)
+        self.assertEqual(len(loads), 1)
+        self.assertEqual(dossier_cache.flights.stats(), {'in_flight': 0, 'waiters': 0})
+        self.assertEqual(dossier_cache.get_dossier('123ABC02', self.SECTIONS, 10, loader), {'plate': '123ABC02'})
+        self.assertEqual(len(loads), 1)
+
+    def test_expired_entry_is_served_while_refreshed(self):
+        dossier_cache.get_dossier('123ABC02', self.SECTIONS, 10, lambda: {'version': 1})
+        key = dossier_cache.make_key('123ABC02', self.SECTIONS, 10)
+        loads = []
+        release = threading.Event()
+
+        def loader():
+            loads.append(1)
+            release.wait(5)
+            return {'version': 2}
+
+        expired = time.time() + 60
+        with mock.patch.object(dossier_cache.time, 'time', return_value=expired):
+            for _ in range(3):
+                self.assertEqual(dossier_cache.get_dossier('123ABC02', self.SECTIONS, 10, loader), {'version': 1})
+            release.set()
+            self.wait_for(lambda: key not in dossier_cache._refreshing)
+        self.assertEqual(len(loads), 1)
+        self.assertEqual(dossier_cache.get_dossier('123ABC02', self.SECTIONS, 10, loader), {'version': 2})
+        self.assertEqual(len(loads), 1)
+
+
+@override_settings(LOOKUP_STATS={'FLUSH_INTERVAL': 3600})
+class LookupCounterTests(TestCase):
+    def counter(self):
+        counter = stats.LookupCounter()
+        self.addCleanup(counter.stop)
+        return counter
+
+    def stored(self):
+        return dict(PlateLookupStat.objects.values_list('plate_number', 'lookups'))
+
+    def test_flush_upserts_deltas(self):
+        counter = self.counter()
+        for plate in ['123ABC02'] * 3 + ['456DEF03']:
+            counter.record(plate)
+        with self.assertNumQueries(3):  # savepoint, one batched upsert, release
+            self.assertEqual(counter.flush(), 2)
+        self.assertEqual(self.stored(), {'123ABC02': 3, '456DEF03': 1})
+        self.assertEqual(counter.flush(), 0)
+
+        counter.record('123ABC02')
+        counter.record('789GHI04')
+        self.assertEqual(counter.flush(), 2)
+        self.assertEqual(self.stored(), {'123ABC02': 4, '456DEF03': 1, '789GHI04': 1})
+        self.assertEqual(stats.hottest_plates(1), ['123ABC02'])
+        self.assertEqual(counter.snapshot()['flushed_rows'], 4)
+
+    def test_failed_flush_keeps_deltas(self):
+        counter = self.counter()
+        counter.record('123ABC02')
+        with mock.patch.object(stats, 'UPSERT_SQL', 'INSERT INTO no_such_table VALUES (%s, %s, %s)'), \
+                self.assertLogs('api.stats', 'ERROR'):
+            self.assertEqual(counter.flush(), 0)
+        counter.record('123ABC02')
+        self.assertEqual(counter.snapshot()['flush_errors'], 1)
+        self.assertEqual(counter.flush(), 1)
+        self.assertEqual(self.stored(), {'123ABC02': 2})
+        self.assertEqual(counter.lag(), 0.0)
+
+    def test_heavy_hitters(self):
+        hot = {f'{n:03d}HOT02': count for n, count in enumerate([90, 70, 50, 30, 20])}
+        stream = [f'{n:03d}AAA01' for n in range(1000)]  # each seen once, before the hot ones
+        for step in range(max(hot.values())):
+            stream += [plate for plate, count in hot.items() if step < count]
+        hitters = stats.HeavyHitters(5, 512, 4)
+        for plate in stream:
+            hitters.add(plate)
+
+        self.assertEqual([plate for plate, _ in hitters.most_common()], list(hot))
+        self.assertEqual([plate for plate, _ in hitters.most_common(2)], list(hot)[:2])
+        truth = dict.fromkeys(stream[:1000], 1) | hot
+        for plate, count in truth.items():
+            self.assertGreaterEqual(hitters.sketch.estimate(plate), count)
+        for plate, estimate in hitters.most_common():
+            self.assertLessEqual(estimate - hot[plate], 10)
+
+
+@override_settings(LOOKUP_AUDIT={'BATCH_SIZE': 3, 'FLUSH_INTERVAL': 3600, 'QUEUE_SIZE': 100})
+class AuditWriterTests(TransactionTestCase):
+    """The background writer has its own connection, so its rows must be committed to be seen."""
+
+    def writer(self):
+        writer = audit.AuditWriter()
+        self.addCleanup(writer.shutdown)
+        return writer
+
+    def record(self, writer, count):
+        for n in range(count):
+            writer.record(f'{n:03d}ABC02', 'anonymous', '127.0.0.1', 'check_plate', 'vehicle', 200)
+
+    def test_batches_are_written_off_the_request_thread(self):
+        writer = self.writer()
+        with self.assertNumQueries(0):
+            self.record(writer, 7)
+        # A full batch wakes the writer long before FLUSH_INTERVAL
+        deadline = time.monotonic() + 5
+        while writer.snapshot().get('written', 0) < 6:
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.005)
+        self.assertGreaterEqual(writer.snapshot()['batches'], 2)
+        self.assertGreaterEqual(LookupAuditEvent.objects.count(), 6)
+
+    def test_shutdown_flushes_the_queue(self):
+        writer = self.writer()
+        self.record(writer, 2)
+        self.assertEqual(LookupAuditEvent.objects.count(), 0)
+        writer.shutdown()
+        self.assertEqual(writer.snapshot(), {'written': 2, 'batches': 1, 'queued': 0, 'lag': 0.0})
+        self.assertEqual(
+            sorted(LookupAuditEvent.objects.values_list('plate_number', flat=True)), ['000ABC02', '001ABC02']
+        )
+
+
+@override_settings(LOOKUP_AUDIT={'QUEUE_SIZE': 1, 'ON_FULL': 'block', 'BLOCK_TIMEOUT': 0})
+class AuditOverflowTests(TestCase):
+    def setUp(self):
+        # No writer thread: the queue stays full
+        self.writer = audit.AuditWriter()
+        self.writer._wake = threading.Event()
+        patcher = mock.patch.object(self.writer, '_ensure_started')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def record(self, plate):
+        self.writer.record(plate, 'anonymous', '127.0.0.1', 'check_plate', 'vehicle', 200)
+
+    def test_full_queue_writes_inline(self):
+        self.record('000ABC02')
+        self.record('001ABC02')
+        self.assertEqual(list(LookupAuditEvent.objects.values_list('plate_number', flat=True)), ['001ABC02'])
+        self.assertEqual(self.writer.snapshot()['written_inline'], 1)
+
+    def test_failed_inline_write_is_logged_and_counted(self):
+        self.record('000ABC02')
+        with mock.patch.object(audit, 'INSERT_SQL', 'INSERT INTO no_such_table VALUES (%s, %s, %s, %s, %s, %s, %s)'), \
+                self.assertLogs('api.audit', 'ERROR'):
+            self.record('001ABC02')
+        snapshot = self.writer.snapshot()
+        self.assertEqual((snapshot['dropped'], snapshot['write_errors'], snapshot['queued']), (1, 1, 1))
+        self.assertNotIn('written_inline', snapshot)
+        self.assertEqual(LookupAuditEvent.objects.count(), 0)
+
+
+@skipUnless(renderers.msgpack, 'msgpack is not installed')
+@override_settings(DOSSIER_CACHE={'TTL': 0})
+class MessagePackTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.plates = seed_registry()
+
+    def test_round_trip_keeps_dates(self):
+        moment = datetime(2024, 5, 10, 8, 30, 15, 123456, tzinfo=dt_timezone.utc)
+        data = {
+            'dates': [date(2024, 2, 29), date(1969, 12, 31), date(1, 1, 1), date(9999, 12, 31)],
+            'moment': moment,
+            'naive': datetime(2024, 5, 10, 8, 30),  # read as UTC
+            'amount': Decimal('12.50'),
+            'nested': [{'n': 1, 'none': None, 'text': 'Алматы'}],
+        }
+        self.assertEqual(renderers.unpackb(renderers.packb(data)), dict(
+            data, naive=datetime(2024, 5, 10, 8, 30, tzinfo=dt_timezone.utc), amount='12.50',
+        ))
+
+    def test_endpoints(self):
+        with mock.patch.object(audit.writer, 'record'), mock.patch.object(stats.lookups, 'record'):
+            response = self.client.get('/api/check/123ABC02/', HTTP_ACCEPT='application/msgpack')
+            self.assertEqual(response['Content-Type'], 'application/msgpack')
+            self.assertEqual(renderers.unpackb(response.content),
+                             dossier.load_dossier('123ABC02', frozenset(dossier.SECTIONS)))
+
+            response = self.client.post(
+                '/api/check/batch/', renderers.packb({'plates': self.plates + ['000XXX01'], 'fields': 'vehicle'}),
+                content_type='application/msgpack', HTTP_ACCEPT='application/msgpack',
+            )
+            body = renderers.unpackb(response.content)
+            self.assertEqual(sorted(body['results']), self.plates)
+            self.assertEqual(body['not_found'], ['000XXX01'])
+
+        response = self.client.get('/api/list/stream/', HTTP_ACCEPT='application/msgpack-seq')
+        unpacker = renderers.unpacker()
+        unpacker.feed(b''.join(response.streaming_content))
+        self.assertEqual(list(unpacker), sorted(self.plates))
+
+
+@override_settings(REGISTRY_SHARDS={'default': [], 'almaty': ['02', '05'], 'astana': ['01', '03']})
+class ShardRoutingTests(SimpleTestCase):
+    def test_alias_for_plate(self):
+        self.assertEqual(
+            {plate: shards.alias_for_plate(plate) for plate in ['123ABC02', '123ABC05', '456DEF01', '789GHI17', 'ABC']},
+            {'123ABC02': 'almaty', '123ABC05': 'almaty', '456DEF01': 'astana', '789GHI17': 'default', 'ABC': 'default'},
+        )
+        self.assertEqual(shards.group_by_alias(['123ABC02', '456DEF03', '111AAA02']),
+                         {'almaty': ['123ABC02', '111AAA02'], 'astana': ['456DEF03']})
+        with override_settings(REGISTRY_DEFAULT_SHARD='astana'):
+            self.assertEqual(shards.alias_for_plate('789GHI17'), 'astana')
+
+    def test_router(self):
+        router = RegionShardRouter()
+        plate, stat = Plate(), PlateLookupStat()
+        plate._state.db = stat._state.db = 'almaty'
+        self.assertEqual(router.db_for_read(Plate, instance=plate), 'almaty')
+        self.assertEqual(router.db_for_write(CarPart, instance=CarPart()), None)
+        self.assertIsNone(router.db_for_read(PlateLookupStat, instance=stat))
+        other = Vehicle()
+        other._state.db = 'astana'
+        self.assertFalse(router.allow_relation(plate, other))
+
+        allowed = {
+            (db, app_label, model_name): router.allow_migrate(db, app_label, model_name)
+            for db in ('default', 'almaty', 'replica')
+            for app_label, model_name in [('api', 'plate'), ('api', 'carpart'), ('api', 'platelookupstat'),
+                                          ('auth', 'user')]
+        }
+        self.assertEqual({key for key, value in allowed.items() if value}, {
+            ('default', 'api', 'plate'), ('default', 'api', 'carpart'), ('default', 'api', 'platelookupstat'),
+            ('default', 'auth', 'user'), ('almaty', 'api', 'plate'), ('almaty', 'api', 'carpart'),
+        })
+        self.assertIsNone(allowed['replica', 'api', 'plate'])
+
+    def test_fan_out_and_merge(self):
+        request_id = contextvars.ContextVar('request_id')
+        request_id.set('r1')
+        with mock.patch.object(shards, 'connections') as fake_connections:
+            results = shards.fan_out(lambda alias: (threading.current_thread().name, request_id.get(), alias))
+        self.assertEqual(list(results), ['default', 'almaty', 'astana'])
+        for alias, (thread, seen, called_with) in results.items():
+            self.assertTrue(thread.startswith('shard'))
+            self.assertEqual((seen, called_with), ('r1', alias))
+        self.assertEqual(sorted(call.args[0] for call in fake_connections.__getitem__.call_args_list),
+                         ['almaty', 'astana', 'default'])
+        # A single target runs inline
+        self.assertEqual(shards.fan_out(lambda alias: threading.current_thread().name, ['almaty']),
+                         {'almaty': threading.current_thread().name})
+
+        by_shard = {'default': [1, 4, 9], 'almaty': [2, 3], 'astana': []}
+        self.assertEqual(shards.merge_sorted(by_shard), [1, 2, 3, 4, 9])
+        by_shard = {'default': [('b', 9), ('a', 1)], 'almaty': [('c', 5)]}
+        self.assertEqual(shards.merge_sorted(by_shard, key=lambda row: row[1], reverse=True),
+                         [('b', 9), ('c', 5), ('a', 1)])
+
+
+class RiskSummaryTests(TestCase):
+    """The maintained summary must always equal a recount from scratch."""
+
+    def setUp(self):
+        self.vehicles = [Vehicle.objects.create(vin=f'WVWZZZ1JZXW00010{n}') for n in range(2)]
+        self.ids = [vehicle.pk for vehicle in self.vehicles]
+
+    def assert_in_step(self, **expected):
+        fields = risk.ACCIDENT_FIELDS + risk.POLICY_FIELDS
+        stored = {row.pop('vehicle_id'): row for row in
+                  VehicleRiskSummary.objects.filter(vehicle_id__in=self.ids).values('vehicle_id', *fields)}
+        accidents, policies = risk.accident_totals(self.ids, 'default'), risk.policy_totals(self.ids, 'default')
+        self.assertEqual(stored, {pk: dict(accidents[pk], **policies[pk]) for pk in self.ids})
+        first = stored[self.ids[0]]
+        self.assertEqual({field: first[field] for field in expected}, expected)
+
+    def test_accident_writes(self):
+        first, second = self.vehicles
+        self.assert_in_step(accidents=0, last_accident_at=None)
+        accidents = [Accident.objects.create(vehicle=first, date=date(2024, 1, day), fault_party=fault)
+                     for day, fault in [(5, 'owner'), (9, 'other'), (7, 'owner')]]
+        self.assert_in_step(accidents=3, at_fault_accidents=2, last_accident_at=date(2024, 1, 9))
+
+        accidents[1].fault_party = 'owner'
+        accidents[1].date = date(2023, 12, 31)
+        accidents[1].save()
+        self.assert_in_step(accidents=3, at_fault_accidents=3, last_accident_at=date(2024, 1, 7))
+        accidents[2].vehicle = second
+        accidents[2].save()
+        self.assert_in_step(accidents=2, at_fault_accidents=2, last_accident_at=date(2024, 1, 5))
+        accidents[0].delete()
+        self.assert_in_step(accidents=1, at_fault_accidents=1, last_accident_at=date(2023, 12, 31))
+
+        # Archiving moves the row but keeps it counted
+        archived = accidents[1]
+        AccidentArchive.objects.create(accident_id=archived.pk, vehicle=first, date=archived.date,
+                                       fault_party=archived.fault_party)
+        archived.delete()
+        self.assert_in_step(accidents=1, at_fault_accidents=1, last_accident_at=date(2023, 12, 31))
+
+    def test_policy_writes(self):
+        first = self.vehicles[0]
+        today = timezone.localdate()
+        osago = InsurancePolicy.objects.create(vehicle=first, policy_number='OSG-7', type='OSAGO', status='active',
+                                               valid_from=today - timedelta(days=30), valid_to=today + timedelta(days=5))
+        kasko = InsurancePolicy.objects.create(vehicle=first, policy_number='KSK-7', type='KASKO', status='expired',
+                                               valid_from=date(2020, 1, 1), valid_to=date(2021, 1, 1))
+        self.assert_in_step(osago_valid_to=today + timedelta(days=5), kasko_valid_to=None)
+
+        kasko.status = 'active'
+        kasko.save()
+        self.assert_in_step(kasko_valid_to=date(2021, 1, 1))
+        summary = risk.summaries_by_vehicle([first.pk], 'default')[first.pk]
+        self.assertEqual((summary['osago_active'], summary['kasko_active']), (True, False))
+
+        osago.valid_to = today - timedelta(days=1)
+        osago.save()
+        self.assertFalse(risk.summaries_by_vehicle([first.pk], 'default')[first.pk]['osago_active'])
+        osago.delete()
+        kasko.delete()
+        self.assert_in_step(osago_valid_to=None, kasko_valid_to=None)
+
+    def test_policy_moves_to_another_vehicle(self):
+        first, second = self.vehicles
+        today = timezone.localdate()
+        policy = InsurancePolicy.objects.create(vehicle=first, policy_number='OSG-8', type='OSAGO', status='active',
+                                                valid_from=today, valid_to=today + timedelta(days=90))
+        self.assert_in_step(osago_valid_to=today + timedelta(days=90))
+        policy.vehicle = second
+        policy.save()
+        self.assert_in_step(osago_valid_to=None)
+        self.assertEqual(VehicleRiskSummary.objects.get(vehicle=second).osago_valid_to, today + timedelta(days=90))
+
+
+@override_settings(DOSSIER_CACHE={'TTL': 0}, FRAGMENT_CACHE={'TTL': 3600})
+class FragmentCacheTests(TestCase):
+    """Cached owner, license and insurer fragments are dropped by ORM writes."""
+
+    SECTIONS = frozenset(['owner', 'driver_license', 'insurance'])
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.plates = seed_registry()
+
+    def setUp(self):
+        caches['fragments'].clear()
+
+    def lookup(self, queries):
+        with self.assertNumQueries(queries):
+            return dossier.load_dossier('123ABC02', self.SECTIONS)
+
+    def test_owner_and_license_writes(self):
+        self.lookup(5)
+        # Warm: plate and policies only
+        found = self.lookup(2)
+        self.assertEqual((found['owner']['full_name'], found['driver_license']['number']), ('Иванов Иван', 'KZ002'))
+
+        owner = Owner.objects.get(iin='900101300123')
+        owner.full_name = 'Иванов Иван Иванович'
+        owner.save()
+        self.assertEqual(self.lookup(4)['owner']['full_name'], 'Иванов Иван Иванович')
+
+        license = DriverLicense.objects.create(owner=owner, number='KZ003', categories='B', issued_at=date.today(),
+                                               expires_at=date.today() + timedelta(days=3650), status='valid')
+        self.assertEqual(self.lookup(4)['driver_license']['number'], 'KZ003')
+
+        # Moving the license away drops both owners' entries
+        other = Owner.objects.create(full_name='Сидоров Сидор', iin='770707300789', dob=date(1977, 7, 7))
+        fragments.read_through('owner', [other.pk], 'default', lambda ids: {other.pk: 'stale'})
+        license.owner = other
+        license.save()
+        self.assertEqual(self.lookup(4)['driver_license']['number'], 'KZ002')
+        self.assertIsNone(caches['fragments'].get(fragments.make_key('owner', 'default', other.pk)))
+
+        DriverLicense.objects.get(number='KZ002').delete()
+        self.assertEqual(self.lookup(4)['driver_license']['number'], 'KZ001')
+
+    def test_insurer_writes(self):
+        self.lookup(5)
+        insurer = Insurer.objects.get(name='Jusan Insurance')
+        insurer.name = 'Jusan Garant'
+        insurer.save()
+        self.assertEqual(self.lookup(3)['insurance'][0]['insurer'], 'Jusan Garant')
+        self.lookup(2)
+        insurer.delete()
+        self.assertIsNone(self.lookup(2)['insurance'][0]['insurer'])
+
+
+class DatabaseGuardTests(TestCase):
+    LONG_QUERY = ('WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n WHERE i < 100000000) '
+                  'SELECT count(*) FROM n')
+
+    def breaker(self, **options):
+        options = dict(window=10.0, min_calls=4, error_rate=0.5, slow_call=0.25, slow_rate=0.8, open_for=5.0,
+                       half_open_calls=2, **options)
+        return dbguard.CircuitBreaker('default', **options)
+
+    def test_deadline_interrupts_a_long_query(self):
+        started = time.monotonic()
+        with mock.patch.dict(dbguard._breakers, {'default': self.breaker()}), \
+                self.assertRaises(dbguard.StatementTimeout), dbguard.deadline(0.05):
+            with connection.cursor() as cursor:
+                cursor.execute(self.LONG_QUERY)
+        self.assertLess(time.monotonic() - started, 2)
+        # The progress handler is gone once the statement ends
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT 1')
+
+    def test_deadline_bounds_a_lock_wait(self):
+        # A file database: the in-memory test database uses table locks, not the busy handler
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, 'locked.sqlite3')
+        holder = sqlite3.connect(path, isolation_level=None)
+        holder.execute('CREATE TABLE t (n INTEGER)')
+        self.addCleanup(holder.close)
+        guarded = SQLiteDatabaseWrapper(dict(connection.settings_dict, NAME=path), alias='locked')
+        self.addCleanup(guarded.close)
+        guarded.ensure_connection()
+
+        holder.execute('BEGIN IMMEDIATE')
+        started = time.monotonic()
+        with mock.patch.dict(dbguard._breakers, {'locked': self.breaker()}), \
+                self.assertRaises(dbguard.StatementTimeout), dbguard.deadline(0.2):
+            with guarded.cursor() as cursor:
+                cursor.execute('INSERT INTO t VALUES (1)')
+        # Not the connection's 5 s timeout
+        self.assertLess(time.monotonic() - started, 1.5)
+        holder.execute('ROLLBACK')
+
+        with guarded.cursor() as cursor:
+            cursor.execute('PRAGMA busy_timeout')
+            self.assertEqual(cursor.fetchone(), (5000,))
+
+    def test_deadline_hits_do_not_open_the_breaker(self):
+        breaker = self.breaker()
+        with mock.patch.dict(dbguard._breakers, {'default': breaker}):
+            for _ in range(6):
+                with self.assertRaises(dbguard.StatementTimeout), dbguard.deadline(0.01):
+                    with connection.cursor() as cursor:
+                        cursor.execute(self.LONG_QUERY)
+            self.assertEqual(breaker.snapshot(), {'state': 'closed', 'deadline_hits': 6})
+
+            # Six real errors against six deadline hits reach ERROR_RATE
+            for _ in range(6):
+                with self.assertRaises(OperationalError), dbguard.deadline(5):
+                    with connection.cursor() as cursor:
+                        cursor.execute('SELECT * FROM no_such_table')
+            self.assertEqual(breaker.state, 'open')
+            with self.assertRaises(dbguard.CircuitOpen), dbguard.deadline(5):
+                Plate.objects.count()
+            # Unguarded statements (management commands, admin) still run
+            Plate.objects.count()
+
+    def test_breaker_states(self):
+        clock = [1000.0]
+        breaker = self.breaker()
+        with mock.patch.object(dbguard.time, 'monotonic', side_effect=lambda: clock[0]):
+            for failed in (False, True, False):
+                self.assertEqual(breaker.allow(), 0)
+                breaker.record(0.01, failed)
+            self.assertEqual(breaker.state, 'closed')  # under MIN_CALLS
+            breaker.record(0.01, True)
+            self.assertEqual(breaker.state, 'open')
+            self.assertEqual(breaker.allow(), 5.0)
+
+            clock[0] += 5
+            self.assertEqual(breaker.allow(), 0)
+            self.assertEqual(breaker.state, 'half_open')
+            breaker.record(0.01, True)  # a failed trial opens it again
+            self.assertEqual(breaker.state, 'open')
+
+            clock[0] += 5
+            self.assertEqual((breaker.allow(), breaker.allow()), (0, 0))
+            self.assertEqual(breaker.allow(), 5.0)  # HALF_OPEN_CALLS trials at a time
+            breaker.record(0.5, False, timed_out=True)  # frees its trial slot
+            self.assertEqual(breaker.allow(), 0)
+            breaker.record(0.01, False)
+            breaker.record(0.01, False)
+            self.assertEqual(breaker.state, 'closed')
+
+            # Mostly slow statements open it as well
+            for _ in range(4):
+                breaker.record(0.3, False)
+            self.assertEqual(breaker.state, 'open')
+        self.assertEqual(breaker.counters, {'failures': 3, 'opened': 3, 'rejected': 2, 'closed': 1, 'deadline_hits': 1})
+
+
+class HealthProbeTests(TestCase):
+    def setUp(self):
+        health._report = (None, 0.0)
+
+    def test_ready_probe_is_cached_and_skips_registry_tables(self):
+        with CaptureQueriesContext(connection) as queries:
+            first = self.client.get(reverse('health_ready'))
+            for _ in range(5):
+                self.client.get(reverse('health_ready'))
+        self.assertEqual(first.status_code, 200)
+        self.assertTrue(first.json()['ready'])
+        self.assertEqual(first.json()['databases']['default']['pending_migrations'], 0)
+        sql = [q['sql'] for q in queries]
+        self.assertIn('SELECT 1', sql)
+        self.assertEqual(sql.count('SELECT 1'), 1)
+        for table in ('vehicles', 'plates', 'owners'):
+            self.assertFalse([s for s in sql if f'"{table}"' in s], table)
+
+    def test_not_ready_when_database_fails(self):
+        with mock.patch.object(health, '_pending_migrations', side_effect=dbguard.StatementTimeout('slow')):
+            response = self.client.get(reverse('health_ready'))
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.json()['databases']['default']['status'], 'timeout')
+        self.assertFalse(self.client.get(reverse('health')).json()['ok'])
+        self.assertEqual(self.client.get(reverse('health_live')).status_code, 200)
+
+
+class IntegrityAuditTests(TestCase):
+    """The checks' SQL, run in this process (workers need a file database)."""
+
+    @classmethod
+    def setUpTestData(cls):
+        seed_registry()
+        today = date.today()
+        fleet = Vehicle.objects.get(vin='WVWZZZ1JZXW000001')
+        cls.second = Plate.objects.create(vehicle=fleet, plate_number='456DEF03', region='03')
+        cls.overlap = InsurancePolicy.objects.create(
+            vehicle=fleet, policy_number='OSG-2', type='OSAGO', valid_from=today, valid_to=today + timedelta(days=30),
+            status='active',
+        )
+        cls.stale = InsurancePolicy.objects.create(
+            vehicle=Vehicle.objects.get(vin='WVWZZZ1JZXW000002'), policy_number='OSG-3', type='OSAGO',
+            valid_from=date(2020, 1, 1), valid_to=date(2021, 1, 1), status='active',
+        )
+        cls.orphan = Owner.objects.create(full_name='Без ТС', iin='900101300999')
+
+    def scan(self, name):
+        lo, hi = integrity.pk_bounds('default', integrity.CHECKS[name]['table'], integrity.CHECKS[name]['pk'])
+        with mock.patch.object(integrity, '_deadline_at', float('inf')):
+            return integrity.scan_chunk('default', name, lo, hi, date.today(), 10)
+
+    def test_checks_find_seeded_violations(self):
+        found = {name: self.scan(name) for name in integrity.CHECKS}
+        self.assertTrue(all(result['status'] == 'ok' for result in found.values()))
+        self.assertEqual([row['active_plates'] for row in found['multiple_active_plates']['samples']], [2])
+        self.assertEqual([row['plate_id'] for row in found['duplicate_active_plates']['samples']], [self.second.pk])
+        self.assertEqual([row['policy_id'] for row in found['overlapping_policies']['samples']], [self.overlap.pk])
+        self.assertEqual([row['policy_id'] for row in found['expired_active_policies']['samples']], [self.stale.pk])
+        self.assertEqual(found['expired_valid_licenses']['found'], 0)
+        self.assertEqual([row['owner_id'] for row in found['orphaned_owners']['samples']], [self.orphan.pk])
+
+    def test_plan_interleaves_checks(self):
+        databases, tasks = integrity.plan(['default'], ['orphaned_owners', 'duplicate_active_plates'], 1)
+        self.assertEqual([task[1] for task in tasks[:4]], ['orphaned_owners', 'duplicate_active_plates'] * 2)
+        self.assertEqual(databases['default']['duplicate_active_plates']['chunks'],
+                         len([task for task in tasks if task[1] == 'duplicate_active_plates']))
+
+
+def grow_registry(start, count):
+    """``count`` more vehicles with a row in every registry table, numbered from ``start``."""
+    insurer = Insurer.objects.get_or_create(name='Halyk')[0]
+    for i in range(start, start + count):
+        owner = Owner.objects.create(full_name=f'Владелец {i}', iin=f'{800000000000 + i:012d}')
+        DriverLicense.objects.create(owner=owner, number=f'GR{i}', categories='B', issued_at=date(2015, 1, 1),
+                                     expires_at=date(2035, 1, 1), status='valid')
+        vehicle = Vehicle.objects.create(owner=owner, vin=f'GROW{i:013d}', make=f'Make{i % 3}', year=2000 + i % 7,
+                                         color=f'color{i % 4}')
+        plate = f'{i % 1000:03d}GRW{i % 20 + 1:02d}'
+        Plate.objects.create(vehicle=vehicle, plate_number=plate, region=plate[-2:])
+        PlateArchive.objects.create(plate_id=10_000 + i, vehicle=vehicle, plate_number=f'OLD{i}',
+                                    assigned_at=timezone.now(), released_at=timezone.now())
+        InsurancePolicy.objects.create(vehicle=vehicle, insurer=insurer, policy_number=f'GRP-{i}', type='OSAGO',
+                                       valid_from=date(2024, 1, 1), valid_to=date(2025, 1, 1), status='expired')
+        Accident.objects.create(vehicle=vehicle, date=date(2023, 1, 1), fault_party='other')
+        AccidentArchive.objects.create(accident_id=10_000 + i, vehicle=vehicle, date=date(2010, 1, 1))
+        PlateLookupStat.objects.create(plate_number=plate, lookups=i)
+        LookupAuditEvent.objects.create(occurred_at=timezone.now(), plate_number=plate, client='admin',
+                                        endpoint='check_plate', status_code=200)
+
+
+class PlateReassignmentTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.plates = seed_registry()
+
+    def active(self, vin):
+        return list(Plate.objects.filter(vehicle__vin=vin, released_at__isnull=True).values_list('plate_number', flat=True))
+
+    def test_swap_conflicts_and_single_invalidation(self):
+        outsider = Vehicle.objects.create(vin='WVWZZZ1JZXW000004')
+        Plate.objects.create(vehicle=outsider, plate_number='555ZZZ02', region='02')
+        pairs = [
+            ('WVWZZZ1JZXW000001', '777AAA02'),  # new plate
+            ('WVWZZZ1JZXW000002', '456DEF03'),  # already has it
+            ('WVWZZZ1JZXW000003', '555ZZZ02'),  # held outside the batch
+            ('WVWZZZ1JZXW000099', '111BBB02'),  # unknown
+        ]
+        generation = dossier_cache.generation()
+        report = replating.reassign(pairs, chunk_size=1)
+        self.assertEqual(report['reassigned'], 1)
+        self.assertEqual(report['unchanged'], [{'vin': 'WVWZZZ1JZXW000002', 'plate': '456DEF03'}])
+        self.assertEqual({c['vin']: c['reason'] for c in report['conflicts']},
+                         {'WVWZZZ1JZXW000003': 'plate_in_use', 'WVWZZZ1JZXW000099': 'unknown_vin'})
+        self.assertEqual(self.active('WVWZZZ1JZXW000001'), ['777AAA02'])
+        self.assertEqual(self.active('WVWZZZ1JZXW000003'), ['789GHI04'])
+        self.assertNotEqual(dossier_cache.generation(), generation)
+
+        # A swap inside the batch stays in one chunk whatever the chunk size
+        generation = dossier_cache.generation()
+        report = replating.reassign([('WVWZZZ1JZXW000001', '555ZZZ02'), ('WVWZZZ1JZXW000004', '777AAA02')],
+                                    chunk_size=1)
+        self.assertEqual((report['reassigned'], report['conflicts'], report['chunks']), (2, [], 1))
+        self.assertEqual(self.active('WVWZZZ1JZXW000001'), ['555ZZZ02'])
+        self.assertEqual(self.active('WVWZZZ1JZXW000004'), ['777AAA02'])
+        self.assertEqual(dossier_cache.generation(), generation + 1)
+
+    def test_endpoint_requires_staff(self):
+        url = reverse('reassign_plates')
+        body = {'assignments': [{'vin': 'wvwzzz1jzxw000001', 'plate': ' 777aaa02 '}], 'dry_run': True}
+        self.assertEqual(self.client.post(url, body, content_type='application/json').status_code, 403)
+        self.client.force_login(User.objects.create_user('clerk', is_staff=True))
+        response = self.client.post(url, body, content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual((response.json()['reassigned'], response.json()['dry_run']), (1, True))
+        self.assertEqual(self.active('WVWZZZ1JZXW000001'), ['123ABC02'])
+
+
+class DossierExportTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.plates = seed_registry()
+
+    def export(self, **options):
+        sections = frozenset(dossier.SECTIONS)
+        lines = gzip.decompress(b''.join(export.stream(sections, **options))).decode().splitlines()
+        return [json.loads(line) for line in lines]
+
+    def test_chunks_checkpoints_and_resume(self):
+        sections = frozenset(dossier.SECTIONS)
+        expected = json.loads(JSONRenderer().render(dossier.build_dossiers(
+            dossier.active_plates(sections).order_by('plate_id'), sections
+        )))
+        records = self.export(chunk_size=2)
+        self.assertEqual([r for r in records if 'plate' in r], expected)
+        checkpoints = [r for r in records if 'cursor' in r]
+        self.assertEqual(len(checkpoints), 3)
+        self.assertTrue(checkpoints[-1]['complete'])
+
+        resumed = self.export(chunk_size=2, cursor=export.decode_cursor(checkpoints[0]['cursor']))
+        self.assertEqual([r for r in resumed if 'plate' in r], expected[2:])
+
+        month_ago = timezone.now() - timedelta(days=30)
+        Plate.objects.exclude(plate_number=self.plates[0]).update(assigned_at=month_ago)
+        VehicleRiskSummary.objects.update(updated_at=month_ago)
+        since = timezone.now() - timedelta(days=1)
+        self.assertEqual([r['plate'] for r in self.export(since=since) if 'plate' in r], [self.plates[0]])
+        Accident.objects.create(vehicle=Vehicle.objects.get(vin='WVWZZZ1JZXW000002'), date=date.today())
+        self.assertEqual([r['plate'] for r in self.export(since=since) if 'plate' in r], self.plates[:2])
+        self.assertEqual([r['plate'] for r in self.export(region='03') if 'plate' in r], [self.plates[1]])
+
+    def test_one_export_at_a_time(self):
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@example.com', 'admin'))
+        with mock.patch.object(audit.writer, 'record'):
+            first = self.client.get('/api/export/dossiers/')
+            self.assertEqual(first.status_code, 200)
+            # The first body is still being streamed: its slot is held
+            second = self.client.get('/api/export/dossiers/', HTTP_X_REQUEST_TIMEOUT='0.01')
+            self.assertEqual(second.status_code, 503)
+            self.assertIn('Retry-After', second)
+            b''.join(first.streaming_content)
+            self.assertEqual(admission.snapshot()['export_dossiers']['active'], 0)
+            third = self.client.get('/api/export/dossiers/')
+            self.assertEqual(third.status_code, 200)
+            b''.join(third.streaming_content)
+
+
+class RequestProfilingTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.plates = seed_registry()
+
+    def test_token_header_profiles_into_ring_buffer(self):
+        with tempfile.TemporaryDirectory() as directory, override_settings(PROFILING={
+            'TOKEN': 'secret', 'DIRECTORY': directory, 'MAX_PROFILES': 2, 'PROFILER': 'cprofile',
+        }):
+            # plate_history writes no audit events or lookup counters
+            url = reverse('plate_history', args=[self.plates[0]])
+            self.assertNotIn('X-Profile-Id', self.client.get(url))
+            self.assertNotIn('X-Profile-Id', self.client.get(url, HTTP_X_PROFILE='wrong'))
+            ids = [self.client.get(url, HTTP_X_PROFILE='secret')['X-Profile-Id'] for _ in range(3)]
+            self.assertEqual(len(set(ids)), 3)
+            self.assertEqual(len([name for name in os.listdir(directory) if name.endswith('.txt')]), 2)
+            with open(os.path.join(directory, f'{ids[-1]}.txt'), encoding='utf-8') as f:
+                report = f.read()
+            self.assertIn('time by area', report)
+            self.assertIn('top allocations', report)
+
+    def test_staff_sessions_profile_without_token(self):
+        url = reverse('plate_history', args=[self.plates[0]])
+        with tempfile.TemporaryDirectory() as directory, override_settings(PROFILING={
+            'DIRECTORY': directory, 'PROFILER': 'cprofile', 'MEMORY': False,
+        }):
+            # No TOKEN configured: the header alone is not enough
+            self.assertNotIn('X-Profile-Id', self.client.get(url, HTTP_X_PROFILE='1'))
+            self.client.force_login(User.objects.create_user('clerk'))
+            self.assertNotIn('X-Profile-Id', self.client.get(url, HTTP_X_PROFILE='1'))
+            self.client.force_login(User.objects.create_user('auditor', is_staff=True))
+            self.assertNotIn('X-Profile-Id', self.client.get(url))
+            self.assertIn('X-Profile-Id', self.client.get(url, HTTP_X_PROFILE='1'))
+            # One profiled request per process at a time
+            with profiling._busy:
+                self.assertNotIn('X-Profile-Id', self.client.get(url, HTTP_X_PROFILE='1'))
+
+    def test_save_keeps_the_newest_reports(self):
+        with tempfile.TemporaryDirectory() as directory:
+            config = dict(profiling.DEFAULTS, DIRECTORY=directory, MAX_PROFILES=2)
+            with profiling.Profile('cprofile', memory=False) as profile:
+                sum(range(1000))
+            old = profiling.save(profile, 'old', config)
+            for suffix in ('.txt', '.prof'):
+                os.utime(os.path.join(directory, old + suffix), (0, 0))
+            ids = [profiling.save(profile, 'check_plate', config) for _ in range(3)]
+            self.assertEqual(sorted(os.listdir(directory)),
+                             sorted(f'{stem}{suffix}' for stem in ids[-2:] for suffix in ('.txt', '.prof')))
+
+    def test_unwritable_directory_does_not_fail_the_request(self):
+        url = reverse('plate_history', args=[self.plates[0]])
+        with override_settings(PROFILING={'TOKEN': 'secret', 'PROFILER': 'cprofile', 'MEMORY': False}), \
+                mock.patch.object(profiling, 'save', side_effect=OSError(28, 'No space left on device')), \
+                self.assertLogs('api.profiling', 'ERROR'):
+            response = self.client.get(url, HTTP_X_PROFILE='secret')
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('X-Profile-Id', response)
+
+
+class MaterializedDossierTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.plates = seed_registry()
+
+    def live(self, plate, sections=materialized.ALL_SECTIONS, accidents_limit=dossier.DEFAULT_ACCIDENTS):
+        return JSONRenderer().render(dossier.load_dossier(plate, sections, accidents_limit)).decode()
+
+    def lookup(self, plate, sections=materialized.ALL_SECTIONS, accidents_limit=dossier.DEFAULT_ACCIDENTS):
+        return materialized.lookup(plate, sections, accidents_limit)
+
+    def test_lookup_is_one_read_matching_live_assembly(self):
+        # The seed's writes queued every vehicle
+        self.assertIsNone(self.lookup(self.plates[0]))
+        self.assertEqual(materialized.drain('default'), 3)
+        for plate in self.plates:
+            expected = self.live(plate)
+            with self.assertNumQueries(1):
+                self.assertEqual(self.lookup(plate), expected)
+        subset = frozenset(['vehicle', 'accidents'])
+        self.assertEqual(self.lookup(self.plates[0], subset, 3), self.live(self.plates[0], subset, 3))
+        self.assertIsNone(self.lookup(self.plates[0], accidents_limit=dossier.DEFAULT_ACCIDENTS + 1))
+        result = materialized.check_range('default', 0, 10 ** 9)
+        self.assertEqual((result['checked'], result['counts']), (3, {'missing': 0, 'mismatched': 0, 'orphaned': 0}))
+
+    def test_writes_queue_vehicles_until_refreshed(self):
+        materialized.drain('default')
+        fleet = Vehicle.objects.get(vin='WVWZZZ1JZXW000001')
+        with self.captureOnCommitCallbacks(execute=True):
+            fleet.color = 'красный'
+            fleet.save()
+            self.assertIsNone(self.lookup(self.plates[0]))
+        self.assertEqual(self.lookup(self.plates[0]), self.live(self.plates[0]))
+        self.assertIn('красный', self.lookup(self.plates[0]))
+
+        released = Plate.objects.get(plate_number=self.plates[1])
+        released.released_at = timezone.now()
+        released.save()
+        fleet.owner.save()
+        self.assertEqual(set(DossierRefresh.objects.values_list('vehicle_id', flat=True)),
+                         {released.vehicle_id, fleet.pk, Vehicle.objects.get(vin='WVWZZZ1JZXW000003').pk})
+        materialized.drain('default')
+        self.assertIsNone(MaterializedDossier.objects.get(pk=self.plates[1]).body)
+        self.assertIsNone(self.lookup(self.plates[1]))
+
+        MaterializedDossier.objects.filter(pk=self.plates[2]).update(body='{}')
+        result = materialized.check_range('default', 0, 10 ** 9)
+        self.assertEqual(result['mismatched'], [(self.plates[2], Vehicle.objects.get(vin='WVWZZZ1JZXW000003').pk)])
+
+
+class PartMaskTests(TestCase):
+    """Accident.damaged_parts_mask follows the M2M and the catalog follows CarPart writes."""
+
+    def setUp(self):
+        parts.invalidate()
+        owner = Owner.objects.create(full_name='Петров Петр', iin='850505300456', dob=date(1985, 5, 5))
+        vehicle = Vehicle.objects.create(owner=owner, vin='WVWZZZ1JZXW000009')
+        self.accidents = [Accident.objects.create(vehicle=vehicle, date=date(2024, 1, k + 1), fault_party='other')
+                          for k in range(2)]
+        self.hood = CarPart.objects.create(name='Капот', category='Кузов')
+        self.glass = CarPart.objects.create(name='Лобовое стекло', category='Стекло')
+        # Past int4: PostgreSQL would shift a plain integer 1 modulo 32
+        self.mirror = CarPart.objects.create(name='Зеркало', category='Кузов', bit=40)
+
+    def masks(self):
+        return [Accident.objects.get(pk=accident.pk).damaged_parts_mask for accident in self.accidents]
+
+    def test_m2m_changes_sync_masks(self):
+        first, second = self.accidents
+        first.damaged_parts.add(self.hood, self.mirror)
+        self.assertEqual(first.damaged_parts_mask, 1 << self.hood.bit | 1 << 40)
+        first.damaged_parts.remove(self.hood)
+        second.damaged_parts.set([self.glass, self.hood])
+        self.assertEqual(self.masks(), [1 << 40, 1 << self.glass.bit | 1 << self.hood.bit])
+
+        self.glass.accidents.add(first)
+        self.hood.accidents.remove(second)
+        self.assertEqual(self.masks(), [1 << 40 | 1 << self.glass.bit, 1 << self.glass.bit])
+        self.glass.accidents.clear()
+        self.assertEqual(self.masks(), [1 << 40, 0])
+        first.damaged_parts.clear()
+        self.assertEqual(self.masks(), [0, 0])
+
+        second.damaged_parts.set([self.mirror])
+        self.mirror.delete()
+        self.assertEqual(self.masks(), [0, 0])
+
+    def test_high_bits_decode_and_filter(self):
+        first, second = self.accidents
+        first.damaged_parts.set([self.mirror, self.glass])
+        second.damaged_parts.set([self.hood])
+        self.assertEqual(parts.refresh_masks('default'), 2)
+        self.assertEqual(self.masks(), [1 << 40 | 1 << self.glass.bit, 1 << self.hood.bit])
+        self.assertEqual([part.name for part in parts.catalog().decode(self.masks()[0])], ['Зеркало', 'Лобовое стекло'])
+        self.assertEqual(
+            list(Accident.objects.filter(damaged_parts_mask__has_any=parts.mask_of(['Зеркало'])).values_list('pk', flat=True)),
+            [first.pk],
+        )
+
+    def test_catalog_follows_writes_in_other_workers(self):
+        self.assertNotIn('Бампер', parts.catalog().by_name)
+        # Another worker adds a part: this process only sees the bumped generation
+        with mock.patch.object(parts, 'invalidate'):
+            CarPart.objects.create(name='Бампер', category='Кузов')
+        caches['fragments'].incr(parts.generation_key('default'))
+        with self.assertNumQueries(0):
+            self.assertNotIn('Бампер', parts.catalog().by_name)
+        with override_settings(FRAGMENT_CACHE={'CATALOG_CHECK': 0}):
+            self.assertIn('Бампер', parts.catalog().by_name)
+            with self.assertNumQueries(0):
+                self.assertIn('Бампер', parts.catalog().by_name)
+
+
+@override_settings(DOSSIER_CACHE={'TTL': 0}, FRAGMENT_CACHE={'TTL': 0})
+class QueryPlanTests(TestCase):
+    """Lookup endpoints must not scan a table or sort its rows in a temp B-tree."""
+
+    maxDiff = None
+
+    # The part catalog (at most 63 rows) is read whole: by api.parts and,
+    # aliased cp, by the damaged-parts decode of api.sqljson
+    FULL_SCAN_ALLOWED = {'car_parts', 'cp'}
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.plates = seed_registry()
+
+    def setUp(self):
+        parts.invalidate()
+
+    def plan_problems(self, sql):
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN QUERY PLAN ' + sql)
+            plan = cursor.fetchall()
+        # Sorting a subquery's output (already cut down by LIMIT or a window
+        # filter) is fine; sorting rows read from a table is not
+        derived = {detail.split(' ', 1)[1] for _, _, _, detail in plan
+                   if detail.startswith(('CO-ROUTINE ', 'MATERIALIZE '))}
+        reads_table = set()
+        problems = []
+        for _, parent, _, detail in plan:
+            verb, _, rest = detail.partition(' ')
+            if verb in ('SCAN', 'SEARCH'):
+                name = rest.split(' ', 1)[0]
+                if name in derived or name.startswith('(subquery-'):
+                    continue
+                reads_table.add(parent)
+                if verb == 'SCAN' and name not in self.FULL_SCAN_ALLOWED:
+                    problems.append(detail)
+        problems += [detail for _, parent, _, detail in plan
+                     if detail.startswith('USE TEMP B-TREE') and parent in reads_table]
+        return problems
+
+    def test_lookup_endpoints_use_indexes(self):
+        calls = [
+            lambda: self.client.get(f'/api/check/{self.plates[0]}/', HTTP_ACCEPT='application/json'),
+            lambda: self.client.get(f'/api/check/{self.plates[0]}/', HTTP_ACCEPT='application/msgpack'),
+            lambda: self.client.post('/api/check/batch/', {'plates': self.plates}, content_type='application/json'),
+            lambda: self.client.get('/api/vin/WVWZZZ1JZXW000001/'),
+            lambda: self.client.get(f'/api/history/{self.plates[0]}/'),
+            lambda: self.client.get(f'/api/history/{self.plates[0]}/?vehicle=1'),
+        ]
+        queries = []
+        with mock.patch.object(audit.writer, 'record'), mock.patch.object(stats.lookups, 'record'):
+            # Queued vehicles go through the live paths, drained ones through
+            # the materialized table
+            for drain in (False, True):
+                if drain:
+                    materialized.drain('default')
+                for call in calls:
+                    with CaptureQueriesContext(connection) as captured:
+                        self.assertEqual(call().status_code, 200)
+                    queries += [q['sql'] for q in captured if q['sql'].startswith('SELECT')]
+        self.assertIn('json_object(', ' '.join(queries))
+        self.assertIn('materialized_dossiers', ' '.join(queries))
+        problems = {sql: found for sql in dict.fromkeys(queries) if (found := self.plan_problems(sql))}
+        self.assertEqual(problems, {})
+
+
+class AdminQueryBudgetTests(TestCase):
+    """Changelist query counts must not depend on table size."""
+
+    # Session, user, row estimate (MAX(pk)), capped COUNT and the page
+    # itself, plus one query per list filter that reads its choices
+    BUDGETS = {
+        'owner': 5,
+        'driverlicense': 5,
+        'vehicle': 8,
+        'plate': 5,
+        'insurer': 5,
+        'insurancepolicy': 6,
+        'carpart': 6,
+        'accident': 5,
+        'platelookupstat': 4,
+        'lookupauditevent': 5,
+        'platearchive': 5,
+        'accidentarchive': 5,
+        'vehiclerisksummary': 5,
+    }
+    # Small reference tables keep the stock admin
+    REFERENCE = {'insurer', 'carpart'}
+
+    @classmethod
+    def setUpTestData(cls):
+        seed_registry()
+        cls.user = User.objects.create_superuser('admin', 'admin@example.com', 'admin')
+
+    def setUp(self):
+        self.client.force_login(self.user)
+
+    def changelist_queries(self, model, query=''):
+        url = reverse(f'admin:api_{model._meta.model_name}_changelist') + query
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200, url)
+        return [q['sql'] for q in queries]
+
+    def test_every_changelist_has_a_budget(self):
+        registered = {model._meta.model_name for model in admin.site._registry if model._meta.app_label == 'api'}
+        self.assertEqual(registered, set(self.BUDGETS))
+
+    def test_changelists_within_budget(self):
+        models = [model for model in admin.site._registry if model._meta.app_label == 'api']
+        grow_registry(0, 3)
+        before = {model: len(self.changelist_queries(model)) for model in models}
+        grow_registry(3, 60)
+        for model in models:
+            name = model._meta.model_name
+            queries = self.changelist_queries(model)
+            self.assertLessEqual(len(queries), self.BUDGETS[name], f'{name}: {queries}')
+            self.assertEqual(len(queries), before[model], f'{name} grows with the table')
+            if name not in self.REFERENCE:
+                self.assertFalse([sql for sql in queries if 'COUNT(' in sql and 'LIMIT' not in sql],
+                                 f'{name} runs an exact COUNT(*)')
+
+    def test_search_within_budget(self):
+        grow_registry(0, 30)
+        for model, term in [(Plate, '007grw08'), (Vehicle, 'GROW0000000000007'), (Owner, '800000000007'),
+                            (DriverLicense, 'gr7'), (InsurancePolicy, 'GRP-7'), (Accident, 'GROW0000000000007')]:
+            queries = self.changelist_queries(model, f'?q={term}')
+            self.assertLessEqual(len(queries), self.BUDGETS[model._meta.model_name], queries)
+            self.assertTrue(any('LIMIT' in sql and 'COUNT(' in sql for sql in queries))
+
+    def test_vehicle_widgets_are_not_dropdowns(self):
+        grow_registry(0, 5)
+        vehicle = Vehicle.objects.get(vin='GROW0000000000003')
+        response = self.client.get(reverse('admin:api_plate_change', args=[vehicle.plates.get().pk]))
+        self.assertContains(response, 'vForeignKeyRawIdAdminField')
+        self.assertNotContains(response, 'GROW0000000000004')
@@ -3,6 +3,17 @@ from . import views
 
 urlpatterns = [
     path('health/', views.health_check, name='health'),
+    path('health/live/', views.health_live, name='health_live'),
+    path('health/ready/', views.health_ready, name='health_ready'),
+    path('metrics/', views.metrics, name='metrics'),
     path('list/', views.list_plates, name='list_plates'),
+    path('list/stream/', views.stream_plates, name='stream_plates'),
+    path('export/dossiers/', views.export_dossiers, name='export_dossiers'),
+    path('stats/hot/', views.hot_plates, name='hot_plates'),
+    path('check/batch/', views.check_batch, name='check_batch'),
+    path('plates/reassign/', views.reassign_plates, name='reassign_plates'),
     path('check/<str:plate>/', views.check_plate, name='check_plate'),
+    path('vin/<str:vin>/', views.check_vin, name='check_vin'),
+    path('vehicles/search/', views.search_vehicles, name='search_vehicles'),
+    path('history/<str:plate>/', views.plate_history, name='plate_history'),
 ]
@@ -1,25 +1,70 @@
-import re
-from django.http import JsonResponse
+import heapq
+import math
+import os
+from itertools import islice
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
 from django.db.models import Q
+from django.utils import timezone
 from rest_framework import status
-from rest_framework.decorators import api_view, permission_classes
-from rest_framework.permissions import AllowAny
+from rest_framework.decorators import api_view, permission_classes, renderer_classes
+from rest_framework.permissions import AllowAny, IsAdminUser
+from rest_framework.renderers import JSONRenderer
 from rest_framework.response import Response
 from drf_spectacular.utils import extend_schema, OpenApiParameter, OpenApiExample
 from drf_spectacular.types import OpenApiTypes
-from .models import Vehicle, Plate
+from . import (
+    admission, audit, dbguard, dossier, export, fragments, health, history, kzplates, materialized, renderers, replating,
+    search, shards, sqljson, stats,
+)
+from . import cache as dossier_cache
+from .models import Vehicle, Plate, PlateLookupStat
 from .serializers import VehicleDetailSerializer
 
 
+MAX_BATCH_PLATES = 500
+MAX_REASSIGN_PAIRS = 10000
+STREAM_CHUNK_SIZE = 2000
+
+
 def normalize_plate(plate_number):
-    """Normalize plate number by removing spaces and converting to uppercase"""
-    return re.sub(r"\s+", "", plate_number).upper()
+    """Normalize plate number: drop separators, uppercase, fold Cyrillic look-alikes (see api.kzplates)"""
+    return kzplates.normalize(plate_number)
+
+
+def invalid_plate():
+    return Response({"detail": "invalid plate number"}, status=status.HTTP_400_BAD_REQUEST)
+
+
+def active_plate_numbers(using):
+    return (
+        Plate.objects.using(using)
+        .filter(released_at__isnull=True)
+        .order_by('plate_number')
+        .values_list('plate_number', flat=True)
+    )
+
+
+def db_unavailable(error):
+    """503 for statements cut off by their deadline or refused by an open circuit breaker"""
+    response = Response({"detail": f"db_unavailable: {error}"}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+    response['Retry-After'] = str(max(1, math.ceil(error.retry_after)))
+    return response
+
+
+def chunked(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
 
 
 @extend_schema(
     operation_id='health_check',
     summary='Проверка состояния API',
-    description='Проверяет состояние API и подключение к базе данных',
+    description='Проверяет состояние API и подключение к базе данных (результат `SELECT 1`, '
+                'кэшируется на `HEALTH_CHECKS[\'CHECK_INTERVAL\']` секунд)',
     tags=['Health'],
     responses={
         200: {
@@ -27,7 +72,8 @@ def normalize_plate(plate_number):
             'examples': {
                 'application/json': {
                     'ok': True,
-                    'database': 'connected'
+                    'database': 'connected',
+                    'circuit_breakers': {'default': 'closed'}
                 }
             }
         },
@@ -35,8 +81,9 @@ def normalize_plate(plate_number):
             'description': 'Проблемы с подключением к базе данных',
             'examples': {
                 'application/json': {
-                    'ok': True,
-                    'database': 'not_connected'
+                    'ok': False,
+                    'database': 'not_connected',
+                    'circuit_breakers': {'default': 'open'}
                 }
             }
         }
@@ -46,12 +93,142 @@ def normalize_plate(plate_number):
 @permission_classes([AllowAny])
 def health_check(request):
     """Health check endpoint"""
+    breakers = {alias: dbguard.get_breaker(alias).state for alias in shards.aliases()}
+    connected = all(db['status'] == 'ok' for db in health.readiness()['databases'].values())
+    return Response(
+        {"ok": connected, "database": "connected" if connected else "not_connected", "circuit_breakers": breakers},
+        status=status.HTTP_200_OK if connected else status.HTTP_503_SERVICE_UNAVAILABLE,
+    )
+
+
+@extend_schema(
+    operation_id='health_live',
+    summary='Liveness probe',
+    description='Процесс жив и обслуживает запросы. База данных и кэш не проверяются',
+    tags=['Health'],
+    responses={200: OpenApiTypes.OBJECT},
+)
+@api_view(['GET'])
+@permission_classes([AllowAny])
+def health_live(request):
+    """Liveness probe: answered from memory"""
+    return Response(health.liveness())
+
+
+@extend_schema(
+    operation_id='health_ready',
+    summary='Readiness probe',
+    description='Готовность принимать трафик: каждая база отвечает на `SELECT 1` за `DB_TIMEOUT` секунд и '
+                'не имеет непримененных миграций. Результат кэшируется на `CHECK_INTERVAL` секунд '
+                '(поле `age`); таблицы реестра не читаются. Дополнительно: возраст соединений, '
+                'прогрет ли кэш досье и отставание фоновых писателей',
+    tags=['Health'],
+    responses={
+        200: {
+            'description': 'Готов',
+            'examples': {
+                'application/json': {
+                    'ready': True,
+                    'databases': {
+                        'default': {'status': 'ok', 'vendor': 'sqlite', 'conn_max_age': 0,
+                                    'pending_migrations': 0, 'latency': 0.0003, 'connection_age': 0.002}
+                    },
+                    'dossier_cache': {'warm': True},
+                    'age': 1.204,
+                    'writers': {'lookup_stats': {'lag': 0.4, 'stale': False}, 'audit': {'lag': 0.0, 'stale': False}}
+                }
+            }
+        },
+        503: {
+            'description': 'База недоступна или есть непримененные миграции',
+            'examples': {
+                'application/json': {
+                    'ready': False,
+                    'databases': {
+                        'default': {'status': 'timeout', 'vendor': 'postgresql', 'conn_max_age': 60,
+                                    'pending_migrations': None}
+                    },
+                    'dossier_cache': {'warm': None},
+                    'age': 0.0,
+                    'writers': {'lookup_stats': {'lag': 0.0, 'stale': False}, 'audit': {'lag': 0.0, 'stale': False}}
+                }
+            }
+        }
+    }
+)
+@api_view(['GET'])
+@permission_classes([AllowAny])
+def health_ready(request):
+    """Readiness probe: cached database check, never touches the registry tables"""
+    report = health.readiness()
+    return Response(report, status=status.HTTP_200_OK if report['ready'] else status.HTTP_503_SERVICE_UNAVAILABLE)
+
+
+@extend_schema(
+    operation_id='metrics',
+    summary='Метрики процесса',
+    description='Счётчики admission control (принятые и отброшенные запросы), состояние circuit breaker и кэшей '
+                'для текущего worker-процесса',
+    tags=['Health'],
+    responses={200: OpenApiTypes.OBJECT},
+)
+@api_view(['GET'])
+@permission_classes([AllowAny])
+def metrics(request):
+    """Per-process operational counters"""
+    return Response({
+        "pid": os.getpid(),
+        "admission": admission.snapshot(),
+        "db_guard": dbguard.snapshot(),
+        "dossier_cache": dossier_cache.stats(),
+        "fragment_cache": fragments.stats(),
+        "materialized_dossiers": materialized.stats(),
+        "lookup_stats": stats.lookups.snapshot(),
+        "audit": audit.writer.snapshot(),
+    })
+
+
+@extend_schema(
+    operation_id='hot_plates',
+    summary='Самые запрашиваемые номера',
+    description='Топ номеров по числу проверок: накопленные счётчики из базы (все worker-процессы) '
+                'и оценка count-min sketch для текущего процесса',
+    tags=['Plates'],
+    parameters=[
+        OpenApiParameter(
+            name='limit',
+            type=OpenApiTypes.INT,
+            location=OpenApiParameter.QUERY,
+            required=False,
+            description='Сколько номеров вернуть (по умолчанию 20)'
+        )
+    ],
+    responses={200: OpenApiTypes.OBJECT},
+)
+@api_view(['GET'])
+@permission_classes([AllowAny])
+def hot_plates(request):
+    """Most looked-up plates"""
     try:
-        # Test database connection
-        Vehicle.objects.first()
-        return Response({"ok": True, "database": "connected"})
+        limit = min(max(int(request.query_params.get('limit', 20)), 1), 1000)
+    except ValueError:
+        return Response({"detail": "limit must be an integer"}, status=status.HTTP_400_BAD_REQUEST)
+    try:
+        return Response({
+            "persisted": [
+                {"plate": plate, "lookups": lookups}
+                for plate, lookups in PlateLookupStat.objects.order_by('-lookups').values_list('plate_number', 'lookups')[:limit]
+            ],
+            "process": [
+                {"plate": plate, "estimate": estimate}
+                for plate, estimate in stats.lookups.hot.most_common(limit)
+            ],
+        })
     except Exception as e:
-        return Response({"ok": True, "database": "not_connected"}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+        return Response(
+            {"detail": f"db_error: {type(e).__name__}: {e}"}, 
+            status=status.HTTP_500_INTERNAL_SERVER_ERROR
+        )
 
 
 @extend_schema(
@@ -76,6 +253,14 @@ def health_check(request):
                     'detail': 'db_error: DatabaseError: connection failed'
                 }
             }
+        },
+        503: {
+            'description': 'Сервис перегружен, запрос отклонён (см. заголовок Retry-After)',
+            'examples': {
+                'application/json': {
+                    'detail': 'overloaded: latency_budget'
+                }
+            }
         }
     }
 )
@@ -84,9 +269,12 @@ def health_check(request):
 def list_plates(request):
     """List all current plate numbers"""
     try:
-        current_plates = Plate.objects.filter(released_at__isnull=True).order_by('plate_number')
-        plates = [plate.plate_number for plate in current_plates]
+        # Each shard returns its plates sorted; merge them into one list
+        per_shard = shards.fan_out(lambda alias: list(active_plate_numbers(alias)))
+        plates = shards.merge_sorted(per_shard)
         return Response({"plates": plates, "count": len(plates)})
+    except dbguard.DatabaseUnavailable as e:
+        return db_unavailable(e)
     except Exception as e:
         return Response(
             {"detail": f"db_error: {type(e).__name__}: {e}"}, 
@@ -104,11 +292,37 @@ def list_plates(request):
             name='plate',
             type=OpenApiTypes.STR,
             location=OpenApiParameter.PATH,
-            description='Номерной знак транспортного средства',
+            description='Номерной знак транспортного средства: 123ABC02 или 123AB02 (код региона 01-20). '
+                        'Пробелы и дефисы не важны, регистр и кириллические буквы-двойники (А, В, Е, К...) '
+                        'приводятся к латинице',
             examples=[
                 OpenApiExample('Пример 1', value='123ABC02'),
                 OpenApiExample('Пример 2', value='456DEF03'),
             ]
+        ),
+        OpenApiParameter(
+            name='fields',
+            type=OpenApiTypes.STR,
+            location=OpenApiParameter.QUERY,
+            required=False,
+            description='Разделы досье через запятую: vehicle, owner, driver_license, insurance, accidents, risk. '
+                        'Незапрошенные разделы не загружаются из базы',
+            examples=[OpenApiExample('Только ТС и страховка', value='vehicle,insurance')]
+        ),
+        OpenApiParameter(
+            name='exclude',
+            type=OpenApiTypes.STR,
+            location=OpenApiParameter.QUERY,
+            required=False,
+            description='Разделы досье, которые нужно исключить (через запятую)',
+            examples=[OpenApiExample('Без аварий', value='accidents')]
+        ),
+        OpenApiParameter(
+            name='accidents',
+            type=OpenApiTypes.INT,
+            location=OpenApiParameter.QUERY,
+            required=False,
+            description=f'Сколько последних аварий вернуть (0-{dossier.MAX_ACCIDENTS}, по умолчанию {dossier.DEFAULT_ACCIDENTS})'
         )
     ],
     responses={
@@ -173,7 +387,24 @@ def list_plates(request):
                                 }
                             ]
                         }
-                    ]
+                    ],
+                    'risk': {
+                        'accidents': 1,
+                        'at_fault_accidents': 0,
+                        'last_accident_at': '2024-05-10',
+                        'osago_active': True,
+                        'osago_valid_to': '2025-12-31',
+                        'kasko_active': False,
+                        'kasko_valid_to': None
+                    }
+                }
+            }
+        },
+        400: {
+            'description': 'Неверный формат номера (invalid plate number) или параметры запроса',
+            'examples': {
+                'application/json': {
+                    'detail': 'unknown fields: foo'
                 }
             }
         },
@@ -192,6 +423,15 @@ def list_plates(request):
                     'detail': 'db_error: DatabaseError: connection failed'
                 }
             }
+        },
+        503: {
+            'description': 'Сервис перегружен или база данных не ответила вовремя / отключена circuit breaker, '
+                           'а в кэше нет досье (см. заголовок Retry-After)',
+            'examples': {
+                'application/json': {
+                    'detail': 'overloaded: latency_budget'
+                }
+            }
         }
     }
 )
@@ -200,104 +440,490 @@ def list_plates(request):
 def check_plate(request, plate):
     """Check vehicle information by plate number"""
     try:
-        plate_norm = normalize_plate(plate)
+        sections, accidents_limit = dossier.parse_params(request.query_params)
+    except ValueError as e:
+        return Response({"detail": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+    # Malformed input never reaches the cache or a database; numbers stored
+    # before the format was enforced are still looked up
+    plate_norm, _ = kzplates.parse(plate, legacy=True)
+    if plate_norm is None:
+        return invalid_plate()
+
+    try:
+        # JSON clients can get the dossier built as JSON text by the database
+        as_sql_json = type(request.accepted_renderer) is JSONRenderer and sqljson.supported(plate_norm)
+        
+        # Concurrent lookups of the same plate share one computation; an
+        # expired cached dossier is served while it is refreshed. A miss
+        # reads the materialized dossier before assembling one
+        if as_sql_json:
+            result = dossier_cache.get_dossier(
+                plate_norm, sections, accidents_limit,
+                lambda: (materialized.lookup(plate_norm, sections, accidents_limit)
+                         or sqljson.load_dossier_json(plate_norm, sections, accidents_limit)),
+                variant='sql-json',
+            )
+        else:
+            result = dossier_cache.get_dossier(
+                plate_norm, sections, accidents_limit,
+                lambda: dossier.load_dossier(plate_norm, sections, accidents_limit)
+            )
         
-        # Find the vehicle with this plate number
-        current_plate = Plate.objects.filter(
-            plate_number__iexact=plate_norm,
-            released_at__isnull=True
-        ).select_related('vehicle', 'vehicle__owner').first()
+        audit.writer.record(
+            plate_norm, audit.client_label(request), request.META.get('REMOTE_ADDR'),
+            'check_plate', ','.join(sorted(sections)), 404 if result is None else 200
+        )
         
-        if not current_plate:
+        if result is None:
             return Response(
                 {"detail": "plate not found"}, 
                 status=status.HTTP_404_NOT_FOUND
             )
         
-        vehicle = current_plate.vehicle
-        
-        # Get owner information
-        owner_data = None
-        if vehicle.owner:
-            owner_data = {
-                'owner_id': vehicle.owner.owner_id,
-                'full_name': vehicle.owner.full_name,
-                'iin': vehicle.owner.iin,
-                'dob': vehicle.owner.dob,
-                'phone': vehicle.owner.phone
-            }
-        
-        # Get driver license (latest one)
-        driver_license_data = None
-        if vehicle.owner:
-            latest_license = vehicle.owner.driver_licenses.order_by('-expires_at').first()
-            if latest_license:
-                driver_license_data = {
-                    'license_id': latest_license.license_id,
-                    'number': latest_license.number,
-                    'categories': latest_license.categories,
-                    'issued_at': latest_license.issued_at,
-                    'expires_at': latest_license.expires_at,
-                    'status': latest_license.status
-                }
-        
-        # Get insurance policies
-        insurance_policies = []
-        for policy in vehicle.insurance_policies.all():
-            policy_data = {
-                'policy_number': policy.policy_number,
-                'type': policy.type,
-                'insurer': policy.insurer.name if policy.insurer else None,
-                'valid_from': policy.valid_from,
-                'valid_to': policy.valid_to,
-                'status': policy.status
-            }
-            insurance_policies.append(policy_data)
-        
-        # Get accidents (last 10)
-        accidents = []
-        for accident in vehicle.accidents.order_by('-date')[:10]:
-            # Get damaged parts for this accident
-            damaged_parts = []
-            for part in accident.damaged_parts.all():
-                part_data = {
-                    'part_id': part.part_id,
-                    'name': part.name,
-                    'category': part.category,
-                    'description': part.description
+        stats.lookups.record(plate_norm)
+        if as_sql_json:
+            return HttpResponse(result, content_type='application/json')
+        return Response(result)
+
+    except dbguard.DatabaseUnavailable as e:
+        # Fail fast, but the same dossier cached for another representation
+        # (or by a concurrent request) still beats a 503
+        text = dossier_cache.peek(plate_norm, sections, accidents_limit, 'sql-json') if as_sql_json else None
+        result = text if text is not None else dossier_cache.peek(plate_norm, sections, accidents_limit)
+        if result is None:
+            return db_unavailable(e)
+        audit.writer.record(
+            plate_norm, audit.client_label(request), request.META.get('REMOTE_ADDR'),
+            'check_plate', ','.join(sorted(sections)), 200
+        )
+        if text is not None:
+            return HttpResponse(text, content_type='application/json')
+        return Response(result)
+    except Exception as e:
+        return Response(
+            {"detail": f"db_error: {type(e).__name__}: {e}"}, 
+            status=status.HTTP_500_INTERNAL_SERVER_ERROR
+        )
+
+
+@extend_schema(
+    operation_id='check_batch',
+    summary='Пакетная проверка номерных знаков',
+    description='Возвращает досье сразу для нескольких номеров (до 500) за фиксированное число SQL-запросов. '
+                'Строки, не являющиеся номером, в базу не передаются и возвращаются в invalid. '
+                'Тело запроса и ответ могут быть в JSON или MessagePack (Content-Type / Accept: application/msgpack)',
+    tags=['Vehicles'],
+    request={
+        'application/json': {
+            'type': 'object',
+            'properties': {
+                'plates': {'type': 'array', 'items': {'type': 'string'}},
+                'fields': {'type': 'string'},
+                'exclude': {'type': 'string'},
+                'accidents': {'type': 'integer'},
+            },
+            'required': ['plates'],
+        }
+    },
+    responses={
+        200: {
+            'description': 'Досье по найденным номерам и список ненайденных',
+            'examples': {
+                'application/json': {
+                    'results': {'123ABC02': {'plate': '123ABC02', 'vehicle': {'vehicle_id': 1}}},
+                    'not_found': ['456DEF03'],
+                    'invalid': ['12-ABC']
                 }
-                damaged_parts.append(part_data)
-            
-            accident_data = {
-                'accident_id': accident.accident_id,
-                'date': accident.date,
-                'severity': accident.severity,
-                'location': accident.location,
-                'description': accident.description,
-                'fault_party': accident.fault_party,
-                'damaged_parts': damaged_parts
             }
-            accidents.append(accident_data)
-        
-        # Build response
-        result = {
-            'plate': current_plate.plate_number,
-            'vehicle': {
-                'vehicle_id': vehicle.vehicle_id,
-                'vin': vehicle.vin,
-                'make': vehicle.make,
-                'model': vehicle.model,
-                'year': vehicle.year,
-                'color': vehicle.color
+        },
+        400: {'description': 'Неверные параметры запроса'},
+    }
+)
+@api_view(['POST'])
+@permission_classes([AllowAny])
+def check_batch(request):
+    """Check vehicle information for several plate numbers at once"""
+    data = request.data if isinstance(request.data, dict) else {}
+    plates = data.get('plates')
+    if not isinstance(plates, list) or not plates or not all(isinstance(p, str) for p in plates):
+        return Response({"detail": "plates must be a non-empty list of strings"}, status=status.HTTP_400_BAD_REQUEST)
+    if len(plates) > MAX_BATCH_PLATES:
+        return Response({"detail": f"at most {MAX_BATCH_PLATES} plates per request"}, status=status.HTTP_400_BAD_REQUEST)
+    try:
+        sections, accidents_limit = dossier.parse_params(data)
+    except ValueError as e:
+        return Response({"detail": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+    try:
+        parsed = [(p, kzplates.parse(p, legacy=True)[0]) for p in plates]
+        invalid = [p for p, plate_norm in parsed if plate_norm is None]
+        plate_norms = list(dict.fromkeys(plate_norm for _, plate_norm in parsed if plate_norm is not None))
+        found = dossier.find_active_plates(plate_norms, sections)
+        dossiers = dossier.build_dossiers(found.values(), sections, accidents_limit)
+        results = {d['plate']: d for d in dossiers}
+
+        client = audit.client_label(request)
+        section_names = ','.join(sorted(sections))
+        for plate_norm in plate_norms:
+            audit.writer.record(
+                plate_norm, client, request.META.get('REMOTE_ADDR'), 'check_batch', section_names,
+                200 if plate_norm in results else 404
+            )
+            if plate_norm in results:
+                stats.lookups.record(plate_norm)
+
+        return Response({
+            "results": results,
+            "not_found": [p for p in plate_norms if p not in results],
+            "invalid": invalid,
+        })
+    except dbguard.DatabaseUnavailable as e:
+        return db_unavailable(e)
+    except Exception as e:
+        return Response(
+            {"detail": f"db_error: {type(e).__name__}: {e}"}, 
+            status=status.HTTP_500_INTERNAL_SERVER_ERROR
+        )
+
+
+@extend_schema(
+    operation_id='reassign_plates',
+    summary='Массовая перерегистрация номеров',
+    description='Выдаёт ТС новые номера по парам (VIN, номер), до 10000 за запрос. Пары проверяются целиком: '
+                'дубли в запросе, неизвестные VIN, номер другого шарда, номер, действующий у ТС вне запроса. '
+                'Старые номера снимаются, новые создаются порциями в транзакциях; обмен номерами внутри '
+                'запроса допускается. Конфликтующие пары пропускаются и перечислены в conflicts. '
+                'Только для staff-пользователей',
+    tags=['Plates'],
+    request={
+        'application/json': {
+            'type': 'object',
+            'properties': {
+                'assignments': {
+                    'type': 'array',
+                    'items': {
+                        'type': 'object',
+                        'properties': {'vin': {'type': 'string'}, 'plate': {'type': 'string'}},
+                        'required': ['vin', 'plate'],
+                    },
+                },
+                'dry_run': {'type': 'boolean'},
             },
-            'owner': owner_data,
-            'driver_license': driver_license_data,
-            'insurance': insurance_policies,
-            'accidents': accidents
+            'required': ['assignments'],
         }
-        
+    },
+    responses={
+        200: {
+            'description': 'Итог: число перерегистраций, пары без изменений и конфликты',
+            'examples': {
+                'application/json': {
+                    'reassigned': 2,
+                    'unchanged': [],
+                    'conflicts': [{'vin': 'WVWZZZ1JZXW000009', 'plate': '777AAA02', 'reason': 'plate_in_use',
+                                   'holder_vehicle_id': 42}],
+                    'chunks': 1,
+                    'dry_run': False
+                }
+            }
+        },
+        400: {'description': 'Неверное тело запроса'},
+        403: {'description': 'Нет прав staff'},
+    }
+)
+@api_view(['POST'])
+@permission_classes([IsAdminUser])
+def reassign_plates(request):
+    """Bulk plate reassignment: release current plates and issue new ones"""
+    data = request.data if isinstance(request.data, dict) else {}
+    assignments = data.get('assignments')
+    if (not isinstance(assignments, list) or not assignments
+            or not all(isinstance(a, dict) and isinstance(a.get('vin'), str) and isinstance(a.get('plate'), str)
+                       for a in assignments)):
+        return Response({"detail": "assignments must be a non-empty list of {vin, plate} objects"},
+                        status=status.HTTP_400_BAD_REQUEST)
+    if len(assignments) > MAX_REASSIGN_PAIRS:
+        return Response({"detail": f"at most {MAX_REASSIGN_PAIRS} assignments per request"},
+                        status=status.HTTP_400_BAD_REQUEST)
+
+    pairs = [(a['vin'].strip().upper(), normalize_plate(a['plate'])) for a in assignments]
+    try:
+        return Response(replating.reassign(pairs, dry_run=bool(data.get('dry_run'))))
+    except dbguard.DatabaseUnavailable as e:
+        return db_unavailable(e)
+    except Exception as e:
+        return Response(
+            {"detail": f"db_error: {type(e).__name__}: {e}"},
+            status=status.HTTP_500_INTERNAL_SERVER_ERROR
+        )
+
+
+@extend_schema(
+    operation_id='stream_plates',
+    summary='Потоковый список номерных знаков',
+    description='Отдаёт все активные номера потоком без загрузки списка в память: '
+                'NDJSON по умолчанию или последовательность MessagePack-объектов '
+                '(Accept: application/msgpack-seq)',
+    tags=['Plates'],
+    responses={200: {'description': 'Поток номеров, по одному объекту на номер'}},
+)
+@api_view(['GET'])
+@permission_classes([AllowAny])
+@renderer_classes(renderers.STREAM_RENDERERS)
+def stream_plates(request):
+    """Stream all current plate numbers"""
+    numbers = heapq.merge(*(
+        active_plate_numbers(alias).iterator(chunk_size=STREAM_CHUNK_SIZE) for alias in shards.aliases()
+    ))
+    # Encode a chunk at a time so memory stays flat however many plates exist
+    renderer = request.accepted_renderer
+    body = (renderer.render(chunk) for chunk in chunked(numbers, STREAM_CHUNK_SIZE))
+    return StreamingHttpResponse(body, content_type=renderer.media_type)
+
+
+@extend_schema(
+    operation_id='export_dossiers',
+    summary='Выгрузка всех досье',
+    description='Досье всех действующих номеров одним потоком: NDJSON, по строке на номер, сжатый gzip '
+                '(или zstd, если установлен zstandard). После каждой порции идёт строка {"cursor": "..."}: '
+                'с этим курсором выгрузку можно продолжить после обрыва; последняя строка содержит '
+                '"complete": true. Только для staff-пользователей',
+    tags=['Plates'],
+    parameters=[
+        OpenApiParameter(name='compression', type=OpenApiTypes.STR, enum=list(export.COMPRESSORS),
+                         description='gzip (по умолчанию), zstd или none'),
+        OpenApiParameter(name='region', type=OpenApiTypes.STR, description='Только номера региона'),
+        OpenApiParameter(name='since', type=OpenApiTypes.DATETIME,
+                         description='Только номера, выданные с этого момента, и ТС, у которых с этого момента '
+                                     'менялись ДТП или полисы'),
+        OpenApiParameter(name='cursor', type=OpenApiTypes.STR, description='Продолжить с контрольной строки'),
+        OpenApiParameter(name='fields', type=OpenApiTypes.STR, description='Разделы досье через запятую'),
+        OpenApiParameter(name='exclude', type=OpenApiTypes.STR, description='Исключить разделы'),
+        OpenApiParameter(name='accidents', type=OpenApiTypes.INT, description='Сколько последних ДТП (0-100)'),
+    ],
+    responses={
+        200: {'description': 'Сжатый NDJSON-поток досье с контрольными строками'},
+        400: {'description': 'Неверные параметры'},
+        403: {'description': 'Нет прав staff'},
+    }
+)
+@api_view(['GET'])
+@permission_classes([IsAdminUser])
+def export_dossiers(request):
+    """Stream every active plate's dossier as compressed NDJSON"""
+    try:
+        options = export.parse_params(request.query_params)
+    except ValueError as e:
+        return Response({"detail": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+    # One journal entry for the whole export rather than one per plate
+    audit.writer.record(f"*{options['region'] or ''}", audit.client_label(request), request.META.get('REMOTE_ADDR'),
+                        'export_dossiers', ','.join(sorted(options['sections'])), 200)
+    compressor = export.COMPRESSORS[options['compression']]
+    response = StreamingHttpResponse(export.stream(**options), content_type=compressor.media_type)
+    filename = f"dossiers-{timezone.localdate():%Y%m%d}.ndjson{compressor.suffix}"
+    response['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response
+
+
+@extend_schema(
+    operation_id='check_vin',
+    summary='Проверка по VIN',
+    description='Ищет транспортное средство по VIN во всех шардах и возвращает досье по его действующему номеру. '
+                'Поддерживает те же параметры fields / exclude / accidents, что и проверка по номеру',
+    tags=['Vehicles'],
+    parameters=[
+        OpenApiParameter(
+            name='vin',
+            type=OpenApiTypes.STR,
+            location=OpenApiParameter.PATH,
+            description='VIN транспортного средства (17 символов)',
+            examples=[OpenApiExample('Пример', value='WVWZZZ1JZXW000001')]
+        ),
+    ],
+    responses={
+        200: {'description': 'Досье; plate = null, если у ТС нет действующего номера'},
+        404: {
+            'description': 'ТС не найдено',
+            'examples': {'application/json': {'detail': 'vehicle not found'}}
+        },
+    }
+)
+@api_view(['GET'])
+@permission_classes([AllowAny])
+def check_vin(request, vin):
+    """Check vehicle information by VIN"""
+    try:
+        sections, accidents_limit = dossier.parse_params(request.query_params)
+    except ValueError as e:
+        return Response({"detail": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+    try:
+        vin = vin.strip().upper()
+        # The VIN says nothing about the region: ask every shard at once
+        per_shard = shards.fan_out(lambda alias: Vehicle.objects.using(alias).filter(vin=vin).first())
+        vehicle = next((v for v in per_shard.values() if v is not None), None)
+        if vehicle is None:
+            audit.writer.record(vin, audit.client_label(request), request.META.get('REMOTE_ADDR'),
+                                'check_vin', ','.join(sorted(sections)), 404)
+            return Response({"detail": "vehicle not found"}, status=status.HTTP_404_NOT_FOUND)
+
+        current_plate = dossier.active_plates(sections, vehicle._state.db).filter(vehicle_id=vehicle.vehicle_id).order_by('-assigned_at').first()
+        if current_plate is not None:
+            result = dossier.build_dossiers([current_plate], sections, accidents_limit)[0]
+        else:
+            result = {'plate': None, 'vehicle': dossier.vehicle_data(vehicle)}
+        audit.writer.record(result['plate'] or vin, audit.client_label(request), request.META.get('REMOTE_ADDR'),
+                            'check_vin', ','.join(sorted(sections)), 200)
         return Response(result)
-        
+    except dbguard.DatabaseUnavailable as e:
+        return db_unavailable(e)
+    except Exception as e:
+        return Response(
+            {"detail": f"db_error: {type(e).__name__}: {e}"}, 
+            status=status.HTTP_500_INTERNAL_SERVER_ERROR
+        )
+
+
+@extend_schema(
+    operation_id='plate_history',
+    summary='История номера',
+    description='Все закрепления номера (включая снятые и перенесённые в архив), а также полная история номеров '
+                'и ДТП последнего владельца номера. Архивные записи помечены archived = true',
+    tags=['Vehicles'],
+    parameters=[
+        OpenApiParameter(
+            name='plate',
+            type=OpenApiTypes.STR,
+            location=OpenApiParameter.PATH,
+            description='Номерной знак (например: 123ABC02)',
+            examples=[OpenApiExample('Пример', value='123ABC02')]
+        ),
+    ],
+    responses={
+        200: {'description': 'История номера'},
+        404: {
+            'description': 'Номер никогда не выдавался',
+            'examples': {'application/json': {'detail': 'plate not found'}}
+        },
+    }
+)
+@api_view(['GET'])
+@permission_classes([AllowAny])
+def plate_history(request, plate):
+    """Full history of a plate number, live and archived"""
+    try:
+        plate_norm = normalize_plate(plate)
+        using = shards.alias_for_plate(plate_norm)
+        assignments = history.plate_assignments(plate_norm, using)
+        if not assignments:
+            return Response({"detail": "plate not found"}, status=status.HTTP_404_NOT_FOUND)
+
+        vehicle = Vehicle.objects.using(using).get(pk=assignments[0]['vehicle_id'])
+        return Response({
+            'plate': plate_norm,
+            'assignments': assignments,
+            'vehicle': dossier.vehicle_data(vehicle),
+            'plates': history.vehicle_plates(vehicle.vehicle_id, using),
+            'accidents': history.vehicle_accidents(vehicle.vehicle_id, using),
+        })
+    except dbguard.DatabaseUnavailable as e:
+        return db_unavailable(e)
+    except Exception as e:
+        return Response(
+            {"detail": f"db_error: {type(e).__name__}: {e}"}, 
+            status=status.HTTP_500_INTERNAL_SERVER_ERROR
+        )
+
+
+@extend_schema(
+    operation_id='search_vehicles',
+    summary='Поиск ТС с фасетами',
+    description='Поиск транспортных средств по марке, модели, диапазону годов, цвету, ИИН владельца, региону '
+                'действующего номера и показателям риска (ДТП, полисы). Постраничный вывод по курсору (next), '
+                'сортировка по показателям риска, счётчики по марке, модели, году и цвету',
+    tags=['Vehicles'],
+    parameters=[
+        OpenApiParameter(name='make', type=OpenApiTypes.STR, location=OpenApiParameter.QUERY, required=False,
+                         description='Марка (точное совпадение)'),
+        OpenApiParameter(name='model', type=OpenApiTypes.STR, location=OpenApiParameter.QUERY, required=False,
+                         description='Модель (точное совпадение)'),
+        OpenApiParameter(name='year', type=OpenApiTypes.INT, location=OpenApiParameter.QUERY, required=False,
+                         description='Год выпуска (точное совпадение)'),
+        OpenApiParameter(name='year_min', type=OpenApiTypes.INT, location=OpenApiParameter.QUERY, required=False,
+                         description='Год выпуска от'),
+        OpenApiParameter(name='year_max', type=OpenApiTypes.INT, location=OpenApiParameter.QUERY, required=False,
+                         description='Год выпуска до'),
+        OpenApiParameter(name='color', type=OpenApiTypes.STR, location=OpenApiParameter.QUERY, required=False,
+                         description='Цвет'),
+        OpenApiParameter(name='iin', type=OpenApiTypes.STR, location=OpenApiParameter.QUERY, required=False,
+                         description='ИИН владельца'),
+        OpenApiParameter(name='region', type=OpenApiTypes.STR, location=OpenApiParameter.QUERY, required=False,
+                         description='Регион действующего номера (например: 02)'),
+        OpenApiParameter(name='min_accidents', type=OpenApiTypes.INT, location=OpenApiParameter.QUERY,
+                         required=False, description='Не меньше стольких ДТП (включая архивные)'),
+        OpenApiParameter(name='min_at_fault', type=OpenApiTypes.INT, location=OpenApiParameter.QUERY,
+                         required=False, description='Не меньше стольких ДТП по вине владельца'),
+        OpenApiParameter(name='accident_since', type=OpenApiTypes.DATE, location=OpenApiParameter.QUERY,
+                         required=False, description='Последнее ДТП не раньше этой даты'),
+        OpenApiParameter(name='osago', type=OpenApiTypes.BOOL, location=OpenApiParameter.QUERY, required=False,
+                         description='Есть (true) или нет (false) действующего полиса ОСАГО'),
+        OpenApiParameter(name='kasko', type=OpenApiTypes.BOOL, location=OpenApiParameter.QUERY, required=False,
+                         description='Есть (true) или нет (false) действующего полиса КАСКО'),
+        OpenApiParameter(name='sort', type=OpenApiTypes.STR, location=OpenApiParameter.QUERY, required=False,
+                         enum=list(search.SORTS),
+                         description='Сортировка по убыванию: accidents, at_fault, last_accident '
+                                     '(по умолчанию — по vehicle_id)'),
+        OpenApiParameter(name='limit', type=OpenApiTypes.INT, location=OpenApiParameter.QUERY, required=False,
+                         description=f'Размер страницы (по умолчанию {search.DEFAULT_LIMIT}, максимум {search.MAX_LIMIT})'),
+        OpenApiParameter(name='cursor', type=OpenApiTypes.STR, location=OpenApiParameter.QUERY, required=False,
+                         description='Значение next из предыдущей страницы'),
+        OpenApiParameter(name='facets', type=OpenApiTypes.BOOL, location=OpenApiParameter.QUERY, required=False,
+                         description='Считать фасеты (по умолчанию да; для следующих страниц можно отключить)'),
+    ],
+    responses={
+        200: {
+            'description': 'Страница результатов',
+            'examples': {
+                'application/json': {
+                    'results': [{
+                        'vehicle_id': 1, 'vin': 'WVWZZZ1JZXW000001', 'make': 'Toyota', 'model': 'Camry',
+                        'year': 2018, 'color': 'white', 'plate': '123ABC02', 'owner': None,
+                        'risk': {
+                            'accidents': 2, 'at_fault_accidents': 1, 'last_accident_at': '2024-05-10',
+                            'osago_active': True, 'osago_valid_to': '2025-12-31',
+                            'kasko_active': False, 'kasko_valid_to': None,
+                        },
+                    }],
+                    'next': 'eyJkZWZhdWx0IjoxfQ==',
+                    'facets': {'make': [{'value': 'Toyota', 'count': 1}], 'model': [], 'year': [], 'color': []},
+                    'facets_exact': True,
+                }
+            }
+        },
+        400: {
+            'description': 'Некорректные параметры',
+            'examples': {'application/json': {'detail': 'invalid cursor'}}
+        },
+    }
+)
+@api_view(['GET'])
+@permission_classes([AllowAny])
+def search_vehicles(request):
+    """Faceted vehicle search with keyset pagination"""
+    try:
+        filters, sort, cursor, limit, with_facets = search.parse_params(request.query_params)
+    except ValueError as e:
+        return Response({"detail": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+    try:
+        results, next_cursor = search.search(filters, cursor, limit, sort)
+        data = {"results": results, "next": next_cursor}
+        if with_facets:
+            data["facets"], data["facets_exact"] = search.facet_counts(filters)
+        return Response(data)
+    except dbguard.DatabaseUnavailable as e:
+        return db_unavailable(e)
     except Exception as e:
         return Response(
             {"detail": f"db_error: {type(e).__name__}: {e}"}, 
@@ -0,0 +1,407 @@
+#!/usr/bin/env python
+"""
+Бенчмарки API на синтетических данных
+
+Каждый сценарий работает во временной тестовой базе (как manage.py test),
+рабочая db.sqlite3 не затрагивается.
+
+    python benchmark.py audit --vehicles 2000 --requests 5000 --threads 4
+    python benchmark.py workers --workers 1,2,4,8
+    python benchmark.py plates --parses 1000000
+"""
+import argparse
+import http.client
+import os
+import random
+import signal
+import string
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+
+import django
+
+
+def percentile(values, p):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(p / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def report(name, latencies):
+    total = sum(latencies)
+    print(
+        f"{name:<28} n={len(latencies):<6} "
+        f"p50={percentile(latencies, 50) * 1000:7.3f}ms "
+        f"p95={percentile(latencies, 95) * 1000:7.3f}ms "
+        f"p99={percentile(latencies, 99) * 1000:7.3f}ms "
+        f"avg={total / len(latencies) * 1000:7.3f}ms"
+    )
+
+
+def seed(vehicles, accidents_per_vehicle=3):
+    """Заполняет базу синтетическими данными, возвращает список активных номеров"""
+    from api.models import Owner, DriverLicense, Vehicle, Plate, Insurer, InsurancePolicy, Accident, CarPart
+    from api import risk
+    from api.parts import refresh_masks
+    from api.search import rebuild_facets
+
+    rng = random.Random(42)
+    today = date.today()
+    insurers = Insurer.objects.bulk_create([Insurer(name=f'Insurer {i}') for i in range(5)])
+    parts = CarPart.objects.bulk_create([
+        CarPart(name=f'Part {i}', category=f'Category {i % 5}', description=f'Part {i}', bit=i) for i in range(31)
+    ])
+    owners = Owner.objects.bulk_create([
+        Owner(full_name=f'Owner {i}', iin=f'{700000000000 + i:012d}',
+              dob=date(1970, 1, 1) + timedelta(days=rng.randint(0, 15000)), phone=f'+7701{i:07d}')
+        for i in range(vehicles)
+    ])
+    DriverLicense.objects.bulk_create([
+        DriverLicense(owner=owner, number=f'DL-{i:07d}', categories='B', issued_at=today - timedelta(days=3650),
+                      expires_at=today + timedelta(days=rng.randint(1, 1800)), status='valid')
+        for i, owner in enumerate(owners)
+    ])
+    cars = Vehicle.objects.bulk_create([
+        Vehicle(owner=owner, vin=f'{i:017d}', make=rng.choice(['Toyota', 'Kia', 'Lada', 'Hyundai']),
+                model=rng.choice(['A', 'B', 'C']), year=rng.randint(2000, 2024),
+                color=rng.choice(['white', 'black', 'silver']))
+        for i, owner in enumerate(owners)
+    ])
+    plates = []
+    for i in range(vehicles):
+        letters = ''.join(rng.choices(string.ascii_uppercase, k=3))
+        plates.append(f'{i % 900 + 100}{letters}{i % 20 + 1:02d}')
+    plates = list(dict.fromkeys(plates))
+    Plate.objects.bulk_create([
+        Plate(vehicle=car, plate_number=number, region=number[-2:]) for car, number in zip(cars, plates)
+    ])
+    InsurancePolicy.objects.bulk_create([
+        InsurancePolicy(vehicle=car, insurer=rng.choice(insurers), policy_number=f'OSG-{i:08d}', type='OSAGO',
+                        valid_from=today - timedelta(days=30), valid_to=today + timedelta(days=300), status='active')
+        for i, car in enumerate(cars)
+    ])
+    accidents = Accident.objects.bulk_create([
+        Accident(vehicle=car, date=today - timedelta(days=rng.randint(1, 2000)), severity='minor',
+                 location='Алматы', description='Имитация ДТП', fault_party=rng.choice(['owner', 'other']))
+        for car in cars for _ in range(rng.randint(0, accidents_per_vehicle))
+    ])
+    through = Accident.damaged_parts.through
+    through.objects.bulk_create([
+        through(accident_id=accident.accident_id, carpart_id=part.part_id)
+        for accident in accidents for part in rng.sample(parts, rng.randint(1, 4))
+    ])
+    # bulk_create skips the signal handlers that maintain these
+    refresh_masks('default')
+    rebuild_facets('default')
+    risk.rebuild('default')
+    return plates
+
+
+def timed_lookups(plates, requests, threads=1, path='/api/check/{}/', **headers):
+    from django.test import Client
+
+    def run(count):
+        client = Client()
+        rng = random.Random()
+        latencies = []
+        for _ in range(count):
+            url = path.format(rng.choice(plates))
+            started = time.perf_counter()
+            response = client.get(url, **headers)
+            latencies.append(time.perf_counter() - started)
+            assert response.status_code == 200, (url, response.status_code)
+        return latencies
+
+    per_thread = max(1, requests // threads)
+    with ThreadPoolExecutor(threads) as pool:
+        results = pool.map(run, [per_thread] * threads)
+    return [latency for latencies in results for latency in latencies]
+
+
+def bench_audit(args):
+    """Накладные расходы аудита check_plate: p50/p99 с журналом и без"""
+    from django.test import override_settings
+    from api import audit
+    from api.models import LookupAuditEvent
+
+    plates = seed(args.vehicles)
+    results = {}
+    for enabled in (False, True):
+        config = dict(audit.get_config(), ENABLED=enabled)
+        with override_settings(LOOKUP_AUDIT=config, DOSSIER_CACHE={'TTL': 0}):
+            audit.writer.configure()
+            timed_lookups(plates, min(200, args.requests), args.threads)  # warm-up
+            results[enabled] = timed_lookups(plates, args.requests, args.threads)
+            audit.writer.shutdown()
+        report(f"audit {'on' if enabled else 'off'}", results[enabled])
+    overhead = percentile(results[True], 99) - percentile(results[False], 99)
+    print(f"p99 overhead: {overhead * 1000:+.3f}ms, events written: {LookupAuditEvent.objects.count()}, "
+          f"writer: {audit.writer.snapshot()}")
+
+
+def bench_msgpack(args):
+    """Размер ответа и время кодирования/декодирования: JSON против MessagePack"""
+    import json
+    from rest_framework.renderers import JSONRenderer
+    from api import dossier, renderers
+
+    seed(args.vehicles, accidents_per_vehicle=6)
+    sections = frozenset(dossier.SECTIONS)
+    plates = list(dossier.active_plates(sections)[:args.requests])
+    dossiers = dossier.build_dossiers(plates, sections)
+    batch = {'results': {d['plate']: d for d in dossiers[:500]}, 'not_found': []}
+
+    # JSON clients also have to turn ISO strings back into dates
+    date_fields = {'dob', 'issued_at', 'expires_at', 'valid_from', 'valid_to', 'date'}
+
+    def json_with_dates(body):
+        return json.loads(body, object_hook=lambda obj: {
+            key: date.fromisoformat(value) if key in date_fields and isinstance(value, str) else value
+            for key, value in obj.items()
+        })
+
+    codecs = {
+        'json': (JSONRenderer().render, json.loads),
+        'json+dates': (JSONRenderer().render, json_with_dates),
+        'msgpack': (renderers.MessagePackRenderer().render, renderers.unpackb),
+    }
+    for label, payloads in (('single dossier', dossiers), ('batch of 500', [batch])):
+        print(f"{label} (x{len(payloads)}):")
+        for name, (encode, decode) in codecs.items():
+            started = time.perf_counter()
+            encoded = [encode(payload) for payload in payloads]
+            encode_time = time.perf_counter() - started
+            started = time.perf_counter()
+            for body in encoded:
+                decode(body)
+            decode_time = time.perf_counter() - started
+            size = sum(len(body) for body in encoded) / len(encoded)
+            print(f"  {name:<10} size={size:10.0f}B  encode={encode_time / len(encoded) * 1e6:9.1f}us  "
+                  f"decode={decode_time / len(encoded) * 1e6:9.1f}us")
+
+
+def bench_search(args):
+    """Поиск ТС: задержка типовых фильтров и страниц по курсору в глубине выдачи"""
+    from django.test import Client
+
+    plates = seed(args.vehicles, accidents_per_vehicle=2)
+    queries = {
+        'no filters': '/api/vehicles/search/',
+        'make': '/api/vehicles/search/?make=Toyota',
+        'make+model': '/api/vehicles/search/?make=Kia&model=B',
+        'make+years': '/api/vehicles/search/?make=Lada&year_min=2010&year_max=2015',
+        'color': '/api/vehicles/search/?color=white&facets=0',
+        'region': '/api/vehicles/search/?region=02&facets=0',
+        'risk sort': '/api/vehicles/search/?sort=at_fault&facets=0',
+        'risk filter': '/api/vehicles/search/?min_accidents=2&osago=true&facets=0',
+    }
+    for name, path in queries.items():
+        report(f"search {name}", timed_lookups(plates, args.requests, args.threads, path=path))
+
+    client = Client()
+    latencies = []
+    path = '/api/vehicles/search/?facets=0&limit=200'
+    while path:
+        started = time.perf_counter()
+        body = client.get(path).json()
+        latencies.append(time.perf_counter() - started)
+        path = body['next'] and f"/api/vehicles/search/?facets=0&limit=200&cursor={body['next']}"
+    report('search every page', latencies)
+    print(f"first page {latencies[0] * 1000:.3f}ms, last page {latencies[-1] * 1000:.3f}ms")
+
+
+def bench_plates(args):
+    """Разбор номеров (api.kzplates): миллионов вызовов в секунду на разных видах ввода"""
+    import re
+    from api import kzplates
+
+    rng = random.Random(1)
+    cyrillic = dict(zip(kzplates.LATIN, kzplates.CYRILLIC))
+
+    def canonical():
+        letters = ''.join(rng.choices('ABCEHKMOPTXY', k=rng.choice([2, 3])))
+        return f"{rng.randint(100, 999)}{letters}{rng.randint(1, 20):02d}"
+
+    def messy():
+        plate = canonical()
+        plate = ''.join(cyrillic.get(c, c) if rng.random() < 0.5 else c.lower() for c in plate)
+        return f"{plate[:3]} {plate[3:-2]} {plate[-2:]}"
+
+    def garbage():
+        return ''.join(rng.choices(string.ascii_letters + string.digits + ' -!', k=rng.randint(1, 12)))
+
+    count = args.parses
+    inputs = {
+        'canonical': [canonical() for _ in range(count)],
+        'spaces+cyrillic': [messy() for _ in range(count)],
+        'garbage': [garbage() for _ in range(count)],
+    }
+    inputs['mixed 80/15/5'] = [rng.choices(list(inputs.values()), weights=[80, 15, 5])[0][i] for i in range(count)]
+
+    def old_normalize(value):
+        return re.sub(r"\s+", "", value).upper()
+
+    for name, values in inputs.items():
+        for label, fn in (('kzplates.parse', kzplates.parse), ('old normalize_plate', old_normalize)):
+            started = time.perf_counter()
+            for value in values:
+                fn(value)
+            elapsed = time.perf_counter() - started
+            valid = sum(kzplates.parse(value)[0] is not None for value in values) if fn is kzplates.parse else None
+            print(f"{name:<16} {label:<20} {count / elapsed / 1e6:6.2f}M/s  {elapsed / count * 1e9:7.0f}ns"
+                  + (f"  valid={valid / count:.0%}" if valid is not None else ''))
+
+
+def bench_sqljson(args):
+    """check_plate: ORM + JSONRenderer против одного SQL-запроса с JSON-агрегацией (CPU на запрос и p50/p99)"""
+    from django.test import override_settings
+    from rest_framework.renderers import JSONRenderer
+    from api import dossier, sqljson
+
+    plates = seed(args.vehicles, accidents_per_vehicle=6)
+    sections = frozenset(dossier.SECTIONS)
+    sample = [random.choice(plates) for _ in range(args.requests)]
+    loaders = {
+        'orm': lambda plate: JSONRenderer().render(dossier.load_dossier(plate, sections, dossier.DEFAULT_ACCIDENTS)),
+        'sql json': lambda plate: sqljson.load_dossier_json(plate, sections, dossier.DEFAULT_ACCIDENTS),
+    }
+    for name, load in loaders.items():
+        started = time.process_time()
+        for plate in sample:
+            load(plate)
+        cpu = time.process_time() - started
+        print(f"{name:<9} cpu/lookup={cpu / len(sample) * 1e6:9.1f}us")
+
+    for enabled in (False, True):
+        with override_settings(SQL_JSON_DOSSIER={'ENABLED': enabled}, DOSSIER_CACHE={'TTL': 0}):
+            timed_lookups(plates, min(200, args.requests), args.threads)  # warm-up
+            report(f"check_plate sql json {'on' if enabled else 'off'}",
+                   timed_lookups(plates, args.requests, args.threads))
+
+
+def http_lookups(port, plates, requests, clients):
+    """``requests`` GETs of check_plate over HTTP from ``clients`` threads; returns (seconds, latencies)"""
+    def run(count):
+        connection = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+        rng = random.Random()
+        latencies = []
+        for _ in range(count):
+            url = f'/api/check/{rng.choice(plates)}/'
+            started = time.perf_counter()
+            connection.request('GET', url)
+            response = connection.getresponse()
+            response.read()
+            latencies.append(time.perf_counter() - started)
+            assert response.status == 200, (url, response.status)
+        connection.close()
+        return latencies
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(clients) as pool:
+        results = list(pool.map(run, [max(1, requests // clients)] * clients))
+    return time.perf_counter() - started, [latency for latencies in results for latency in latencies]
+
+
+def bench_workers(args):
+    """check_plate через gunicorn (gunicorn.conf.py): пропускная способность в зависимости от числа worker-процессов"""
+    from django.db import connection
+
+    plates = seed(args.vehicles)
+    root = os.path.dirname(os.path.abspath(__file__))
+    # The server runs in its own processes: point it at the benchmark
+    # database and measure the queries, not the dossier cache
+    settings_dir = os.path.dirname(connection.settings_dict['NAME'])
+    with open(os.path.join(settings_dir, 'bench_settings.py'), 'w') as f:
+        f.write(
+            'from car_registry.settings import *  # noqa\n'
+            f"DATABASES = {{'default': dict(DATABASES['default'], NAME={str(connection.settings_dict['NAME'])!r})}}\n"
+            "DOSSIER_CACHE = dict(DOSSIER_CACHE, TTL=0, PREWARM_TOP_K=0)\n"
+            'DEBUG = False\n'
+        )
+    env = dict(os.environ, DJANGO_SETTINGS_MODULE='bench_settings', PYTHONPATH=os.pathsep.join([settings_dir, root]))
+
+    counts = [int(n) for n in args.workers.split(',')]
+    print(f"CPU: {os.cpu_count()}, requests per run: {args.requests}")
+    baseline = None
+    for port, workers in enumerate(counts, start=18400):
+        server = subprocess.Popen(
+            [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', '--workers', str(workers),
+             '--threads', '1', '--bind', f'127.0.0.1:{port}'],
+            cwd=root, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+        try:
+            for _ in range(300):
+                try:
+                    probe = http.client.HTTPConnection('127.0.0.1', port, timeout=1)
+                    probe.request('GET', '/api/health/ready/')
+                    if probe.getresponse().status == 200:
+                        break
+                except OSError:
+                    time.sleep(0.1)
+            # Enough concurrent clients to keep every worker busy
+            clients = max(args.threads, 2 * workers)
+            http_lookups(port, plates, min(200, args.requests), clients)  # warm-up
+            elapsed, latencies = http_lookups(port, plates, args.requests, clients)
+        finally:
+            server.send_signal(signal.SIGTERM)
+            server.wait(60)
+        throughput = len(latencies) / elapsed
+        baseline = baseline or throughput
+        report(f"gunicorn workers={workers}", latencies)
+        print(f"{'':<28} {throughput:8.1f} req/s, x{throughput / baseline:.2f} vs {counts[0]} worker(s), "
+              f"{clients} clients")
+
+
+SCENARIOS = {
+    'audit': bench_audit,
+    'msgpack': bench_msgpack,
+    'plates': bench_plates,
+    'search': bench_search,
+    'sqljson': bench_sqljson,
+    'workers': bench_workers,
+}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Бенчмарки Car Registry API')
+    parser.add_argument('scenario', choices=sorted(SCENARIOS))
+    parser.add_argument('--vehicles', type=int, default=2000)
+    parser.add_argument('--requests', type=int, default=3000)
+    parser.add_argument('--threads', type=int, default=1)
+    parser.add_argument('--parses', type=int, default=1_000_000, help='Число разборов номера (сценарий plates)')
+    parser.add_argument('--workers', default=','.join(str(2 ** i) for i in range(4)),
+                        help='Число worker-процессов через запятую (сценарий workers)')
+    args = parser.parse_args()
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'car_registry.settings')
+    django.setup()
+
+    from django.conf import settings
+    from django.test.runner import DiscoverRunner
+    from django.test.utils import setup_test_environment
+
+    # A real file rather than SQLite's shared in-memory test database, whose
+    # table-level locking would distort any scenario with background writers
+    workdir = tempfile.TemporaryDirectory(prefix='car_registry_bench_')
+    for alias, database in settings.DATABASES.items():
+        if database['ENGINE'] == 'django.db.backends.sqlite3':
+            database.setdefault('TEST', {})['NAME'] = os.path.join(workdir.name, f'{alias}.sqlite3')
+
+    setup_test_environment()
+    runner = DiscoverRunner(verbosity=0)
+    databases = runner.setup_databases()
+    try:
+        SCENARIOS[args.scenario](args)
+    finally:
+        from api import audit, stats
+
+        # Flush background writers while the benchmark database still exists
+        audit.writer.shutdown()
+        stats.lookups.stop()
+        runner.teardown_databases(databases)
+        workdir.cleanup()
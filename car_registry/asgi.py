@@ -14,3 +14,8 @@ from django.core.asgi import get_asgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'car_registry.settings')
 
 application = get_asgi_application()
+
+# Warm the dossier cache with the hottest plates (DOSSIER_CACHE['PREWARM_TOP_K'])
+from api.cache import prewarm_on_startup  # noqa: E402
+
+prewarm_on_startup()
@@ -10,8 +10,10 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/4.2/ref/settings/
 """
 
+from importlib.util import find_spec
 from pathlib import Path
 import os
+import tempfile
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -24,7 +26,8 @@ BASE_DIR = Path(__file__).resolve().parent.parent
 SECRET_KEY = 'django-insecure-your-secret-key-here'
 
 # SECURITY WARNING: don't run with debug turned on in production!
-DEBUG = True
+# DEBUG also records every SQL statement per connection: keep it off in production
+DEBUG = os.environ.get('DEBUG', 'True').lower() in ('1', 'true', 'yes')
 
 ALLOWED_HOSTS = ['*']
 
@@ -51,8 +54,11 @@ MIDDLEWARE = [
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'api.profiling.ProfilingMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'api.admission.AdmissionControlMiddleware',
+    'api.dbguard.StatementDeadlineMiddleware',
 ]
 
 ROOT_URLCONF = 'car_registry.urls'
@@ -79,13 +85,36 @@ WSGI_APPLICATION = 'car_registry.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/4.2/ref/settings/#databases
 
+# Connections are kept for CONN_MAX_AGE seconds (DB_CONN_MAX_AGE, 0 =
+# one per request) and checked before reuse by CONN_HEALTH_CHECKS.
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+        'NAME': os.environ.get('SQLITE_PATH') or BASE_DIR / 'db.sqlite3',
+        'CONN_MAX_AGE': int(os.environ.get('DB_CONN_MAX_AGE', 60)),
+        'CONN_HEALTH_CHECKS': True,
     }
 }
 
+# Region sharding of the registry (see api/shards.py). Each alias holds the
+# vehicles whose plate region code (last two digits) is listed; regions not
+# listed go to REGISTRY_DEFAULT_SHARD. Every alias needs a DATABASES entry
+# and its own `manage.py migrate --database=<alias>`. Example:
+#
+#   REGISTRY_SHARDS = {
+#       'default': [],                              # everything else
+#       'almaty': ['02', '05', '19'],
+#       'astana': ['01', '03'],
+#   }
+#   DATABASES['almaty'] = {'ENGINE': 'django.db.backends.sqlite3', 'NAME': BASE_DIR / 'db_almaty.sqlite3'}
+#   DATABASES['astana'] = {'ENGINE': 'django.db.backends.sqlite3', 'NAME': BASE_DIR / 'db_astana.sqlite3'}
+REGISTRY_SHARDS = {
+    'default': [],
+}
+REGISTRY_DEFAULT_SHARD = 'default'
+
+DATABASE_ROUTERS = ['api.routers.RegionShardRouter']
+
 
 # Password validation
 # https://docs.djangoproject.com/en/4.2/ref/settings/#auth-password-validators
@@ -130,16 +159,245 @@ STATIC_ROOT = BASE_DIR / 'staticfiles'
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 # REST Framework settings
+MSGPACK_AVAILABLE = find_spec('msgpack') is not None
+
 REST_FRAMEWORK = {
     'DEFAULT_PERMISSION_CLASSES': [
         'rest_framework.permissions.AllowAny',
     ],
+    # JSON stays the default; internal callers send Accept: application/msgpack
     'DEFAULT_RENDERER_CLASSES': [
         'rest_framework.renderers.JSONRenderer',
-    ],
+    ] + ([
+        'api.renderers.MessagePackRenderer',
+        'api.renderers.XMessagePackRenderer',
+    ] if MSGPACK_AVAILABLE else []),
+    'DEFAULT_PARSER_CLASSES': [
+        'rest_framework.parsers.JSONParser',
+        'rest_framework.parsers.FormParser',
+        'rest_framework.parsers.MultiPartParser',
+    ] + (['api.renderers.MessagePackParser'] if MSGPACK_AVAILABLE else []),
     'DEFAULT_SCHEMA_CLASS': 'drf_spectacular.openapi.AutoSchema',
 }
 
+# Cache
+# https://docs.djangoproject.com/en/4.2/topics/cache/
+
+# Dossiers and fragments can be shared by all worker processes. Pick the
+# backend with SHARED_CACHE_BACKEND:
+#   locmem     per process (default, also used by the tests)
+#   file       files under SHARED_CACHE_LOCATION (default BASE_DIR/cache)
+#   shm        files under /dev/shm, i.e. RAM shared by workers on one host
+#   memcached  SHARED_CACHE_LOCATION = host:port (pymemcache)
+#   redis      SHARED_CACHE_LOCATION = redis://host:port/db (redis-py)
+# The file-based backends scan their directory on every write to cull it,
+# so keep MAX_ENTRIES modest there or prefer memcached/redis.
+SHARED_CACHE_BACKEND = os.environ.get('SHARED_CACHE_BACKEND', 'locmem')
+SHARED_CACHE_LOCATION = os.environ.get('SHARED_CACHE_LOCATION', '')
+
+
+def _shared_cache(name, max_entries):
+    if SHARED_CACHE_BACKEND == 'locmem':
+        return {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'LOCATION': name,
+            'OPTIONS': {'MAX_ENTRIES': max_entries},
+        }
+    if SHARED_CACHE_BACKEND in ('file', 'shm'):
+        root = '/dev/shm/car_registry' if SHARED_CACHE_BACKEND == 'shm' else SHARED_CACHE_LOCATION or BASE_DIR / 'cache'
+        return {
+            'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+            'LOCATION': os.path.join(root, name),
+            'OPTIONS': {'MAX_ENTRIES': max_entries},
+        }
+    if SHARED_CACHE_BACKEND == 'memcached':
+        return {
+            'BACKEND': 'django.core.cache.backends.memcached.PyMemcacheCache',
+            'LOCATION': SHARED_CACHE_LOCATION or '127.0.0.1:11211',
+            'KEY_PREFIX': name,
+        }
+    if SHARED_CACHE_BACKEND == 'redis':
+        return {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': SHARED_CACHE_LOCATION or 'redis://127.0.0.1:6379/0',
+            'KEY_PREFIX': name,
+        }
+    raise ValueError(f'unknown SHARED_CACHE_BACKEND: {SHARED_CACHE_BACKEND}')
+
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'dossiers': _shared_cache('dossiers', 100000),
+    'fragments': _shared_cache('fragments', 200000),
+}
+
+# check_plate dossier cache: entries are fresh for TTL seconds and then
+# served stale for up to STALE_TTL more while one refresh runs in the
+# background. CROSS_PROCESS_LOCK coalesces misses across workers when the
+# cache alias is shared (SHARED_CACHE_BACKEND). TTL = 0 disables caching.
+# PREWARM_TOP_K: on worker start, preload the N most looked-up plates
+# (skipped when another worker or `manage.py warm_dossier_cache` already
+# did). GENERATION_CHECK: how often (seconds) a worker re-reads the shared
+# key generation that `warm_dossier_cache --invalidate` bumps.
+DOSSIER_CACHE = {
+    'ALIAS': 'dossiers',
+    'TTL': 30,
+    'STALE_TTL': 300,
+    'CROSS_PROCESS_LOCK': False,
+    'LOCK_TIMEOUT': 5.0,
+    'PREWARM_TOP_K': 1000,
+    'GENERATION_CHECK': 1.0,
+}
+
+# Entity-level cache for dossier pieces shared across plates (owner with
+# latest license, insurer names), see api.fragments. Entries are dropped
+# on ORM writes; TTL bounds staleness after bulk updates. TTL = 0 disables.
+# CATALOG_CHECK: how often (seconds) a worker re-reads the CarPart catalog
+# generation kept in this alias, so part edits reach every worker.
+FRAGMENT_CACHE = {
+    'ALIAS': 'fragments',
+    'TTL': 3600,
+    'CATALOG_CHECK': 1.0,
+}
+
+# check_plate: let the database build the dossier JSON in one statement
+# (api.sqljson) for JSON clients on SQLite/PostgreSQL shards.
+SQL_JSON_DOSSIER = {
+    'ENABLED': True,
+}
+
+# Precomputed dossiers per active plate (api.materialized): JSON lookups
+# read one row by primary key. Writes queue the affected vehicles; up to
+# INLINE_LIMIT of them are rebuilt right after the commit, the rest by
+# `manage.py rebuild_dossiers --pending` (run it from cron). ACCIDENTS is
+# how many accidents a row keeps; larger requests are assembled live.
+# With ENABLED off the table is neither read nor maintained: run
+# `manage.py rebuild_dossiers` after turning it back on.
+MATERIALIZED_DOSSIERS = {
+    'ENABLED': True,
+    'ACCIDENTS': 10,
+    'INLINE_LIMIT': 100,
+    'CHUNK_SIZE': 500,
+}
+
+# Per-plate lookup counters, buffered in memory and flushed in batches to
+# plate_lookup_stats every FLUSH_INTERVAL seconds. TOP_K/SKETCH_* size the
+# in-process heavy-hitters tracker (count-min sketch).
+LOOKUP_STATS = {
+    'ENABLED': True,
+    'FLUSH_INTERVAL': 5.0,
+    'TOP_K': 100,
+    'SKETCH_WIDTH': 4096,
+    'SKETCH_DEPTH': 4,
+}
+
+# Audit log of check_plate lookups (personal data access). Events go to a
+# bounded in-process queue and are batch-inserted by a background writer
+# every BATCH_SIZE events or FLUSH_INTERVAL seconds. ON_FULL: 'block'
+# waits BLOCK_TIMEOUT seconds and then writes the event synchronously,
+# 'drop' discards it (counted in /api/metrics/).
+LOOKUP_AUDIT = {
+    'ENABLED': True,
+    'QUEUE_SIZE': 10000,
+    'BATCH_SIZE': 500,
+    'FLUSH_INTERVAL': 1.0,
+    'ON_FULL': 'block',
+    'BLOCK_TIMEOUT': 0.05,
+}
+
+# Admission control / load shedding for the lookup endpoints.
+# Requests that cannot start within LATENCY_BUDGET seconds are rejected
+# with 503 + Retry-After; RATE_LIMIT enables per-client token buckets
+# shared by all workers on the host (RATE tokens/sec, BURST capacity).
+# Concurrency limits and queues are per worker process; gunicorn.conf.py
+# runs enough threads per worker for them to engage.
+API_ADMISSION = {
+    'ENABLED': True,
+    'MAX_CONCURRENCY': 16,
+    'MAX_QUEUE': 64,
+    'LATENCY_BUDGET': 0.5,
+    'VIEWS': {
+        'check_plate': {'MAX_CONCURRENCY': 16, 'MAX_QUEUE': 64, 'LATENCY_BUDGET': 0.5},
+        'check_batch': {'MAX_CONCURRENCY': 4, 'MAX_QUEUE': 16, 'LATENCY_BUDGET': 1.0},
+        'list_plates': {'MAX_CONCURRENCY': 2, 'MAX_QUEUE': 4, 'LATENCY_BUDGET': 2.0},
+        'stream_plates': {'MAX_CONCURRENCY': 2, 'MAX_QUEUE': 4, 'LATENCY_BUDGET': 2.0},
+        'export_dossiers': {'MAX_CONCURRENCY': 1, 'MAX_QUEUE': 2, 'LATENCY_BUDGET': 2.0},
+        'check_vin': {'MAX_CONCURRENCY': 8, 'MAX_QUEUE': 32, 'LATENCY_BUDGET': 0.5},
+        'plate_history': {'MAX_CONCURRENCY': 4, 'MAX_QUEUE': 16, 'LATENCY_BUDGET': 1.0},
+        'search_vehicles': {'MAX_CONCURRENCY': 4, 'MAX_QUEUE': 16, 'LATENCY_BUDGET': 1.0},
+    },
+    'RATE_LIMIT': None,  # e.g. {'RATE': 50, 'BURST': 100, 'SLOTS': 4096}
+}
+
+# Statement deadlines per view (seconds; the client's X-Request-Timeout
+# applies if shorter) and a circuit breaker per database alias, see
+# api/dbguard.py. The breaker opens when, over the last WINDOW seconds and
+# at least MIN_CALLS statements, ERROR_RATE of them failed or SLOW_RATE of
+# them took SLOW_CALL seconds or more; it then rejects guarded statements
+# for OPEN_FOR seconds and closes after HALF_OPEN_CALLS successful trials.
+DB_GUARD = {
+    'ENABLED': True,
+    'VIEWS': {
+        'check_plate': 0.5,
+        'check_batch': 2.0,
+        'check_vin': 1.0,
+        'list_plates': 5.0,
+        'plate_history': 2.0,
+        'search_vehicles': 2.0,
+    },
+    'SQLITE_PROGRESS_OPS': 1000,
+    'BREAKER': {
+        'WINDOW': 10.0,
+        'MIN_CALLS': 20,
+        'ERROR_RATE': 0.5,
+        'SLOW_CALL': 0.25,
+        'SLOW_RATE': 0.8,
+        'OPEN_FOR': 5.0,
+        'HALF_OPEN_CALLS': 3,
+    },
+}
+
+# Partner export of every active plate's dossier (api/export.py): plates
+# are read CHUNK_SIZE at a time in plate_id order and each chunk is
+# flushed through the compressor (GZIP_LEVEL, or ZSTD_LEVEL when the
+# zstandard package is installed).
+DOSSIER_EXPORT = {
+    'CHUNK_SIZE': 1000,
+    'GZIP_LEVEL': 6,
+    'ZSTD_LEVEL': 3,
+}
+
+# On-demand profiling (api/profiling.py): requests sent with
+# "X-Profile: <TOKEN>" (any value from a staff session), plus a SAMPLE_RATE
+# share of the VIEWS listed (all views if empty), run under a CPU profiler
+# and tracemalloc. Reports go to DIRECTORY, which keeps the last
+# MAX_PROFILES of them. PROFILER: 'auto' (pyinstrument if installed) or
+# 'cprofile'.
+PROFILING = {
+    'ENABLED': True,
+    'TOKEN': os.environ.get('PROFILING_TOKEN', ''),
+    'SAMPLE_RATE': float(os.environ.get('PROFILING_SAMPLE_RATE', 0)),
+    'VIEWS': ('check_plate', 'check_batch', 'check_vin'),
+    'PROFILER': 'auto',
+    'MEMORY': True,
+    'DIRECTORY': os.environ.get('PROFILING_DIR', os.path.join(tempfile.gettempdir(), 'car_registry_profiles')),
+    'MAX_PROFILES': 50,
+}
+
+# Liveness/readiness probes (api/health.py). Readiness runs SELECT 1 on
+# every database alias with a DB_TIMEOUT-second deadline and caches the
+# result for CHECK_INTERVAL seconds; the pending-migrations check reloads
+# the migration graph at most every MIGRATIONS_INTERVAL seconds. Background
+# writers more than STALE_AFTER seconds behind are reported as stale.
+HEALTH_CHECKS = {
+    'CHECK_INTERVAL': 5.0,
+    'DB_TIMEOUT': 1.0,
+    'MIGRATIONS_INTERVAL': 60.0,
+    'STALE_AFTER': 60.0,
+}
+
 # CORS settings
 CORS_ALLOW_ALL_ORIGINS = True
 CORS_ALLOW_CREDENTIALS = True
@@ -3,6 +3,8 @@
 Скрипт для проверки данных в базе
 """
 import os
+from itertools import groupby
+
 import django
 
 if __name__ == '__main__':
@@ -27,7 +29,11 @@ if __name__ == '__main__':
     
     # Показываем примеры аварий с деталями
     print("\n=== Примеры аварий с поврежденными деталями ===")
-    for accident in Accident.objects.filter(damaged_parts__isnull=False).distinct()[:3]:
+    examples = (
+        Accident.objects.filter(damaged_parts__isnull=False).distinct()
+        .select_related('vehicle').prefetch_related('damaged_parts')[:3]
+    )
+    for accident in examples:
         print(f"\nАвария ID {accident.accident_id}:")
         print(f"  Дата: {accident.date}")
         print(f"  ТС: {accident.vehicle}")
@@ -37,7 +43,10 @@ if __name__ == '__main__':
     
     # Показываем все доступные детали
     print("\n=== Все доступные детали ===")
-    for category in CarPart.objects.values_list('category', flat=True).distinct():
+    # Одним запросом: CarPart упорядочены по категории
+    for category, parts in groupby(CarPart.objects.all(), key=lambda part: part.category):
         print(f"\n{category}:")
-        for part in CarPart.objects.filter(category=category):
+        for part in parts:
             print(f"  - {part.name}")
+
+    print("\nПолная проверка целостности: python manage.py audit_registry")
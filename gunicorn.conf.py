@@ -0,0 +1,65 @@
+"""
+Gunicorn settings for production: ``gunicorn -c gunicorn.conf.py``.
+
+Environment:
+    WEB_CONCURRENCY        worker processes (default: number of CPUs)
+    GUNICORN_THREADS       threads per worker (default 32)
+    GUNICORN_BIND          listen address (default 0.0.0.0:8000)
+    GUNICORN_MAX_REQUESTS  recycle a worker after this many requests (default 0: never)
+
+Migrations are not run here: ``python manage.py migrate`` is a separate
+deploy step.
+"""
+import multiprocessing
+import os
+
+wsgi_app = 'car_registry.wsgi:application'
+bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:8000')
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count()))
+# Admission control (API_ADMISSION), single-flight and the circuit breakers
+# are per worker process and only see requests the worker runs at the same
+# time: with one thread a worker serves one request and the rest queue
+# unseen in the listen backlog. Keep threads at or above the largest
+# MAX_CONCURRENCY, with room for the requests admission holds in its queue
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', 32))
+
+# Import Django, the app and its caches (and pre-warm the dossier cache)
+# once in the master; forked workers share those pages copy-on-write.
+# Importing the app opens no database connection and prewarm_on_startup
+# closes the ones it used, so no worker inherits one
+preload_app = True
+
+# Workers finish in-flight requests on SIGTERM for up to graceful_timeout
+# seconds; keep the container's stop grace period longer than that
+timeout = 30
+graceful_timeout = 25
+keepalive = 5
+
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS', 0))
+max_requests_jitter = max_requests // 10
+
+accesslog = os.environ.get('GUNICORN_ACCESS_LOG') or None
+errorlog = '-'
+
+
+def worker_exit(server, worker):
+    # Flush the background batch writers before the process goes away
+    from api import audit, stats
+
+    audit.writer.shutdown()
+    stats.lookups.stop()
+
+
+def when_ready(server):
+    from api import admission
+
+    config = admission.get_config()
+    largest = max([config['MAX_CONCURRENCY']] + [
+        options.get('MAX_CONCURRENCY', config['MAX_CONCURRENCY']) for options in config['VIEWS'].values()
+    ])
+    if threads < largest:
+        server.log.warning(
+            'threads=%s is below API_ADMISSION MAX_CONCURRENCY=%s: the admission limit and queue never engage',
+            threads, largest,
+        )
@@ -11,6 +11,7 @@ if __name__ == '__main__':
     os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'car_registry.settings')
     django.setup()
     
+    from api import shards
     from api.models import Owner, DriverLicense, Vehicle, Plate, Insurer, InsurancePolicy, Accident, CarPart
     from datetime import date, timedelta
     import random
@@ -18,22 +19,20 @@ if __name__ == '__main__':
     
     print("Создаем тестовые данные...")
     
-    # Очищаем существующие данные
-    Accident.objects.all().delete()
-    InsurancePolicy.objects.all().delete()
-    Plate.objects.all().delete()
-    Vehicle.objects.all().delete()
-    DriverLicense.objects.all().delete()
-    Owner.objects.all().delete()
-    Insurer.objects.all().delete()
-    CarPart.objects.all().delete()
+    aliases = shards.aliases()
     
-    # Создаем страховые компании
-    insurers = [
-        Insurer.objects.create(name='Jusan Insurance'),
-        Insurer.objects.create(name='Nomad Insurance'),
-        Insurer.objects.create(name='Eurasia Insurance'),
-    ]
+    # Очищаем существующие данные во всех шардах
+    for alias in aliases:
+        Accident.objects.using(alias).all().delete()
+        InsurancePolicy.objects.using(alias).all().delete()
+        Plate.objects.using(alias).all().delete()
+        Vehicle.objects.using(alias).all().delete()
+        DriverLicense.objects.using(alias).all().delete()
+        Owner.objects.using(alias).all().delete()
+        Insurer.objects.using(alias).all().delete()
+        CarPart.objects.using(alias).all().delete()
+    
+    insurer_names = ['Jusan Insurance', 'Nomad Insurance', 'Eurasia Insurance']
     
     # Создаем детали автомобиля
     car_parts_data = [
@@ -79,38 +78,6 @@ if __name__ == '__main__':
         ('Правое зеркало', 'Зеркала', 'Правое боковое зеркало'),
     ]
     
-    car_parts = []
-    for name, category, description in car_parts_data:
-        part = CarPart.objects.create(
-            name=name,
-            category=category,
-            description=description
-        )
-        car_parts.append(part)
-    
-    # Создаем владельцев и их данные
-    owners = []
-    for i in range(1, 101):  # Создаем 100 владельцев
-        owner = Owner.objects.create(
-            full_name=f'Владелец {i}',
-            iin=f'{700000000000 + i:012d}',
-            dob=date(1970, 1, 1) + timedelta(days=random.randint(0, 15000)),
-            phone=f'+7701{random.randint(1000000, 9999999)}'
-        )
-        owners.append(owner)
-        
-        # Создаем водительское удостоверение
-        DriverLicense.objects.create(
-            owner=owner,
-            number=f'DL-{i:07d}',
-            categories=random.choice(['A', 'B', 'B,BE', 'C', 'D']),
-            issued_at=date.today() - timedelta(days=365 * random.randint(1, 10)),
-            expires_at=date.today() + timedelta(days=365 * random.randint(1, 5)),
-            status='valid'
-        )
-    
-    # Создаем транспортные средства
-    vehicles = []
     makes_models = [
         ('Toyota', 'Camry'),
         ('VW', 'Golf'),
@@ -121,74 +88,111 @@ if __name__ == '__main__':
     ]
     colors = ['white', 'black', 'silver', 'blue', 'red']
     
-    for i, owner in enumerate(owners):
-        make, model = random.choice(makes_models)
-        vin = ''.join(random.choices(string.ascii_uppercase + string.digits, k=17))
-        
-        vehicle = Vehicle.objects.create(
-            owner=owner,
-            vin=vin,
-            make=make,
-            model=model,
-            year=2005 + random.randint(0, 20),
-            color=random.choice(colors)
-        )
-        vehicles.append(vehicle)
-        
-        # Создаем номерной знак
-        plate_number = f'{random.randint(100, 999)}{random.choice(string.ascii_uppercase)}{random.choice(string.ascii_uppercase)}{random.choice(string.ascii_uppercase)}{random.randint(10, 99)}'
-        Plate.objects.create(
-            vehicle=vehicle,
-            plate_number=plate_number,
-            region=f'Region{random.randint(1, 17)}'
-        )
-        
-        # Создаем страховой полис OSAGO
-        InsurancePolicy.objects.create(
-            vehicle=vehicle,
-            insurer=random.choice(insurers),
-            policy_number=f'OSG-{random.randint(1000000, 9999999)}',
-            type='OSAGO',
-            valid_from=date.today() - timedelta(days=random.randint(0, 60)),
-            valid_to=date.today() + timedelta(days=random.randint(10, 300)),
-            status='active' if random.random() < 0.85 else 'expired'
-        )
+    # Готовим записи в памяти и раскладываем их по шардам по коду региона номера
+    records_by_alias = {alias: [] for alias in aliases}
+    for i in range(1, 101):  # Создаем 100 владельцев, у каждого по одному ТС
+        region = f'{random.randint(1, 20):02d}'
+        plate_number = f'{random.randint(100, 999)}{random.choice(string.ascii_uppercase)}{random.choice(string.ascii_uppercase)}{random.choice(string.ascii_uppercase)}{region}'
+        records_by_alias[shards.alias_for_region(region)].append((i, region, plate_number))
+    
+    def load_shard(alias, records):
+        """Записывает данные одного шарда (шарды загружаются параллельно)"""
+        # Справочники дублируются в каждом шарде
+        insurers = [Insurer.objects.using(alias).create(name=name) for name in insurer_names]
+        car_parts = [
+            CarPart.objects.using(alias).create(name=name, category=category, description=description)
+            for name, category, description in car_parts_data
+        ]
         
-        # Создаем страховой полис KASKO (не для всех)
-        if random.random() < 0.3:
-            InsurancePolicy.objects.create(
+        for i, region, plate_number in records:
+            owner = Owner.objects.using(alias).create(
+                full_name=f'Владелец {i}',
+                iin=f'{700000000000 + i:012d}',
+                dob=date(1970, 1, 1) + timedelta(days=random.randint(0, 15000)),
+                phone=f'+7701{random.randint(1000000, 9999999)}'
+            )
+            
+            # Создаем водительское удостоверение
+            DriverLicense.objects.using(alias).create(
+                owner=owner,
+                number=f'DL-{i:07d}',
+                categories=random.choice(['A', 'B', 'B,BE', 'C', 'D']),
+                issued_at=date.today() - timedelta(days=365 * random.randint(1, 10)),
+                expires_at=date.today() + timedelta(days=365 * random.randint(1, 5)),
+                status='valid'
+            )
+            
+            # Создаем транспортное средство
+            make, model = random.choice(makes_models)
+            vin = ''.join(random.choices(string.ascii_uppercase + string.digits, k=17))
+            vehicle = Vehicle.objects.using(alias).create(
+                owner=owner,
+                vin=vin,
+                make=make,
+                model=model,
+                year=2005 + random.randint(0, 20),
+                color=random.choice(colors)
+            )
+            
+            # Создаем номерной знак (последние две цифры - код региона)
+            Plate.objects.using(alias).create(
                 vehicle=vehicle,
-                insurer=random.choice(insurers),
-                policy_number=f'KSK-{random.randint(1000000, 9999999)}',
-                type='KASKO',
-                valid_from=date.today() - timedelta(days=random.randint(0, 60)),
-                valid_to=date.today() + timedelta(days=random.randint(100, 400)),
-                status='active' if random.random() < 0.9 else 'expired'
+                plate_number=plate_number,
+                region=region
             )
-        
-        # Создаем аварии (не для всех)
-        if random.random() < 0.2:
-            accident = Accident.objects.create(
+            
+            # Создаем страховой полис OSAGO
+            InsurancePolicy.objects.using(alias).create(
                 vehicle=vehicle,
-                date=date.today() - timedelta(days=random.randint(10, 800)),
-                severity=random.choice(['minor', 'moderate', 'severe']),
-                location=random.choice(['Алматы', 'Астана', 'Шымкент', 'Караганда']),
-                description='Имитация ДТП',
-                fault_party=random.choice(['owner', 'other', 'unknown'])
+                insurer=random.choice(insurers),
+                policy_number=f'OSG-{random.randint(1000000, 9999999)}',
+                type='OSAGO',
+                valid_from=date.today() - timedelta(days=random.randint(0, 60)),
+                valid_to=date.today() + timedelta(days=random.randint(10, 300)),
+                status='active' if random.random() < 0.85 else 'expired'
             )
             
-            # Добавляем случайные поврежденные детали
-            num_damaged_parts = random.randint(1, 5)  # От 1 до 5 поврежденных деталей
-            damaged_parts = random.sample(car_parts, min(num_damaged_parts, len(car_parts)))
-            accident.damaged_parts.set(damaged_parts)
+            # Создаем страховой полис KASKO (не для всех)
+            if random.random() < 0.3:
+                InsurancePolicy.objects.using(alias).create(
+                    vehicle=vehicle,
+                    insurer=random.choice(insurers),
+                    policy_number=f'KSK-{random.randint(1000000, 9999999)}',
+                    type='KASKO',
+                    valid_from=date.today() - timedelta(days=random.randint(0, 60)),
+                    valid_to=date.today() + timedelta(days=random.randint(100, 400)),
+                    status='active' if random.random() < 0.9 else 'expired'
+                )
+            
+            # Создаем аварии (не для всех)
+            if random.random() < 0.2:
+                accident = Accident.objects.using(alias).create(
+                    vehicle=vehicle,
+                    date=date.today() - timedelta(days=random.randint(10, 800)),
+                    severity=random.choice(['minor', 'moderate', 'severe']),
+                    location=random.choice(['Алматы', 'Астана', 'Шымкент', 'Караганда']),
+                    description='Имитация ДТП',
+                    fault_party=random.choice(['owner', 'other', 'unknown'])
+                )
+                
+                # Добавляем случайные поврежденные детали
+                num_damaged_parts = random.randint(1, 5)  # От 1 до 5 поврежденных деталей
+                damaged_parts = random.sample(car_parts, min(num_damaged_parts, len(car_parts)))
+                accident.damaged_parts.set(damaged_parts)
+        return len(records)
+    
+    shards.write_parallel(records_by_alias, load_shard)
+    
+    def total(model):
+        return sum(model.objects.using(alias).count() for alias in aliases)
     
     print(f"Создано:")
-    print(f"- {Owner.objects.count()} владельцев")
-    print(f"- {DriverLicense.objects.count()} водительских удостоверений")
-    print(f"- {Vehicle.objects.count()} транспортных средств")
-    print(f"- {Plate.objects.count()} номерных знаков")
-    print(f"- {Insurer.objects.count()} страховых компаний")
-    print(f"- {InsurancePolicy.objects.count()} страховых полисов")
-    print(f"- {CarPart.objects.count()} деталей автомобиля")
-    print(f"- {Accident.objects.count()} аварий")
+    print(f"- {total(Owner)} владельцев")
+    print(f"- {total(DriverLicense)} водительских удостоверений")
+    print(f"- {total(Vehicle)} транспортных средств")
+    print(f"- {total(Plate)} номерных знаков")
+    print(f"- {len(insurer_names)} страховых компаний (в каждом из {len(aliases)} шардов)")
+    print(f"- {total(InsurancePolicy)} страховых полисов")
+    print(f"- {len(car_parts_data)} деталей автомобиля (в каждом из {len(aliases)} шардов)")
+    print(f"- {total(Accident)} аварий")
     print("Тестовые данные успешно загружены!")
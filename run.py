@@ -1,20 +1,23 @@
 #!/usr/bin/env python
 """
-Скрипт для запуска Django сервера с автоматической настройкой
+Скрипт для запуска Django сервера
+
+    python run.py          # gunicorn с настройками из gunicorn.conf.py
+    python run.py --dev    # runserver для разработки
+
+Миграции не выполняются: это отдельный шаг (python manage.py migrate).
 """
 import os
 import sys
-import django
-from django.core.management import execute_from_command_line
 
 if __name__ == '__main__':
     os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'car_registry.settings')
-    django.setup()
-    
-    # Выполняем миграции
-    print("Выполняем миграции...")
-    execute_from_command_line(['manage.py', 'migrate'])
-    
-    # Запускаем сервер
-    print("Запускаем сервер...")
-    execute_from_command_line(['manage.py', 'runserver', '0.0.0.0:8000'])
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+    if '--dev' in sys.argv[1:]:
+        from django.core.management import execute_from_command_line
+
+        execute_from_command_line(['manage.py', 'runserver', '0.0.0.0:8000'])
+    else:
+        # exec: gunicorn gets the process and with it SIGTERM for a graceful shutdown
+        os.execvp(sys.executable, [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py'])